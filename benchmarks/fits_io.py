@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+
+from spectral_cube import SpectralCube
+
+from .utils import make_cube, SHAPES, DTYPES
+
+
+class FITSIO(object):
+
+    params = [SHAPES, DTYPES]
+    param_names = ['shape', 'dtype']
+    timeout = 300
+
+    def setup(self, shape, dtype):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cube = make_cube(shape, dtype=dtype)
+        self.filename = os.path.join(self.tmpdir, 'cube.fits')
+        self.cube.write(self.filename)
+
+    def teardown(self, shape, dtype):
+        shutil.rmtree(self.tmpdir)
+
+    def time_read(self, shape, dtype):
+        SpectralCube.read(self.filename)
+
+    def time_read_sum(self, shape, dtype):
+        SpectralCube.read(self.filename).sum(axis=0)
+
+    def peakmem_read_sum(self, shape, dtype):
+        SpectralCube.read(self.filename).sum(axis=0)
+
+    def time_read_memmap_sum(self, shape, dtype):
+        with SpectralCube.read(self.filename, memmap=True) as cube:
+            cube.sum(axis=0)
+
+    def time_write(self, shape, dtype):
+        self.cube.write(os.path.join(self.tmpdir, 'out.fits'), overwrite=True)
+
+    def peakmem_write(self, shape, dtype):
+        self.cube.write(os.path.join(self.tmpdir, 'out.fits'), overwrite=True)
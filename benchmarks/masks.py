@@ -0,0 +1,36 @@
+from spectral_cube import BooleanArrayMask
+
+from .utils import make_cube, SHAPES
+
+
+class MaskComposition(object):
+
+    params = [SHAPES, [False, True]]
+    param_names = ['shape', 'packed']
+    timeout = 300
+
+    def setup(self, shape, packed):
+        self.cube = make_cube(shape)
+        data = self.cube._data
+        self.signal = BooleanArrayMask(data > 0.5, self.cube._wcs,
+                                       packed=packed)
+        self.edges = BooleanArrayMask(data < 0.9, self.cube._wcs,
+                                      packed=packed)
+
+    def time_compose(self, shape, packed):
+        (self.signal & ~self.edges) | self.edges
+
+    def time_include(self, shape, packed):
+        ((self.signal & ~self.edges) | self.edges).include(
+            data=self.cube._data, wcs=self.cube._wcs)
+
+    def peakmem_include(self, shape, packed):
+        ((self.signal & ~self.edges) | self.edges).include(
+            data=self.cube._data, wcs=self.cube._wcs)
+
+    def time_lazy_include(self, shape, packed):
+        mask = self.cube.mask & (self.cube > 0.2) & ~(self.cube > 0.8)
+        mask.include(data=self.cube._data, wcs=self.cube._wcs)
+
+    def time_with_mask_sum(self, shape, packed):
+        self.cube.with_mask(self.signal).with_mask(~self.edges).sum(axis=0)
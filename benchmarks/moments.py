@@ -0,0 +1,31 @@
+from .utils import make_cube, SHAPES, DTYPES, STRATEGIES
+
+
+class Moments(object):
+
+    params = [SHAPES, DTYPES, [0, 1, 2], STRATEGIES]
+    param_names = ['shape', 'dtype', 'order', 'how']
+    timeout = 300
+
+    def setup(self, shape, dtype, order, how):
+        self.cube = make_cube(shape, dtype=dtype)
+
+    def time_moment(self, shape, dtype, order, how):
+        self.cube.moment(order=order, axis=0, how=how)
+
+    def peakmem_moment(self, shape, dtype, order, how):
+        self.cube.moment(order=order, axis=0, how=how)
+
+
+class MomentsAll(object):
+    # all three moments computed in a single pass
+
+    params = [SHAPES, STRATEGIES]
+    param_names = ['shape', 'how']
+    timeout = 300
+
+    def setup(self, shape, how):
+        self.cube = make_cube(shape)
+
+    def time_moments(self, shape, how):
+        self.cube.moments(orders=(0, 1, 2), axis=0, how=how)
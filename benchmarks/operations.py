@@ -0,0 +1,29 @@
+from astropy import units as u
+
+from .utils import make_cube, SHAPES, DTYPES
+
+
+class SpectralOperations(object):
+
+    params = [SHAPES, DTYPES]
+    param_names = ['shape', 'dtype']
+    timeout = 300
+
+    def setup(self, shape, dtype):
+        self.cube = make_cube(shape, dtype=dtype)
+        spectral_axis = self.cube.spectral_axis
+        self.lo = spectral_axis[len(spectral_axis) // 4]
+        self.hi = spectral_axis[3 * len(spectral_axis) // 4]
+
+    def time_spectral_slab(self, shape, dtype):
+        self.cube.spectral_slab(self.lo, self.hi)
+
+    def time_spectral_slab_sum(self, shape, dtype):
+        self.cube.spectral_slab(self.lo, self.hi).sum(axis=0)
+
+    def time_with_spectral_unit(self, shape, dtype):
+        self.cube.with_spectral_unit(u.GHz, velocity_convention='radio')
+
+    def time_with_spectral_unit_axis(self, shape, dtype):
+        self.cube.with_spectral_unit(u.GHz,
+                                     velocity_convention='radio').spectral_axis
@@ -0,0 +1,55 @@
+from .utils import make_cube, SHAPES, DTYPES, STRATEGIES
+
+
+class Reductions(object):
+
+    params = [SHAPES, DTYPES, ['sum', 'max', 'argmax'], STRATEGIES]
+    param_names = ['shape', 'dtype', 'function', 'how']
+    timeout = 300
+
+    def setup(self, shape, dtype, function, how):
+        self.cube = make_cube(shape, dtype=dtype)
+
+    def time_reduce(self, shape, dtype, function, how):
+        getattr(self.cube, function)(axis=0, how=how)
+
+    def peakmem_reduce(self, shape, dtype, function, how):
+        getattr(self.cube, function)(axis=0, how=how)
+
+
+class ReductionsAxis(object):
+    # reductions along a spatial axis, where the slices are not contiguous
+
+    params = [SHAPES, STRATEGIES]
+    param_names = ['shape', 'how']
+    timeout = 300
+
+    def setup(self, shape, how):
+        self.cube = make_cube(shape)
+
+    def time_sum(self, shape, how):
+        self.cube.sum(axis=2, how=how)
+
+
+class OrderStatistics(object):
+    # median and percentile always process blocks of rays, so do not
+    # accept ``how``
+
+    params = [SHAPES, DTYPES, [0, 2]]
+    param_names = ['shape', 'dtype', 'axis']
+    timeout = 300
+
+    def setup(self, shape, dtype, axis):
+        self.cube = make_cube(shape, dtype=dtype)
+
+    def time_median(self, shape, dtype, axis):
+        self.cube.median(axis=axis)
+
+    def peakmem_median(self, shape, dtype, axis):
+        self.cube.median(axis=axis)
+
+    def time_percentile(self, shape, dtype, axis):
+        self.cube.percentile(90, axis=axis)
+
+    def peakmem_percentile(self, shape, dtype, axis):
+        self.cube.percentile(90, axis=axis)
@@ -0,0 +1,59 @@
+"""
+Synthetic cubes for the benchmarks, built from the same header as the test
+cubes in ``spectral_cube/tests/data/make_test_cubes.py``
+"""
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from spectral_cube import SpectralCube, LazyMask
+
+SHAPES = [(32, 64, 64), (128, 128, 128)]
+DTYPES = ['float32', 'float64']
+STRATEGIES = ['cube', 'slice', 'ray']
+
+
+def make_header(shape):
+    """
+    Return a 3D velocity/dec/ra header for data with the given numpy shape
+    """
+    header = fits.Header()
+    header['NAXIS'] = 3
+    for i, n in enumerate(shape[::-1]):
+        header['NAXIS%i' % (i + 1)] = n
+    header['CTYPE1'] = 'RA---SIN'
+    header['CDELT1'] = -5.55555561268E-04
+    header['CRPIX1'] = shape[2] / 2.
+    header['CRVAL1'] = 2.31837500515E+01
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CDELT2'] = 5.55555561268E-04
+    header['CRPIX2'] = shape[1] / 2.
+    header['CRVAL2'] = 3.05765277962E+01
+    header['CTYPE3'] = 'VELO-HEL'
+    header['CDELT3'] = 1.28821496879E+03
+    header['CRPIX3'] = 1.
+    header['CRVAL3'] = -3.21214698632E+05
+    header['RESTFREQ'] = 1.42040571841E+09
+    header['BUNIT'] = 'JY/BEAM'
+    return header
+
+
+def make_data(shape, dtype='float64', seed=42):
+    """
+    Return random data with a few NaN values
+    """
+    random = np.random.RandomState(seed)
+    data = random.random_sample(shape).astype(dtype)
+    data[random.random_sample(shape) < 0.01] = np.nan
+    return data
+
+
+def make_cube(shape, dtype='float64'):
+    """
+    Return a cube of random data, masked where the data are not finite
+    """
+    data = make_data(shape, dtype=dtype)
+    wcs = WCS(make_header(shape))
+    mask = LazyMask(np.isfinite, data=data, wcs=wcs)
+    return SpectralCube(data, wcs, mask=mask)
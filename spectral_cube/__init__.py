@@ -1,2 +1,5 @@
-from .spectral_cube import SpectralCube, StokesSpectralCube, Projection
+from .spectral_cube import (SpectralCube, StokesSpectralCube, Projection,
+                            clear_cache)
+from .dask_spectral_cube import DaskSpectralCube
+from .cube_utils import set_memory_limit, get_memory_limit
 from .masks import *
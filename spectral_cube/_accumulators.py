@@ -0,0 +1,305 @@
+"""
+Streaming accumulators used to reduce a cube one plane at a time
+"""
+
+import numpy as np
+
+
+class Accumulator(object):
+    """
+    Base class for streaming reductions.
+
+    An accumulator is fed the planes of a cube one at a time through
+    :meth:`update`, and only keeps a few plane-sized arrays as state.
+    Once all planes have been seen, :meth:`result` returns the
+    reduction along the iteration axis or, if ``full=True``, over the
+    whole cube.
+
+    NaN values are ignored, consistent with the ``np.nan*`` functions.
+    """
+
+    def __init__(self):
+        self._nplanes = 0
+
+    def update(self, plane, index=None):
+        """
+        Add a plane to the accumulator.
+
+        Parameters
+        ----------
+        plane : `~numpy.ndarray`
+            The next plane of data. All planes must have the same shape.
+        index : int, optional
+            The position of ``plane`` along the iteration axis. Defaults
+            to the number of planes seen so far.
+        """
+        plane = np.asarray(plane)
+        if index is None:
+            index = self._nplanes
+        if self._nplanes == 0:
+            self._initialize(plane, index)
+        self._update(plane, index)
+        self._nplanes += 1
+
+    def merge(self, other):
+        """
+        Combine the state of another accumulator of the same type into
+        this one.
+
+        This is used to combine partial reductions of disjoint sets of
+        planes, for instance computed in parallel. Plane indices should
+        be absolute positions in the cube for index-tracking reductions.
+        """
+        if other._nplanes == 0:
+            return
+        if self._nplanes == 0:
+            # copy the state, so that updating this accumulator does not
+            # modify the other one
+            for key, value in other.__dict__.items():
+                if isinstance(value, np.ndarray):
+                    value = value.copy()
+                setattr(self, key, value)
+            return
+        self._merge(other)
+        self._nplanes += other._nplanes
+
+    def result(self, full=False):
+        """
+        Return the accumulated reduction.
+
+        Parameters
+        ----------
+        full : bool
+            If True, reduce over all axes instead of only along the
+            iteration axis.
+        """
+        if self._nplanes == 0:
+            raise ValueError("No planes have been accumulated")
+        return self._result(full)
+
+    def _initialize(self, plane, index):
+        raise NotImplementedError()
+
+    def _update(self, plane, index):
+        raise NotImplementedError()
+
+    def _merge(self, other):
+        raise NotImplementedError()
+
+    def _result(self, full):
+        raise NotImplementedError()
+
+
+class SumAccumulator(Accumulator):
+    """
+    Streaming equivalent of `numpy.nansum`
+    """
+
+    def _initialize(self, plane, index):
+        # use the same result type as numpy for integers, e.g. to avoid
+        # overflowing small integer types, and add floating point values
+        # in double precision, since rounding errors build up over planes
+        dtype = np.sum(np.zeros(1, dtype=plane.dtype)).dtype
+        if dtype.kind in 'fc':
+            dtype = np.result_type(dtype, np.float64)
+        self._total = np.zeros(plane.shape, dtype=dtype)
+
+    def _update(self, plane, index):
+        np.add(self._total, plane, out=self._total, where=~np.isnan(plane))
+
+    def _merge(self, other):
+        self._total += other._total
+
+    def _result(self, full):
+        return self._total.sum() if full else self._total
+
+
+class CountAccumulator(Accumulator):
+    """
+    Count the number of non-NaN values
+    """
+
+    def _initialize(self, plane, index):
+        self._count = np.zeros(plane.shape, dtype=np.intp)
+
+    def _update(self, plane, index):
+        self._count += ~np.isnan(plane)
+
+    def _merge(self, other):
+        self._count += other._count
+
+    def _result(self, full):
+        return self._count.sum() if full else self._count
+
+
+class MaxAccumulator(Accumulator):
+    """
+    Streaming equivalent of `numpy.nanmax`
+    """
+
+    _combine = staticmethod(np.fmax)
+    _reduce = staticmethod(np.nanmax)
+
+    def _initialize(self, plane, index):
+        self._best = plane.copy()
+
+    def _update(self, plane, index):
+        self._combine(self._best, plane, out=self._best)
+
+    def _merge(self, other):
+        self._combine(self._best, other._best, out=self._best)
+
+    def _result(self, full):
+        return self._reduce(self._best) if full else self._best
+
+
+class MinAccumulator(MaxAccumulator):
+    """
+    Streaming equivalent of `numpy.nanmin`
+    """
+
+    _combine = staticmethod(np.fmin)
+    _reduce = staticmethod(np.nanmin)
+
+
+class ArgMaxAccumulator(Accumulator):
+    """
+    Streaming equivalent of `numpy.nanargmax`.
+
+    The value of the current extremum is tracked along with the index of
+    the plane it came from. Ties are resolved in favor of the earliest
+    index, so the result is identical to `numpy.nanargmax`.
+    """
+
+    _compare = staticmethod(np.greater)
+    _extremum = staticmethod(np.nanmax)
+
+    def _initialize(self, plane, index):
+        self._best = plane.copy()
+        self._index = np.full(plane.shape, index, dtype=np.intp)
+
+    def _update(self, plane, index):
+        better = self._compare(plane, self._best)
+        better |= np.isnan(self._best) & ~np.isnan(plane)
+        np.copyto(self._best, plane, where=better)
+        self._index[better] = index
+
+    def _merge(self, other):
+        better = self._compare(other._best, self._best)
+        better |= np.isnan(self._best) & ~np.isnan(other._best)
+        better |= (other._best == self._best) & (other._index < self._index)
+        np.copyto(self._best, other._best, where=better)
+        np.copyto(self._index, other._index, where=better)
+
+    def _result(self, full):
+        if not full:
+            return self._index
+
+        # the extremum may occur in several pixels, in which case the
+        # index of the first occurrence in the flattened cube wins
+        candidates = self._best == self._extremum(self._best)
+        if not candidates.any():
+            raise ValueError("All-NaN slice encountered")
+        flat = (self._index * self._best.size +
+                np.arange(self._best.size).reshape(self._best.shape))
+        return flat[candidates].min()
+
+
+class ArgMinAccumulator(ArgMaxAccumulator):
+    """
+    Streaming equivalent of `numpy.nanargmin`
+    """
+
+    _compare = staticmethod(np.less)
+    _extremum = staticmethod(np.nanmin)
+
+
+class MeanAccumulator(Accumulator):
+    """
+    Streaming equivalent of `numpy.nanmean`.
+
+    Uses Welford's algorithm, which keeps a running mean and sum of
+    squared deviations per pixel, and is numerically stable. Per-pixel
+    statistics are combined with the parallel algorithm of Chan et al.
+    for full reductions.
+
+    Parameters
+    ----------
+    ddof : int
+        Delta degrees of freedom used by the variance
+    """
+
+    def __init__(self, ddof=0):
+        super(MeanAccumulator, self).__init__()
+        self._ddof = ddof
+
+    def _initialize(self, plane, index):
+        dtype = np.result_type(plane.dtype, np.float64)
+        self._count = np.zeros(plane.shape, dtype=np.intp)
+        self._mean = np.zeros(plane.shape, dtype=dtype)
+        self._m2 = np.zeros(plane.shape, dtype=dtype)
+
+    def _update(self, plane, index):
+        valid = ~np.isnan(plane)
+        self._count += valid
+        delta = np.where(valid, plane - self._mean, 0)
+        self._mean += delta / np.maximum(self._count, 1)
+        self._m2 += delta * np.where(valid, plane - self._mean, 0)
+
+    def _merge(self, other):
+        count = self._count + other._count
+        delta = other._mean - self._mean
+        weight = other._count / np.maximum(count, 1).astype(self._mean.dtype)
+        self._mean += delta * weight
+        self._m2 += other._m2 + delta ** 2 * self._count * weight
+        self._count = count
+
+    def _moments(self, full):
+        """
+        Return the count, mean and sum of squared deviations
+        """
+        if not full:
+            return self._count, self._mean, self._m2
+        count = self._count.sum()
+        mean = (self._count * self._mean).sum() / max(count, 1)
+        m2 = (self._m2 + self._count * (self._mean - mean) ** 2).sum()
+        return count, mean, m2
+
+    def _variance(self, full):
+        count, mean, m2 = self._moments(full)
+        dof = np.asarray(count - self._ddof, dtype=m2.dtype)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(dof > 0, m2 / dof, np.nan)[()]
+
+    def _result(self, full):
+        count, mean, m2 = self._moments(full)
+        return np.where(count > 0, mean, np.nan)[()]
+
+
+class VarianceAccumulator(MeanAccumulator):
+    """
+    Streaming equivalent of `numpy.nanvar`
+    """
+
+    def _result(self, full):
+        return self._variance(full)
+
+
+class StdAccumulator(MeanAccumulator):
+    """
+    Streaming equivalent of `numpy.nanstd`
+    """
+
+    def _result(self, full):
+        return np.sqrt(self._variance(full))
+
+
+# The numpy reductions that can be computed one plane at a time
+ACCUMULATORS = {np.nansum: SumAccumulator,
+                np.nanmax: MaxAccumulator,
+                np.nanmin: MinAccumulator,
+                np.nanargmax: ArgMaxAccumulator,
+                np.nanargmin: ArgMinAccumulator,
+                np.nanmean: MeanAccumulator,
+                np.nanvar: VarianceAccumulator,
+                np.nanstd: StdAccumulator}
@@ -1,6 +1,9 @@
+from math import factorial
+
 import numpy as np
 
-from .cube_utils import iterator_strategy
+from .cube_utils import (iterator_strategy, broadcast_view, broadcast_to,
+                         block_size)
 
 """
 Functions to compute moment maps in a variety of ways
@@ -25,157 +28,205 @@ def _moment_shp(cube, axis):
     return cube.shape[:axis] + cube.shape[axis + 1:]
 
 
-def _slice0(cube, axis):
+def _moment_from_sums(sums, order, valid, ref):
     """
-    0th moment along an axis, calculated slicewise
+    Compute a moment from the intensity-weighted sums of powers of the
+    pixel coordinate
 
     Parameters
     ----------
-    cube : SpectralCube
-    axis : int
+    sums : array
+        An array whose k-th element is the sum of ``I * dl * (l - ref) ** k``
+        along the collapsed axis, for k = 0 up to at least ``order``
+    order : int
+        The order of the moment
+    valid : array
+        Whether any data along the collapsed axis was valid
+    ref : array
+        The coordinate the sums are relative to
 
     Returns
     -------
-    moment0 : array
+    moment : array
     """
-    shp = _moment_shp(cube, axis)
-    result = np.zeros(shp)
+    if order == 0:
+        return np.where(valid, sums[0], np.nan)
 
-    view = [slice(None)] * 3
-    pix_size = cube._pix_size()[axis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mom1 = sums[1] / sums[0]
+        if order == 1:
+            return ref + mom1
 
-    valid = np.zeros(shp, dtype=np.bool)
-    for i in range(cube.shape[axis]):
-        view[axis] = i
-        plane = cube.filled_data[view]
-        valid |= np.isfinite(plane)
-        result += np.nan_to_num(plane) * pix_size[view]
-    result[~valid] = np.nan
-    return result
+        # expand (l - M1) ** order with the binomial theorem
+        result = np.zeros(mom1.shape)
+        for k in range(order + 1):
+            coeff = factorial(order) // (factorial(k) * factorial(order - k))
+            result += coeff * (-mom1) ** (order - k) * sums[k]
+        return result / sums[0]
 
 
-def _slice1(cube, axis):
+def moments_slicewise(cube, orders, axis):
     """
-    1st moment along an axis, calculated slicewise
-
-    Parameters
-    ----------
-    cube : SpectralCube
-    axis : int
+    Compute several moments in a single pass over the data, by
+    accumulating the sums of powers of the pixel coordinate 1 slice at a
+    time
 
-    Returns
-    -------
-    moment1 : array
+    For numerical stability, the coordinates along each ray are taken
+    relative to the first valid pixel of that ray.
     """
+    nsums = max(orders) + 1
+
     shp = _moment_shp(cube, axis)
-    result = np.zeros(shp)
+    sums = np.zeros((nsums,) + shp)
+    valid = np.zeros(shp, dtype=np.bool)
+    ref = np.zeros(shp)
 
     view = [slice(None)] * 3
     pix_size = cube._pix_size()[axis]
     pix_cen = cube._pix_cen()[axis]
-    weights = np.zeros(shp)
 
-    for i in range(cube.shape[axis]):
+    for i, plane in enumerate(cube._iter_slices(axis, fill=np.nan)):
         view[axis] = i
-        plane = cube._get_filled_data(fill=0, view=view)
-        result += (plane *
-                   pix_cen[view] *
-                   pix_size[view])
-        weights += plane * pix_size[view]
-    return result / weights
+        cen = broadcast_to(broadcast_view(pix_cen, view, cube.shape), shp)
+        size = broadcast_view(pix_size, view, cube.shape)
+
+        # the sums are still zero where no valid data has been seen
+        # yet, so the reference coordinate can be set freely there
+        first = np.isfinite(plane) & ~valid
+        ref[first] = cen[first]
+        valid |= first
+
+        term = np.nan_to_num(plane) * size
+        offset = cen - ref
+        for k in range(nsums):
+            sums[k] += term
+            if k + 1 < nsums:
+                term = term * offset
+
+    return [_moment_from_sums(sums, order, valid, ref) for order in orders]
 
 
 def moment_slicewise(cube, order, axis):
     """
     Compute moments by accumulating the result 1 slice at a time
     """
-    if order == 0:
-        return _slice0(cube, axis)
-    if order == 1:
-        return _slice1(cube, axis)
+    return moments_slicewise(cube, [order], axis)[0]
 
-    shp = _moment_shp(cube, axis)
-    result = np.zeros(shp)
 
-    view = [slice(None)] * 3
-    pix_size = cube._pix_size()[axis]
-    pix_cen = cube._pix_cen()[axis]
-    weights = np.zeros(shp)
+def moments_raywise(cube, orders, axis):
+    """
+    Compute several moments by accumulating the answer for blocks of
+    complete rays at a time, sized to fit within the memory limit
+    """
+    nsums = max(orders) + 1
 
-    # would be nice to get mom1 and momn in single pass over data
-    # possible for mom2, not sure about general case
-    mom1 = _slice1(cube, axis)
+    shp = _moment_shp(cube, axis)
+    sums = np.empty((nsums,) + shp)
+    valid = np.empty(shp, dtype=np.bool)
+    ref = np.empty(shp)
 
-    for i in range(cube.shape[axis]):
-        view[axis] = i
-        plane = cube._get_filled_data(fill=0, view=view)
-        result += (plane *
-                   (pix_cen[view] - mom1) ** order *
-                   pix_size[view])
-        weights += plane * pix_size[view]
+    pix_cen = cube._pix_cen()[axis]
+    pix_size = cube._pix_size()[axis]
 
-    return (result / weights)
+    # the blocks are filled into the same double precision buffers
+    data = mask = None
+    size = block_size(cube, dtype=np.float64)
+    for xslc, yslc, view in cube._iter_ray_blocks(axis, block_size=size):
+        shape = cube._data[view].shape
+        n = int(np.prod(shape))
+        if data is None or data.size < n:
+            data = np.empty(n)
+            mask = np.empty(n, dtype=np.bool)
+        block = cube._get_filled_data(view=view, fill=np.nan,
+                                      out=data[:n].reshape(shape),
+                                      mask_out=mask[:n].reshape(shape))
+        block *= broadcast_view(pix_size, view, cube.shape)
+
+        out = (xslc, yslc)
+        block_sums, valid[out], ref[out] = _sums_along(
+            block, broadcast_view(pix_cen, view, cube.shape), axis, nsums)
+        for k in range(nsums):
+            sums[k][out] = block_sums[k]
+
+    return [_moment_from_sums(sums, order, valid, ref) for order in orders]
 
 
 def moment_raywise(cube, order, axis):
     """
     Compute moments by accumulating the answer one ray at a time
     """
-    shp = _moment_shp(cube, axis)
-    out = np.zeros(shp) * np.nan
+    return moments_raywise(cube, [order], axis)[0]
 
-    pix_cen = cube._pix_cen()[axis]
-    pix_size = cube._pix_size()[axis]
 
-    for x, y, slc in cube._iter_rays(axis):
-        # the intensity, i.e. the weights
-        include = cube._mask.include(data=cube._data, wcs=cube._wcs,
-                                     view=slc)
-        if not include.any():
-            continue
+def _sums_along(data, pix_cen, axis, nsums):
+    """
+    Compute the sums of ``data * (l - ref) ** k`` along an axis, for k = 0
+    up to ``nsums - 1``
 
-        data = cube.flattened(slc) * pix_size[slc][include]
+    For numerical stability, the coordinates along each ray are taken
+    relative to the first valid pixel of that ray.
 
-        if order == 0:
-            out[x, y] = data.sum()
-            continue
+    Parameters
+    ----------
+    data : array
+        The data multiplied by the pixel size, with NaN where excluded.
+        This array is overwritten.
+    pix_cen : array
+        The pixel coordinates, broadcastable to the shape of ``data``
+    axis : int
+        The axis to sum along
+    nsums : int
+        The number of sums to compute
 
-        order1 = (data * pix_cen[slc][include]).sum() / data.sum()
-        if order == 1:
-            out[x, y] = order1
-            continue
+    Returns
+    -------
+    sums, valid, ref
+        The sums, whether any data along each ray was valid, and the
+        reference coordinates
+    """
+    finite = np.isfinite(data)
+    valid = finite.any(axis=axis)
+
+    index = np.ogrid[tuple(slice(0, n) for n in valid.shape)]
+    index.insert(axis, finite.argmax(axis=axis))
+    ref = broadcast_to(pix_cen, data.shape)[tuple(index)]
+
+    np.copyto(data, 0, where=~finite)
+    del finite
+    sums = [data.sum(axis=axis)]
+    view = [slice(None)] * data.ndim
+    for k in range(1, nsums):
+        # multiply by the offset from the reference one slice at a time,
+        # rather than building the offsets for the whole array
+        for i in range(data.shape[axis]):
+            view[axis] = i
+            data[tuple(view)] *= (broadcast_view(pix_cen, view, data.shape) -
+                                  ref)
+        sums.append(data.sum(axis=axis))
+
+    return sums, valid, ref
+
+
+def moments_cubewise(cube, orders, axis):
+    """
+    Compute several moments by working with the entire data at once
+    """
+    nsums = max(orders) + 1
 
-        ordern = (data * (pix_cen[slc][include] - order1) ** order).sum()
-        ordern /= data.sum()
+    # the coordinates are compact, so the filled data is the only array
+    # with the size of the cube, and the sums are computed in place
+    data = cube._get_filled_data(fill=np.nan, out=np.empty(cube.shape))
+    data *= cube._pix_size()[axis]
+    sums, valid, ref = _sums_along(data, cube._pix_cen()[axis], axis, nsums)
 
-        out[x, y] = ordern
-    return out
+    return [_moment_from_sums(sums, order, valid, ref) for order in orders]
 
 
 def moment_cubewise(cube, order, axis):
     """
     Compute the moments by working with the entire data at once
     """
-
-    pix_cen = cube._pix_cen()[axis]
-    data = cube._get_filled_data() * cube._pix_size()[axis]
-
-    if order == 0:
-        return np.nansum(data, axis=axis)
-
-    if order == 1:
-        return (np.nansum(data * pix_cen, axis=axis) /
-                np.nansum(data, axis=axis))
-    else:
-        mom1 = moment_cubewise(cube, 1, axis)
-
-        # insert an axis so it broadcasts properly
-        shp = list(_moment_shp(cube, axis))
-        shp.insert(axis, 1)
-        mom1 = mom1.reshape(shp)
-
-        return (np.nansum(data * (pix_cen - mom1) ** order, axis=axis) /
-                np.nansum(data, axis=axis))
+    return moments_cubewise(cube, [order], axis)[0]
 
 
 def moment_auto(cube, order, axis):
@@ -185,3 +236,13 @@ def moment_auto(cube, order, axis):
     strategy = dict(cube=moment_cubewise, ray=moment_raywise,
                     slice=moment_slicewise)
     return strategy[iterator_strategy(cube, axis)](cube, order, axis)
+
+
+def moments_auto(cube, orders, axis):
+    """
+    Build several moment maps, choosing a strategy to balance speed and
+    memory.
+    """
+    strategy = dict(cube=moments_cubewise, ray=moments_raywise,
+                    slice=moments_slicewise)
+    return strategy[iterator_strategy(cube, axis)](cube, orders, axis)
@@ -1,6 +1,15 @@
+import mmap
+import warnings
+
 import numpy as np
+from astropy.extern import six
+
 from . import wcs_utils
-import warnings
+
+# the names of the Stokes parameters for each FITS Stokes code
+STOKES_CODES = {1: 'I', 2: 'Q', 3: 'U', 4: 'V',
+                -1: 'RR', -2: 'LL', -3: 'RL', -4: 'LR',
+                -5: 'XX', -6: 'YY', -7: 'XY', -8: 'YX'}
 
 
 def _split_stokes(array, wcs):
@@ -32,22 +41,128 @@ def _split_stokes(array, wcs):
     # Find stokes dimension
     stokes_index = types.index('stokes')
 
-    # TODO: make the stokes names more general
-    stokes_names = ["I", "Q", "U", "V"]
+    stokes_axis = array.ndim - 1 - stokes_index
+    stokes_names = stokes_axis_names(wcs, stokes_axis,
+                                     array.shape[stokes_index])
 
     stokes_arrays = {}
 
-    wcs_slice = wcs_utils.drop_axis(wcs, array.ndim - 1 - stokes_index)
+    wcs_slice = wcs_utils.drop_axis(wcs, stokes_axis)
 
+    # the components are views of the array, so memory-mapped data is not
+    # read
     for i_stokes in range(array.shape[stokes_index]):
 
         array_slice = [i_stokes if idim == stokes_index else slice(None) for idim in range(array.ndim)]
 
-        stokes_arrays[stokes_names[i_stokes]] = array[array_slice]
+        stokes_arrays[stokes_names[i_stokes]] = array[tuple(array_slice)]
 
     return stokes_arrays, wcs_slice
 
 
+def stokes_axis_names(wcs, stokes_axis, nstokes):
+    """
+    Return the names of the Stokes parameters along an axis of a WCS
+
+    The names are given by the Stokes codes of the axis, or are I, Q, U and
+    V if the codes are not valid.
+
+    Parameters
+    ----------
+    wcs : `~astropy.wcs.WCS`
+        The WCS containing the Stokes axis
+    stokes_axis : int
+        The index of the Stokes axis in the WCS
+    nstokes : int
+        The number of Stokes parameters
+    """
+    codes = wcs.sub([stokes_axis + 1]).wcs_pix2world(np.arange(nstokes), 0)[0]
+    codes = [int(np.round(code)) for code in codes]
+    if all(code in STOKES_CODES for code in codes):
+        return [STOKES_CODES[code] for code in codes]
+    else:
+        return ["I", "Q", "U", "V"][:nstokes]
+
+
+def stokes_wcs(wcs, names):
+    """
+    Add a Stokes axis for the given Stokes parameters to a 3-d WCS
+
+    Parameters
+    ----------
+    wcs : `~astropy.wcs.WCS`
+        The WCS of each Stokes parameter
+    names : list
+        The names of the Stokes parameters, in the order of the new axis.
+        Their codes should be evenly spaced.
+    """
+    codes = dict((name, code) for code, name in STOKES_CODES.items())
+    values = [codes[name] for name in names]
+    step = values[1] - values[0] if len(values) > 1 else 1
+    if step == 0 or np.any(np.diff(values) != step):
+        raise ValueError("The Stokes parameters {0} cannot be described by a "
+                         "linear axis".format(names))
+
+    result = wcs_utils.add_stokes_axis_to_wcs(wcs, wcs.wcs.naxis)
+    result.wcs.crval[-1] = values[0]
+    result.wcs.cdelt[-1] = step
+    return result
+
+
+class FunctionArray(object):
+    """
+    A read-only array computed from other arrays of the same shape when it
+    is indexed, so that only the parts that are used are evaluated, one
+    chunk at a time.
+
+    Parameters
+    ----------
+    function : callable
+        The function computing the values of the array from the values of
+        ``arrays``, e.g. ``np.hypot``
+    arrays : list
+        The arrays (or other objects supporting numpy-style slicing) to
+        compute the values from
+    dtype : dtype, optional
+        The type of the result, by default that of the first array
+    """
+
+    def __init__(self, function, arrays, dtype=None):
+        self._function = function
+        self._arrays = arrays
+        self.shape = arrays[0].shape
+        self.dtype = np.dtype(arrays[0].dtype if dtype is None else dtype)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[()], dtype=dtype)
+
+    def transpose(self, axes):
+        if list(axes) == list(range(self.ndim)):
+            return self
+        return FunctionArray(self._function,
+                             [array.transpose(axes) for array in self._arrays],
+                             dtype=self.dtype)
+
+    def __getitem__(self, view):
+        result = self._function(*[array[view] for array in self._arrays])
+        return np.asarray(result, dtype=self.dtype)
+
+
 def _orient(array, wcs):
     """
     Given a 3-d spectral cube and WCS, swap around the axes so that the
@@ -140,12 +255,234 @@ class SliceIndexer(object):
     def __getitem__(self, view):
         return self._func(self._other, view)
 
+    def __call__(self, view=(), **kwargs):
+        return self._func(self._other, view, **kwargs)
+
+
+def broadcast_to(array, shape):
+    """
+    Return a read-only view of an array broadcast to ``shape``, as
+    `numpy.broadcast_to` does (which needs numpy 1.10)
+
+    Parameters
+    ----------
+    array : `~numpy.ndarray`
+        The array to broadcast
+    shape : tuple
+        The shape to broadcast the array to
+
+    Returns
+    -------
+    result : `~numpy.ndarray`
+        A view of ``array`` with shape ``shape``
+    """
+    if hasattr(np, 'broadcast_to'):
+        return np.broadcast_to(array, shape)
+
+    shape = tuple(shape)
+    array = np.asarray(array)
+    # an empty template of the target shape, which takes no memory
+    template = np.lib.stride_tricks.as_strided(np.zeros(1, dtype=bool),
+                                               shape=shape,
+                                               strides=(0,) * len(shape))
+    result = np.broadcast_arrays(array, template)[0]
+    if result.shape != shape:
+        raise ValueError("array of shape {0} cannot be broadcast to shape "
+                         "{1}".format(array.shape, shape))
+    result.flags.writeable = False
+    return result
+
+
+def broadcast_view(array, view, shape):
+    """
+    Slice an array that broadcasts to ``shape`` with a view of an array of
+    that shape, without expanding the repeated dimensions
+
+    Parameters
+    ----------
+    array : `~numpy.ndarray`
+        An array with the same number of dimensions as ``shape``, and a
+        length of one along the dimensions that are repeated (such as the
+        arrays returned by ``SpectralCube._pix_cen``)
+    view : tuple
+        Integers and slices selecting part of an array of shape ``shape``
+    shape : tuple
+        The shape the array broadcasts to
+
+    Returns
+    -------
+    result : `~numpy.ndarray`
+        The sliced array, which broadcasts to the shape of the view of a
+        full array
+    """
+    view = tuple(view) + (slice(None),) * (len(shape) - len(tuple(view)))
+    compact = []
+    for index, length, full in zip(view, array.shape, shape):
+        if length == 1 and full != 1:
+            index = 0 if np.isscalar(index) else slice(None)
+        compact.append(index)
+    return array[tuple(compact)]
+
+
+# The memory budget, in bytes, used to choose how to iterate over cubes.
+# See set_memory_limit.
+_MEMORY_LIMIT = [2 * 1024 ** 3]
+
+# The typical size of a memory page, used to estimate how much of a
+# memory-mapped file is read when accessing non-contiguous data
+_PAGE_SIZE = 4096
+
+
+def to_bytes(size):
+    """
+    Convert a number of bytes, or a string or quantity with units of
+    information (e.g. ``'8GB'`` or ``'512 MiB'``), to a number of bytes
+    """
+    from astropy import units as u
+
+    if isinstance(size, (six.string_types, u.Quantity)):
+        size = u.Quantity(size).to(u.byte).value
+    return int(size)
+
+
+def set_memory_limit(limit):
+    """
+    Set the amount of memory that cube operations should try to stay
+    within.
+
+    This is used to choose how to iterate over cubes when ``how='auto'``,
+    and the size of the chunks of data that are processed at once.
+
+    Parameters
+    ----------
+    limit : int, str or `~astropy.units.Quantity`
+        The limit, either as a number of bytes, or as a string or quantity
+        with units of information, e.g. ``'8GB'`` or ``'512 MiB'``.
+
+    Returns
+    -------
+    previous : int
+        The previous limit, in bytes
+    """
+    limit = to_bytes(limit)
+    if limit <= 0:
+        raise ValueError("The memory limit should be positive")
+
+    previous = _MEMORY_LIMIT[0]
+    _MEMORY_LIMIT[0] = limit
+    return previous
+
+
+def get_memory_limit():
+    """
+    Return the memory limit set by :func:`set_memory_limit`, in bytes
+    """
+    return _MEMORY_LIMIT[0]
+
+
+def is_memmapped(array):
+    """
+    Whether an array views a memory-mapped file
+    """
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+
+def _mask_bytes(mask):
+    """
+    Estimate the number of bytes per element of temporary arrays created
+    when evaluating a mask
+    """
+    from .masks import (BooleanArrayMask, CompositeMask, InvertedMask)
+
+    if mask is None:
+        return 0
+    if isinstance(mask, BooleanArrayMask):
+        # the mask is already in memory, but may be inverted, and packed
+        # masks are unpacked first
+        return 2 if mask.packed else 1
+    if isinstance(mask, CompositeMask):
+        return _mask_bytes(mask._mask1) + _mask_bytes(mask._mask2) + 1
+    if isinstance(mask, InvertedMask):
+        return _mask_bytes(mask._mask) + 1
+    # masks evaluated from the data create the mask and its inverse
+    return 2
+
+
+def element_bytes(cube, dtype=None):
+    """
+    Estimate the memory needed per element of a cube to get its filled
+    data, which includes the filled array (in the floating point type
+    closest to the data type, unless *dtype* is given) and the temporary
+    arrays of the mask
+    """
+    if dtype is None:
+        dtype = np.result_type(cube._data.dtype, np.float32)
+    return np.dtype(dtype).itemsize + _mask_bytes(cube._mask)
+
+
+def _read_amplification(shape, itemsize, axis):
+    """
+    Estimate how many times each page of a memory-mapped C-ordered array is
+    read when iterating over the array one slice at a time along ``axis``
+    """
+    contiguous = itemsize * int(np.prod(shape[axis + 1:]))
+    return min(shape[axis], max(1, _PAGE_SIZE // max(contiguous, 1)))
+
+
+def strategy_costs(cube, axis=None):
+    """
+    Estimate the peak memory and the amount of data read from disk needed
+    to iterate over a cube with each strategy
+
+    Parameters
+    ----------
+    cube : SpectralCube instance
+        The cube to iterate over
+    axis : [0, 1, 2]
+        For reduction methods, the axis that is being collapsed
+
+    Returns
+    -------
+    costs : dict
+        The ``(memory, io)`` estimates for each strategy, in bytes. The
+        I/O is zero for data that is not memory-mapped.
+    """
+    axis = axis or 0
+    shape = cube.shape
+    size = int(np.prod(shape))
+    per_element = element_bytes(cube)
+    itemsize = cube._data.dtype.itemsize
+    nbytes = size * itemsize
+    on_disk = is_memmapped(cube._data)
+
+    # slice reductions also keep a few slice-sized float64 accumulators
+    plane = size // max(shape[axis], 1)
+    slice_memory = plane * (per_element + 3 * 8)
+    slice_io = nbytes * _read_amplification(shape, itemsize, axis)
+
+    # rays are read in blocks of complete rows, but at least one ray at a
+    # time is needed
+    ray_memory = shape[axis] * per_element
+
+    return {'cube': (size * per_element, nbytes if on_disk else 0),
+            'slice': (slice_memory, slice_io if on_disk else 0),
+            'ray': (ray_memory, nbytes if on_disk else 0)}
+
 
 def iterator_strategy(cube, axis=None):
     """
     Guess the most efficient iteration strategy
     for iterating over a cube, given its size and layout
 
+    Among the strategies whose estimated peak memory is within the limit
+    set by :func:`set_memory_limit`, the one reading the least data from
+    disk is chosen, preferring the strategies that work with larger
+    subsets of data. See :func:`strategy_costs`.
+
     Parameters
     ----------
     cube : SpectralCube instance
@@ -162,7 +499,168 @@ def iterator_strategy(cube, axis=None):
         *slice* recommends working with one slice at a time
         *ray*  recommends working with one ray at a time
     """
-    # pretty simple for now
-    if np.product(cube.shape) < 1e8:  # smallish
-        return 'cube'
-    return 'slice'
+    costs = strategy_costs(cube, axis)
+    limit = get_memory_limit()
+    strategies = [strategy for strategy in ('cube', 'slice', 'ray')
+                  if costs[strategy][0] <= limit]
+    if not strategies:
+        return 'ray'
+    return min(strategies, key=lambda strategy: costs[strategy][1])
+
+
+def block_size(cube, n_workers=1, min_blocks=1, dtype=None):
+    """
+    Return the number of elements of a cube that can be processed at once
+    by each worker within the memory limit
+
+    Parameters
+    ----------
+    cube : SpectralCube instance
+        The cube to process
+    n_workers : int
+        The number of blocks processed at the same time
+    min_blocks : int
+        The minimum number of blocks to split the cube into, e.g. to
+        balance the load between workers
+    dtype : dtype, optional
+        The type the data are filled into, if not the floating point type
+        closest to the data type
+    """
+    n_workers = max(n_workers or 1, 1)
+    size = max(int(np.prod(cube.shape)), 1)
+    elements = get_memory_limit() // (element_bytes(cube, dtype=dtype) *
+                                      n_workers)
+    return max(1, min(elements, -(-size // max(min_blocks, 1))))
+
+
+def slab_views(shape, axis, nslabs):
+    """
+    Split an array into contiguous slabs along an axis
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the array to split
+    axis : int
+        The axis to split along
+    nslabs : int
+        The number of slabs to create. Fewer slabs are returned if the
+        array is shorter than ``nslabs`` along ``axis``
+
+    Returns
+    -------
+    views : list of tuples
+        A view into the array for each slab
+    """
+    n = shape[axis]
+    nslabs = max(1, min(nslabs, n))
+    edges = np.linspace(0, n, nslabs + 1).astype(int)
+    views = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        view = [slice(None)] * len(shape)
+        view[axis] = slice(start, stop)
+        views.append(tuple(view))
+    return views
+
+
+def contiguous_views(shape, size):
+    """
+    Split a C-ordered 3-d array into blocks that are each contiguous in
+    memory (or on disk), made of complete planes along the first axis
+    where possible, or else of complete rows of a single plane
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the array to split
+    size : int
+        The approximate maximum number of elements in each block. Blocks
+        always contain at least one complete row.
+
+    Returns
+    -------
+    views : list of tuples
+        A 3-d view into the array for each block
+    """
+    nz, ny, nx = shape
+    plane = ny * nx
+    if size >= plane:
+        step = int(size // max(plane, 1))
+        return [(slice(z, min(z + step, nz)), slice(None), slice(None))
+                for z in range(0, nz, step)]
+
+    step = max(1, int(size // max(nx, 1)))
+    return [(slice(z, z + 1), slice(y, min(y + step, ny)), slice(None))
+            for z in range(nz) for y in range(0, ny, step)]
+
+
+def prefetch(function, items):
+    """
+    Apply a function to each item, computing the next result on a
+    background thread while the current one is being used
+
+    Parameters
+    ----------
+    function : callable
+        The function to apply to each item
+    items : list
+        The arguments to pass to ``function``, one per call
+
+    Yields
+    ------
+    result
+        The result for each item, in the same order as ``items``
+    """
+    if not items:
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(1)
+    try:
+        pending = pool.apply_async(function, (items[0],))
+        for item in items[1:]:
+            result = pending.get()
+            pending = pool.apply_async(function, (item,))
+            yield result
+        yield pending.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def map_parallel(function, tasks, n_workers=None, executor=None):
+    """
+    Apply a function to each task, optionally in parallel
+
+    Parameters
+    ----------
+    function : callable
+        The function to apply to each task
+    tasks : list
+        The arguments to pass to ``function``, one per call
+    n_workers : int, optional
+        The number of threads to use, if ``executor`` is not given
+    executor : object, optional
+        Any object with a ``map(function, iterable)`` method, such as a
+        `concurrent.futures` executor or a `multiprocessing.Pool`.
+        Process-based executors require ``function`` and ``tasks`` to be
+        picklable.
+
+    Returns
+    -------
+    results : list
+        The result for each task, in the same order as ``tasks``
+    """
+    if executor is not None:
+        return list(executor.map(function, tasks))
+
+    if n_workers is None or n_workers <= 1:
+        return [function(task) for task in tasks]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(n_workers)
+    try:
+        return pool.map(function, tasks)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,422 @@
+"""
+A spectral cube backed by a dask array, for chunked, parallel and
+out-of-core computations.
+
+dask is an optional dependency, and is only imported when a
+:class:`DaskSpectralCube` is used.
+"""
+
+import numpy as np
+from astropy import units as u
+
+from .spectral_cube import SpectralCube, _apply_to_rays, np2wcs
+from .masks import LazyMask, BooleanArrayMask, CompositeMask, InvertedMask
+from . import cube_utils
+from . import wcs_utils
+from ._moments import _moment_from_sums
+
+__all__ = ['DaskSpectralCube']
+
+
+def _dask_reductions():
+    """
+    Return the dask equivalents of the numpy reductions used by
+    :class:`~spectral_cube.SpectralCube`
+    """
+    import dask.array as da
+    return {np.nansum: da.nansum,
+            np.nanmax: da.nanmax,
+            np.nanmin: da.nanmin,
+            np.nanargmax: da.nanargmax,
+            np.nanargmin: da.nanargmin,
+            np.nanmean: da.nanmean,
+            np.nanvar: da.nanvar,
+            np.nanstd: da.nanstd}
+
+
+def _array_key(array):
+    """
+    A key identifying the memory viewed by a numpy array, so that
+    different views of the same data are converted to the same dask array
+    """
+    return (array.__array_interface__['data'][0], array.shape,
+            array.strides, array.dtype.str)
+
+
+def _as_dask(array, chunks, arrays):
+    """
+    Convert an array to a dask array, reusing the conversion of arrays that
+    view the same memory, which are recorded in the ``arrays`` dict
+    """
+    import dask.array as da
+
+    if isinstance(array, da.Array):
+        return array
+
+    if not isinstance(array, np.ndarray) and hasattr(array, 'shape'):
+        # array-like objects, such as packed masks, are sliced by dask
+        # chunk by chunk
+        return da.from_array(array, chunks=chunks, name=False)
+
+    array = np.asanyarray(array)
+    key = _array_key(array)
+    if key not in arrays:
+        # a random name avoids hashing the whole array, which would
+        # read memory-mapped data from disk
+        arrays[key] = da.from_array(array, chunks=chunks, name=False)
+    return arrays[key]
+
+
+def _as_dask_mask(mask, chunks, arrays):
+    """
+    Return an equivalent mask whose arrays are dask arrays, so that
+    evaluating it builds a task graph instead of computing the mask.
+    """
+    if isinstance(mask, LazyMask):
+        return LazyMask(mask._function,
+                        data=_as_dask(mask._data, chunks, arrays),
+                        wcs=mask._wcs)
+    elif isinstance(mask, BooleanArrayMask):
+        return BooleanArrayMask(_as_dask(mask._mask, chunks, arrays),
+                                mask._wcs,
+                                include=mask._mask_type == 'include')
+    elif isinstance(mask, CompositeMask):
+        return CompositeMask(_as_dask_mask(mask._mask1, chunks, arrays),
+                             _as_dask_mask(mask._mask2, chunks, arrays),
+                             operation=mask._operation)
+    elif isinstance(mask, InvertedMask):
+        return InvertedMask(_as_dask_mask(mask._mask, chunks, arrays))
+    # FunctionMask (or unknown masks) are evaluated on the data they are
+    # given, which is the dask array of the cube
+    return mask
+
+
+class DaskSpectralCube(SpectralCube):
+    """
+    A :class:`~spectral_cube.SpectralCube` whose data and masks are dask
+    arrays.
+
+    Reductions, moments and masks build lazy task graphs that are
+    evaluated chunk by chunk, in parallel, with a dask scheduler. The
+    ``how`` argument of the methods is therefore ignored.
+
+    Parameters
+    ----------
+    data : array-like
+        The data, which is converted to a dask array if needed
+    wcs : `~astropy.wcs.WCS`
+        The WCS of the data
+    mask : :class:`~spectral_cube.masks.MaskBase`, optional
+        The mask. The arrays of the mask are converted to dask arrays.
+    meta : dict, optional
+        Metadata
+    fill_value : float, optional
+        The value used by :meth:`filled_data` for excluded elements
+    chunks : tuple or str, optional
+        The chunks used to convert numpy arrays to dask arrays. By default,
+        dask chooses chunks of a reasonable size.
+    scheduler : str, optional
+        The dask scheduler used for computations, e.g. ``'threads'``,
+        ``'processes'`` or ``'synchronous'``. Defaults to the dask default,
+        which is the threaded scheduler.
+    """
+
+    def __init__(self, data, wcs, mask=None, meta=None, fill_value=np.nan,
+                 chunks='auto', scheduler=None):
+
+        unit = None
+        if hasattr(data, 'unit'):
+            unit = data.unit
+            data = data.value
+
+        arrays = {}
+        data = _as_dask(data, chunks, arrays)
+
+        super(DaskSpectralCube, self).__init__(data, wcs, mask=mask,
+                                               meta=meta,
+                                               fill_value=fill_value)
+        if self._unit is None:
+            self._unit = unit
+
+        if self._mask is not None:
+            self._mask = _as_dask_mask(self._mask, self._data.chunks, arrays)
+
+        self._scheduler = scheduler
+
+    @classmethod
+    def from_cube(cls, cube, chunks='auto', scheduler=None):
+        """
+        Create a :class:`DaskSpectralCube` from a
+        :class:`~spectral_cube.SpectralCube`, without copying the data.
+
+        Parameters
+        ----------
+        cube : :class:`~spectral_cube.SpectralCube`
+            The cube to convert
+        chunks, scheduler
+            See :class:`DaskSpectralCube`
+        """
+        result = cls(cube._data, cube._wcs, mask=cube._mask,
+                     meta=cube._meta, fill_value=cube.fill_value,
+                     chunks=chunks, scheduler=scheduler)
+        result._unit = cube._unit
+        result._file_handle = cube._file_handle
+        return result
+
+    @classmethod
+    def read(cls, filename, format=None, hdu=None, chunks='auto',
+             scheduler=None, **kwargs):
+        """
+        Read a spectral cube from a file, as a :class:`DaskSpectralCube`.
+
+        See :meth:`SpectralCube.read <spectral_cube.SpectralCube.read>` for
+        the parameters. ``chunks`` and ``scheduler`` are described in
+        :class:`DaskSpectralCube`. Passing ``memmap=True`` for FITS files
+        allows the data to be read from disk chunk by chunk.
+        """
+        cube = SpectralCube.read(filename, format=format, hdu=hdu, **kwargs)
+        return cls.from_cube(cube, chunks=chunks, scheduler=scheduler)
+
+    def _new_cube(self, data, wcs, mask=None, meta=None, fill_value=np.nan):
+        cube = DaskSpectralCube(data, wcs, mask=mask, meta=meta,
+                                fill_value=fill_value,
+                                scheduler=self._scheduler)
+        cube._unit = self._unit
+        return cube
+
+    def _compute(self, *arrays, **kwargs):
+        """
+        Compute dask arrays with the scheduler of the cube, sharing the
+        work common to all of them.
+
+        Parameters
+        ----------
+        arrays : dask arrays
+            The arrays to compute
+        n_workers : int, optional
+            The number of workers used by the scheduler
+        executor : object, optional
+            A pool or executor used by the scheduler
+        """
+        import dask
+
+        options = {}
+        if self._scheduler is not None:
+            options['scheduler'] = self._scheduler
+        if kwargs.get('n_workers') is not None:
+            options['num_workers'] = kwargs['n_workers']
+        if kwargs.get('executor') is not None:
+            options['pool'] = kwargs['executor']
+
+        return dask.compute(*arrays, **options)
+
+    def _get_lazy_include(self, view=()):
+        """
+        Return a dask array of the included elements of a view of the cube,
+        with the chunks of the data. All elements are included if the cube
+        has no mask.
+        """
+        import dask.array as da
+
+        data = self._data[view]
+        if self._mask is None:
+            return da.ones(data.shape, dtype=bool, chunks=data.chunks)
+        return _as_dask(self._mask.include(data=self._data, wcs=self._wcs,
+                                           view=view), data.chunks, {})
+
+    def _get_lazy_filled_data(self, view=(), fill=np.nan):
+        """
+        Return a dask array of the data, with excluded elements replaced by
+        *fill*.
+        """
+        import dask.array as da
+
+        data = self._data[view]
+        if self._mask is None:
+            return data
+
+        include = self._mask.include(data=self._data, wcs=self._wcs,
+                                     view=view)
+        return da.where(include, data, fill)
+
+    def _get_filled_data(self, view=(), fill=np.nan, check_endian=False,
+                         out=None, mask_out=None):
+        result = self._compute(self._get_lazy_filled_data(view=view,
+                                                          fill=fill))[0]
+        if out is not None:
+            np.copyto(out, result, casting='unsafe')
+            return out
+        if check_endian and not result.dtype.isnative:
+            result = result.astype(result.dtype.newbyteorder('='))
+        return result
+
+    _get_filled_data.__doc__ = SpectralCube._get_filled_data.__doc__
+
+    def _apply_numpy_function(self, function, fill=np.nan,
+                              reduce=True, how='auto',
+                              check_endian=False, n_workers=None,
+                              executor=None, **kwargs):
+        """
+        Apply a numpy function to the cube, using its dask equivalent if
+        there is one
+        """
+        reductions = _dask_reductions()
+        if function not in reductions:
+            return function(self._get_filled_data(fill=fill,
+                                                  check_endian=check_endian),
+                            **kwargs)
+
+        data = self._get_lazy_filled_data(fill=fill)
+        return self._compute(reductions[function](data, **kwargs),
+                             n_workers=n_workers, executor=executor)[0]
+
+    def _apply_along_axes(self, function, axis=None, weights=None, wcs=False,
+                          n_workers=None, executor=None, **kwargs):
+        """
+        Apply a function to valid data along the specified axis.
+
+        The cube is rechunked so that each chunk contains complete rays,
+        and the function is applied to the chunks in parallel. See
+        :meth:`SpectralCube._apply_along_axes
+        <spectral_cube.SpectralCube._apply_along_axes>`.
+        """
+        import dask.array as da
+
+        if axis is None:
+            return function(self.flattened(weights=weights).value, **kwargs)
+
+        data = self._data
+        if weights is not None:
+            data = data * _as_dask(weights, data.chunks, {})
+        include = self._get_lazy_include()
+
+        data = data.rechunk({axis: -1})
+        include = include.rechunk(data.chunks)
+
+        out = da.map_blocks(_apply_to_rays, function, data, include, axis,
+                            kwargs, drop_axis=axis, dtype=float)
+        out = self._compute(out, n_workers=n_workers, executor=executor)[0]
+
+        if wcs:
+            newwcs = wcs_utils.drop_axis(self._wcs, np2wcs[axis])
+            return out, newwcs
+
+        return out
+
+    def median(self, axis=None, n_workers=None, executor=None, **kwargs):
+        """
+        Compute the median of an array, optionally along an axis.
+
+        Ignores excluded mask elements.
+
+        Parameters
+        ----------
+        axis : int (optional)
+            The axis to collapse
+        n_workers : int (optional)
+            The number of workers used by the dask scheduler
+        executor : object (optional)
+            A pool or executor used by the dask scheduler
+
+        Returns
+        -------
+        med : ndarray
+            The median
+        """
+        return u.Quantity(self._apply_along_axes(np.nanmedian, axis=axis,
+                                                 n_workers=n_workers,
+                                                 executor=executor,
+                                                 **kwargs), self.unit,
+                          copy=False)
+
+    def flattened(self, slice=(), weights=None):
+        data = self._data[slice]
+        if weights is not None:
+            data = data * _as_dask(weights, self._data.chunks, {})[slice]
+        include = self._get_lazy_include(view=slice)
+
+        # boolean indexing returns the values chunk by chunk, so chunks
+        # must span all but the first axis to preserve the numpy order
+        planes = (data.chunks[0],) + tuple(-1 for _ in data.shape[1:])
+        data = data.rechunk(planes)
+        include = include.rechunk(data.chunks)
+
+        return u.Quantity(self._compute(data[include])[0], self.unit,
+                          copy=False)
+
+    flattened.__doc__ = SpectralCube.flattened.__doc__
+
+    def get_mask_array(self):
+        """
+        Convert the mask to a boolean numpy array
+        """
+        return self._compute(self._get_lazy_include())[0]
+
+    @cube_utils.slice_syntax
+    def unmasked_data(self, view):
+        """
+        Return a view of the subset of the underlying data,
+        ignoring the mask.
+
+        Returns
+        -------
+        data : Quantity instance
+            The unmasked data
+        """
+        return u.Quantity(self._compute(self._data[view])[0], self.unit,
+                          copy=False)
+
+    def _moments(self, orders, axis):
+        """
+        Compute several moments from the intensity-weighted sums of powers
+        of the pixel coordinate, which are computed in a single pass over
+        the chunks of the cube. See :mod:`spectral_cube._moments`.
+        """
+        import dask.array as da
+
+        nsums = max(orders) + 1
+
+        # the coordinate arrays are compact, and broadcast to the chunks
+        cen, size = self._pix_cen()[axis], self._pix_size()[axis]
+
+        data = self._get_lazy_filled_data(fill=np.nan) * size
+        finite = da.isfinite(data)
+        valid = finite.any(axis=axis)
+
+        # for numerical stability, take the coordinates along each ray
+        # relative to the smallest valid coordinate of that ray
+        ref = da.where(finite, cen, np.inf).min(axis=axis)
+        expand = [slice(None)] * 2
+        expand.insert(axis, None)
+        offset = cen - ref[tuple(expand)]
+
+        data = da.where(finite, data, 0)
+        sums = [data.sum(axis=axis)]
+        for k in range(1, nsums):
+            data = data * offset
+            sums.append(data.sum(axis=axis))
+
+        results = self._compute(valid, ref, *sums)
+        valid, ref, sums = results[0], results[1], results[2:]
+        ref = np.where(valid, ref, 0)
+
+        return [_moment_from_sums(sums, order, valid, ref)
+                for order in orders]
+
+    def moment(self, order=0, axis=0, how='auto'):
+        out = self._moments([order], axis)[0]
+        return self._moment_projection(out, order, axis, how)
+
+    moment.__doc__ = SpectralCube.moment.__doc__
+
+    def moments(self, orders=(0, 1, 2), axis=0, how='auto'):
+        orders = list(orders)
+        out = self._moments(orders, axis)
+        return [self._moment_projection(o, order, axis, how)
+                for o, order in zip(out, orders)]
+
+    moments.__doc__ = SpectralCube.moments.__doc__
+
+    def __repr__(self):
+        return "Dask" + super(DaskSpectralCube, self).__repr__()
+
@@ -1,9 +1,14 @@
+import operator
 import warnings
 from astropy.io import fits
 from astropy.extern import six
+from astropy.utils import OrderedDict
+from astropy.utils.exceptions import AstropyDeprecationWarning
 from astropy.wcs import WCS
 import numpy as np
-from spectral_cube import SpectralCube, BooleanArrayMask
+from spectral_cube import (SpectralCube, StokesSpectralCube,
+                           BooleanArrayMask, LazyMask)
+from .. import cube_utils, wcs_utils
 
 # Read and write from a CASA image. This has a few
 # complications. First, by default CASA does not return the
@@ -27,8 +32,6 @@ def wcs_casa2astropy(casa_wcs):
     Convert a casac.coordsys object into an astropy.wcs.WCS object
     """
 
-    from astropy.wcs import WCS
-
     wcs = WCS(naxis=int(casa_wcs.naxes()))
 
     crpix = casa_wcs.referencepixel()
@@ -83,68 +86,292 @@ def wcs_casa2astropy(casa_wcs):
     return wcs
 
 
-def load_casa_image(filename, skipdata=False,
-                    skipvalid=False, skipcs=False, **kwargs):
-    """
-    Load a cube (into memory?) from a CASA image. By default it will transpose
-    the cube into a 'python' order and drop degenerate axes. These options can
-    be suppressed. The object holds the coordsys object from the image in
-    memory.
-    """
+# numpy types of the CASA pixel types
+CASA_DTYPES = {'float': np.float32,
+               'double': np.float64,
+               'complex': np.complex64,
+               'dcomplex': np.complex128}
 
-    try:
-        from taskinit import ia
-    except ImportError:
-        raise ImportError("Could not import CASA (casac) and therefore cannot read CASA .image files")
 
-    # use the ia tool to get the file contents
-    ia.open(filename)
+class _RegionCache(object):
+    """
+    A least-recently-used cache of the regions read from a CASA image,
+    which can be shared by the arrays reading the same image
+
+    Parameters
+    ----------
+    cache_size : int or str
+        The maximum size of the cached regions, in bytes (or a string such
+        as ``'64MB'``)
+    """
 
-    # read in the data
-    if not skipdata:
-        data = ia.getchunk()
+    def __init__(self, cache_size):
+        self._max_bytes = cube_utils.to_bytes(cache_size)
+        self._entries = OrderedDict()
+        self._nbytes = 0
 
-    # CASA stores validity of data as a mask
-    if not skipvalid:
-        valid = ia.getchunk(getmask=True)
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries[key] = chunk = self._entries.pop(key)
+        return chunk
 
-    # transpose is dealt with within the cube object
+    def put(self, key, chunk):
+        if chunk.nbytes > self._max_bytes:
+            return
+        while self._nbytes + chunk.nbytes > self._max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+        self._entries[key] = chunk
+        self._nbytes += chunk.nbytes
 
-    # read in coordinate system object
-    casa_cs = ia.coordsys()
 
-    wcs = wcs_casa2astropy(casa_cs)
+class CASAArrayWrapper(object):
+    """
+    A read-only array view of a CASA image, which only reads the requested
+    region of the image from disk with ``getchunk``.
+
+    The axes are in the opposite order to the CASA axes, as for FITS
+    images read with astropy, and can be transposed without reading the
+    image. The most recently read regions are cached.
+
+    Parameters
+    ----------
+    tool : image tool
+        An open CASA image tool
+    getmask : bool, optional
+        If True, the array is the mask of the image, which is True for
+        valid pixels, rather than its values
+    fixed : dict, optional
+        The index to select along some of the CASA axes, e.g. to select
+        a Stokes parameter. These axes are dropped from the array.
+    cache_size : int or str, optional
+        The maximum size of the cached regions, in bytes (or a string such
+        as ``'64MB'``)
+    cache : `_RegionCache`, optional
+        A cache shared with other arrays reading the same image, used
+        instead of a new cache of ``cache_size`` bytes
+    """
 
-    # don't need this yet
-    # stokes = get_casa_axis(temp_cs, wanttype="Stokes", skipdeg=False,)
+    def __init__(self, tool, getmask=False, fixed=None, cache_size='64MB',
+                 cache=None):
+        self._tool = tool
+        self._getmask = getmask
+        self._fixed = dict(fixed or {})
+
+        casa_shape = [int(n) for n in tool.shape()]
+        # the CASA axis of each axis of the array
+        self._axes = [i for i in range(len(casa_shape))
+                      if i not in self._fixed][::-1]
+        self.shape = tuple(casa_shape[i] for i in self._axes)
+        if getmask:
+            self.dtype = np.dtype(bool)
+        else:
+            self.dtype = np.dtype(CASA_DTYPES[tool.pixeltype()])
+
+        self._casa_shape = casa_shape
+        self._cache = _RegionCache(cache_size) if cache is None else cache
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[()], dtype=dtype)
+
+    def transpose(self, axes):
+        # only the mapping to the CASA axes changes
+        result = object.__new__(CASAArrayWrapper)
+        result.__dict__.update(self.__dict__)
+        result._axes = [self._axes[i] for i in axes]
+        result.shape = tuple(self.shape[i] for i in axes)
+        return result
+
+    def __getitem__(self, view):
+        if isinstance(view, list):
+            view = tuple(view)
+        elif not isinstance(view, tuple):
+            view = (view,)
+
+        if Ellipsis in view:
+            i = view.index(Ellipsis)
+            view = (view[:i] + (slice(None),) * (self.ndim - len(view) + 1) +
+                    view[i + 1:])
+        if len(view) > self.ndim:
+            return self[()][view]
+        view = view + (slice(None),) * (self.ndim - len(view))
+
+        # the region to read, and how to index it once read, along each
+        # CASA axis
+        blc = [0] * len(self._casa_shape)
+        trc = [0] * len(self._casa_shape)
+        inc = [1] * len(self._casa_shape)
+        local = [0] * len(self._casa_shape)
+        for axis, index in self._fixed.items():
+            blc[axis] = trc[axis] = index
+
+        for axis, item in zip(self._axes, view):
+            n = self._casa_shape[axis]
+            if isinstance(item, slice):
+                start, stop, step = item.indices(n)
+                planes = range(start, stop, step)
+                if len(planes) == 0:
+                    shape = [len(range(*v.indices(size)))
+                             for v, size in zip(view, self.shape)
+                             if isinstance(v, slice)]
+                    return np.empty(shape, dtype=self.dtype)
+                blc[axis] = min(planes[0], planes[-1])
+                trc[axis] = max(planes[0], planes[-1])
+                inc[axis] = abs(step)
+                local[axis] = slice(None, None, -1 if step < 0 else 1)
+            else:
+                try:
+                    index = operator.index(item)
+                except TypeError:
+                    # fancy indexing
+                    return self[()][view]
+                if not -n <= index < n:
+                    raise IndexError("index {0} is out of bounds for axis "
+                                     "with size {1}".format(index, n))
+                blc[axis] = trc[axis] = index % n
+
+        # index the region in the CASA order, and put the remaining axes in
+        # the order of the array
+        chunk = self._read(blc, trc, inc)[tuple(local)]
+        remaining = [axis for axis in range(len(local))
+                     if isinstance(local[axis], slice)]
+        order = [axis for axis, item in zip(self._axes, view)
+                 if isinstance(item, slice)]
+        return chunk.transpose([remaining.index(axis) for axis in order])
+
+    def _read(self, blc, trc, inc):
+        """
+        Read a region of the image, in the CASA axis order
+        """
+        key = (self._getmask, tuple(blc), tuple(trc), tuple(inc))
+        chunk = self._cache.get(key)
+        if chunk is not None:
+            return chunk
+
+        chunk = np.asarray(self._tool.getchunk(blc=list(blc), trc=list(trc),
+                                               inc=list(inc),
+                                               getmask=self._getmask),
+                           dtype=self.dtype)
+        chunk.flags.writeable = False
+        self._cache.put(key, chunk)
+
+        return chunk
+
+
+def _image_tool():
+    """
+    Return a new CASA image tool
+    """
+    try:
+        from taskinit import iatool
+    except ImportError:
+        raise ImportError("Could not import CASA (casac) and therefore cannot read CASA .image files")
+    return iatool()
 
-    #    if stokes == None:
-    #        order = np.arange(self.data.ndim)
-    #    else:
-    #        order = []
-    #        for ax in np.arange(self.data.ndim+1):
-    #            if ax == stokes:
-    #                continue
-    #            order.append(ax)
 
-    #    self.casa_cs = ia.coordsys(order)
+def load_casa_image(filename, skipdata=False,
+                    skipvalid=False, skipcs=False, cache_size='64MB',
+                    **kwargs):
+    """
+    Load a cube from a CASA image. By default it will transpose the cube
+    into a 'python' order and drop degenerate Stokes axes. Images with
+    several Stokes parameters are read as a
+    :class:`~spectral_cube.StokesSpectralCube`.
+
+    Only the metadata are read when the image is opened: the data and the
+    mask are read from disk as they are needed, so the image is kept open
+    until the cube's :meth:`~spectral_cube.SpectralCube.close` method is
+    called.
+
+    Parameters
+    ----------
+    filename : str
+        The CASA image to read
+    skipvalid : bool, optional
+        If True, ignore the mask of the image and only exclude non-finite
+        values
+    cache_size : int or str, optional
+        The maximum size of the recently read regions of the data and mask
+        of all Stokes parameters that are kept in memory (see
+        :class:`CASAArrayWrapper`)
+
+    The ``skipdata`` and ``skipcs`` arguments are deprecated and have no
+    effect, since the data are only read when needed.
+    """
 
-        # This should work, but coordsys.reorder() has a bug
-        # on the error checking. JIRA filed. Until then the
-        # axes will be reversed from the original.
+    for name, value in (('skipdata', skipdata), ('skipcs', skipcs)):
+        if value:
+            warnings.warn("{0} is deprecated and has no effect, since the "
+                          "data are only read when needed".format(name),
+                          AstropyDeprecationWarning)
 
-        # if transpose == True:
-        #    new_order = np.arange(self.data.ndim)
-        #    new_order = new_order[-1*np.arange(self.data.ndim)-1]
-        #    print new_order
-        #    self.casa_cs.reorder(new_order)
+    # use a new image tool, which stays open to read the data
+    ia = _image_tool()
+    ia.open(filename)
 
-    # close the ia tool
-    ia.close()
+    try:
+        # read in coordinate system object
+        casa_cs = ia.coordsys()
+        wcs = wcs_casa2astropy(casa_cs)
+
+        # the Stokes parameters are read separately, and degenerate Stokes
+        # axes are dropped
+        ctype = list(wcs.wcs.ctype)
+        if 'STOKES' in ctype:
+            stokes_axis = ctype.index('STOKES')
+            wcs_slice = wcs_utils.drop_axis(wcs, stokes_axis)
+            nstokes = int(ia.shape()[stokes_axis])
+            components = [{stokes_axis: i} for i in range(nstokes)]
+            names = cube_utils.stokes_axis_names(wcs, stokes_axis, nstokes)
+        else:
+            wcs_slice = wcs
+            components = [{}]
+            names = ['I']
+
+        # the data and mask of all the Stokes parameters share one cache
+        cache = _RegionCache(cache_size)
+
+        data, mask = {}, {}
+        for name, fixed in zip(names, components):
+            array = CASAArrayWrapper(ia, fixed=fixed, cache=cache)
+            data[name], component_wcs = cube_utils._orient(array, wcs_slice)
+            if skipvalid:
+                mask[name] = LazyMask(np.isfinite, data=data[name],
+                                      wcs=component_wcs)
+            else:
+                # CASA stores the validity of the data as the mask
+                valid = CASAArrayWrapper(ia, getmask=True, fixed=fixed,
+                                         cache=cache)
+                valid, _ = cube_utils._orient(valid, wcs_slice)
+                mask[name] = BooleanArrayMask(valid, component_wcs)
+    except:
+        ia.close()
+        raise
 
     meta = {'filename': filename}
 
-    mask = BooleanArrayMask(wcs, np.logical_not(valid))
-    cube = SpectralCube(data, wcs, mask, meta=meta)
+    if len(components) == 1:
+        cube = SpectralCube(data[names[0]], component_wcs, mask[names[0]],
+                            meta=meta)
+    else:
+        cube = StokesSpectralCube(data, component_wcs, mask, meta=meta)
+
+    cube._file_handle = ia
 
     return cube
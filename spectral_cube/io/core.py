@@ -35,7 +35,7 @@ def read(input, format=None, hdu=None, **kwargs):
         raise ValueError("Format {0} not implemented. Supported formats are 'fits' and 'casa_image'".format(format))
 
 
-def write(filename, cube, overwrite=False, format=None):
+def write(filename, cube, overwrite=False, format=None, **kwargs):
     """
     Write :class:`SpectralCube` or :class:`StokesSpectralCube` to a file.
 
@@ -49,6 +49,9 @@ def write(filename, cube, overwrite=False, format=None):
         Whether to overwrite the output file
     format : str, optional
         File format.
+    kwargs : dict
+        If the format is 'fits', the kwargs are passed to
+        :func:`~spectral_cube.io.fits.write_fits_cube`.
     """
 
     if format is None:
@@ -56,7 +59,7 @@ def write(filename, cube, overwrite=False, format=None):
 
     if format == 'fits':
         from .fits import write_fits_cube
-        write_fits_cube(filename, cube, overwrite=overwrite)
+        write_fits_cube(filename, cube, overwrite=overwrite, **kwargs)
     else:
         raise ValueError("Format {0} not implemented. The only supported format is 'fits'".format(format))
 
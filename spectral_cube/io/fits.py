@@ -1,10 +1,17 @@
+import io
+import os
+import re
+import operator
 import warnings
 
+import astropy
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.extern import six
 from astropy.utils import OrderedDict
 from astropy.io.fits.hdu.hdulist import fitsopen as fits_open
+from astropy.io.fits.hdu.base import DTYPE2BITPIX, BITPIX2DTYPE
+from astropy.io.fits.column import FITS2NUMPY
 
 import numpy as np
 from .. import SpectralCube, StokesSpectralCube, LazyMask
@@ -25,15 +32,260 @@ def is_fits(input, **kwargs):
     if isinstance(input, six.string_types):
         if input.lower().endswith(('.fits', '.fits.gz',
                                       '.fit', '.fit.gz',
-                                      '.fits.Z', '.fit.Z')):
+                                      '.fits.Z', '.fit.Z',
+                                      '.fits.fz', '.fit.fz')):
             return True
-    elif isinstance(input, (fits.HDUList, fits.PrimaryHDU, fits.ImageHDU)):
+    elif isinstance(input, (fits.HDUList, fits.PrimaryHDU, fits.ImageHDU,
+                            fits.CompImageHDU)):
         return True
     else:
         return False
 
 
-def read_data_fits(input, hdu=None, **kwargs):
+def _version_tuple(version):
+    """
+    Return the major and minor numbers of a version string such as
+    ``'0.4.dev1234'``, as a tuple of integers
+    """
+    return tuple(int(number) for number in re.findall(r'\d+', version)[:2])
+
+
+# The tiles of compressed images can only be read through private astropy
+# attributes (the table of compressed tiles and its heap), and copied to a
+# new table with BinTableHDU.from_columns. These are known to work from
+# astropy 0.4 up to, but not including, astropy 5.3, where the compressed
+# image internals were rewritten.
+ASTROPY_COMPRESSED_TILES = ((0, 4) <= _version_tuple(astropy.__version__) <
+                            (5, 3))
+
+
+def _compressed_tiles(hdu):
+    """
+    Return the header and the data of the table of tiles of a compressed
+    image, and the heap holding the compressed tiles, or None if they
+    cannot be accessed with the installed astropy.
+
+    This is the only place where the private astropy attributes of
+    compressed images are used.
+    """
+    if not ASTROPY_COMPRESSED_TILES:
+        return None
+    try:
+        header = hdu._header
+        table = hdu.compressed_data
+        heap = table._get_heap_data()
+    except AttributeError:
+        return None
+    if 'ZNAXIS' not in header:
+        return None
+    return header, table, heap
+
+
+def _tile_access(hdu):
+    """
+    Return 'table' if the tiles of a compressed image can be read
+    separately with the installed astropy, or None if only the whole image
+    can be decompressed
+    """
+    return None if _compressed_tiles(hdu) is None else 'table'
+
+
+def _compressed_dtype(hdu):
+    """
+    Return the type of the decompressed data of a compressed image from its
+    header, as astropy would scale them
+    """
+    header = hdu.header
+    # the image header gives the original BITPIX, as ZBITPIX does in the
+    # table header. Quantized floating point images (ZQUANTIZ) are restored
+    # to this floating point type.
+    bitpix = header['BITPIX']
+    dtype = np.dtype(BITPIX2DTYPE[bitpix])
+    if bitpix < 0:
+        return dtype
+
+    scale = header.get('BSCALE', 1)
+    zero = header.get('BZERO', 0)
+    if scale == 1 and zero == 0:
+        return dtype
+    if (scale == 1 and bitpix > 8 and zero == 2 ** (bitpix - 1) and
+            getattr(hdu, '_uint', True)):
+        return np.dtype('u{0}'.format(bitpix // 8))
+    return np.dtype('float64' if bitpix > 16 else 'float32')
+
+
+class CompressedImageArray(object):
+    """
+    A read-only array view of a tile-compressed image, which only
+    decompresses the tiles needed for the requested data.
+
+    The tiles are selected along the first (slowest varying) axis, so that
+    e.g. a spectral slab of a cube only decompresses the tiles that it
+    overlaps. Other kinds of indexing decompress the whole image. The tiles
+    are read through private astropy attributes, so with astropy versions
+    where these are not known to work (see ``ASTROPY_COMPRESSED_TILES``),
+    the whole image is decompressed by `CompImageHDU.data` when first
+    accessed.
+
+    Parameters
+    ----------
+    hdu : `~astropy.io.fits.CompImageHDU`
+        The compressed image. Its file should be kept open while the array
+        is in use.
+    """
+
+    def __init__(self, hdu):
+        self._hdu = hdu
+        self._access = _tile_access(hdu)
+        self.shape = tuple(hdu.shape)
+        self.dtype = _compressed_dtype(hdu)
+        self._tile_depth = 1
+        self._layer_rows = 1
+        self._cache = None
+
+        if self._access == 'table':
+            header = _compressed_tiles(hdu)[0]
+            naxis = header['ZNAXIS']
+            # the number of planes in each tile along the first axis, and
+            # the number of tiles (rows of the table) in each of these
+            # layers
+            self._tile_depth = header.get('ZTILE{0}'.format(naxis), 1)
+            self._layer_rows = int(np.prod([
+                -(-header['ZNAXIS{0}'.format(i)] //
+                  header['ZTILE{0}'.format(i)])
+                for i in range(1, naxis)]))
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[()], dtype=dtype)
+
+    def transpose(self, axes):
+        if list(axes) == list(range(self.ndim)):
+            return self
+        return self[()].transpose(axes)
+
+    def __getitem__(self, view):
+        if isinstance(view, list):
+            view = tuple(view)
+        elif not isinstance(view, tuple):
+            view = (view,)
+
+        if self._access is None:
+            return self._hdu.data[view]
+
+        n = self.shape[0]
+        first = view[0] if view else slice(None)
+
+        if isinstance(first, slice):
+            start, stop, step = first.indices(n)
+            planes = range(start, stop, step)
+            if len(planes) == 0:
+                return self._decompress(0, 1)[view]
+            if step < 0:
+                return self._decompress(0, -(-n // self._tile_depth))[view]
+            lo, hi = planes[0], planes[-1] + 1
+        elif first is Ellipsis or first is None:
+            return self._decompress(0, -(-n // self._tile_depth))[view]
+        else:
+            try:
+                lo = operator.index(first)
+            except TypeError:
+                return self._decompress(0, -(-n // self._tile_depth))[view]
+            if not -n <= lo < n:
+                raise IndexError("index {0} is out of bounds for axis 0 with "
+                                 "size {1}".format(lo, n))
+            lo %= n
+            hi = lo + 1
+
+        start_layer = lo // self._tile_depth
+        offset = start_layer * self._tile_depth
+        data = self._decompress(start_layer, -(-hi // self._tile_depth))
+
+        if isinstance(first, slice):
+            first = slice(lo - offset, planes[-1] + 1 - offset, step)
+        else:
+            first = lo - offset
+        return data[(first,) + view[1:]]
+
+    def _decompress(self, start, stop):
+        """
+        Decompress the layers of tiles from ``start`` to ``stop`` along the
+        first axis
+
+        The rows of the table for these tiles are copied to a new
+        compressed image, which is decompressed by astropy. The most
+        recently decompressed layers are kept.
+        """
+        if self._cache is not None and self._cache[:2] == (start, stop):
+            return self._cache[2]
+
+        tiles = _compressed_tiles(self._hdu)
+        if tiles is None:
+            # decompress the whole image instead
+            data = self._hdu.data[start * self._tile_depth:
+                                  stop * self._tile_depth]
+            self._cache = (start, stop, data)
+            return data
+
+        header, table, heap = tiles
+        raw = np.ndarray.view(table, np.ndarray)
+        first, last = start * self._layer_rows, stop * self._layer_rows
+
+        columns = []
+        for column in table.columns:
+            values = raw[column.name][first:last]
+            match = re.match(r'1?([PQ])([A-Z])', column.format)
+            if match:
+                # copy the variable length arrays from the heap
+                dtype = np.dtype('>' + FITS2NUMPY[match.group(2)])
+                values = [np.frombuffer(heap, dtype=dtype, count=count,
+                                        offset=offset)
+                          for count, offset in values]
+                columns.append(fits.Column(name=column.name,
+                                           format=''.join(match.groups()),
+                                           array=values))
+            else:
+                columns.append(fits.Column(name=column.name,
+                                           format=column.format,
+                                           array=values))
+
+        header = header.copy()
+        naxis = header['ZNAXIS']
+        header['ZNAXIS{0}'.format(naxis)] = (min(stop * self._tile_depth,
+                                                 self.shape[0]) -
+                                             start * self._tile_depth)
+        if 'ZDITHER0' in header:
+            # the dithering of each tile depends on its row in the table
+            header['ZDITHER0'] = (header['ZDITHER0'] - 1 + first) % 10000 + 1
+
+        # the table is only recognized as a compressed image once written
+        del header['ZIMAGE']
+        subset = fits.BinTableHDU.from_columns(columns, header=header)
+        subset.header['ZIMAGE'] = True
+        buffer = io.BytesIO()
+        fits.HDUList([fits.PrimaryHDU(), subset]).writeto(buffer)
+        buffer.seek(0)
+        data = fits.open(buffer)[1].data
+
+        self._cache = (start, stop, data)
+        return data
+
+
+def read_data_fits(input, hdu=None, decompress=True, **kwargs):
     """
     Read an array and header from an FITS file.
 
@@ -44,17 +296,24 @@ def read_data_fits(input, hdu=None, **kwargs):
         following `astropy.io.fits` HDU objects can be used as input:
         - :class:`~astropy.io.fits.hdu.table.PrimaryHDU`
         - :class:`~astropy.io.fits.hdu.table.ImageHDU`
+        - :class:`~astropy.io.fits.hdu.compressed.CompImageHDU`
         - :class:`~astropy.io.fits.hdu.hdulist.HDUList`
     hdu : int or str, optional
         The HDU to read the table from.
+    decompress : bool, optional
+        If False, tile-compressed images are returned as a
+        :class:`CompressedImageArray`, which only decompresses the tiles
+        that are accessed. The file should then be kept open.
     """
 
     if isinstance(input, fits.HDUList):
 
-        # Parse all array objects
+        # Parse all array objects, skipping e.g. empty primary HDUs
         arrays = OrderedDict()
         for ihdu, hdu_item in enumerate(input):
-            if isinstance(hdu_item, (fits.PrimaryHDU, fits.ImageHDU)):
+            if (isinstance(hdu_item, (fits.PrimaryHDU, fits.ImageHDU,
+                                      fits.CompImageHDU)) and
+                    hdu_item.header.get('NAXIS', 0) > 0):
                 arrays[ihdu] = hdu_item
 
         if len(arrays) > 1:
@@ -78,7 +337,8 @@ def read_data_fits(input, hdu=None, **kwargs):
         else:
             raise ValueError("No table found")
 
-    elif isinstance(input, (fits.PrimaryHDU, fits.ImageHDU)):
+    elif isinstance(input, (fits.PrimaryHDU, fits.ImageHDU,
+                            fits.CompImageHDU)):
 
         array_hdu = input
 
@@ -91,10 +351,13 @@ def read_data_fits(input, hdu=None, **kwargs):
         finally:
             hdulist.close()
 
+    if isinstance(array_hdu, fits.CompImageHDU) and not decompress:
+        return CompressedImageArray(array_hdu), array_hdu.header
+
     return array_hdu.data, array_hdu.header
 
 
-def load_fits_cube(input, hdu=0):
+def load_fits_cube(input, hdu=0, memmap=None, **kwargs):
     """
     Read in a cube from a FITS file using astropy.
 
@@ -104,9 +367,32 @@ def load_fits_cube(input, hdu=0):
         The FITS cube file name or HDU
     hdu: int
         The extension number containing the data to be read
+    memmap: bool, optional
+        If True and ``input`` is a file name, the data are memory-mapped
+        read-only, so that only the parts of the cube that are accessed are
+        read from disk. The file is then kept open until the cube's
+        :meth:`~spectral_cube.SpectralCube.close` method is called. Note
+        that data with BSCALE/BZERO scaling cannot be memory-mapped. If
+        not specified, the astropy default is used. Tile-compressed images
+        are then only decompressed for the tiles that are accessed, e.g.
+        the channels of a spectral slab.
+    kwargs: dict
+        Passed to :func:`~astropy.io.fits.open` if ``input`` is a file name
     """
 
-    data, header = read_data_fits(input, hdu=hdu)
+    handle = None
+    if memmap and isinstance(input, six.string_types):
+        handle = fits_open(input, memmap=True, mode='denywrite', **kwargs)
+        try:
+            data, header = read_data_fits(handle, hdu=hdu, decompress=False)
+        except:
+            handle.close()
+            raise
+    else:
+        if memmap is not None:
+            kwargs['memmap'] = memmap
+        data, header = read_data_fits(input, hdu=hdu, **kwargs)
+
     meta = {}
 
     if 'BUNIT' in header:
@@ -116,6 +402,7 @@ def load_fits_cube(input, hdu=0):
 
     if wcs.wcs.naxis == 3:
 
+        # _orient only transposes, so memory-mapped data stay on disk
         data, wcs = cube_utils._orient(data, wcs)
 
         mask = LazyMask(np.isfinite, data=data, wcs=wcs)
@@ -125,9 +412,12 @@ def load_fits_cube(input, hdu=0):
 
         data, wcs = cube_utils._split_stokes(data, wcs)
 
+        # the components share one WCS, and their masks are only evaluated
+        # for the parts of the data that are used
         mask = {}
         for component in data:
             data[component], wcs_slice = cube_utils._orient(data[component], wcs)
+        for component in data:
             mask[component] = LazyMask(np.isfinite, data=data[component], wcs=wcs_slice)
 
         cube = StokesSpectralCube(data, wcs_slice, mask, meta=meta)
@@ -136,16 +426,165 @@ def load_fits_cube(input, hdu=0):
 
         raise Exception("Data should be 3- or 4-dimensional")
 
+    cube._file_handle = handle
+
     return cube
 
 
-def write_fits_cube(filename, cube, overwrite=False):
+def write_fits_cube(filename, cube, overwrite=False, apply_mask=True,
+                    blank=None, chunksize=None, compression_type=None,
+                    tile_shape=None, quantize_level=None,
+                    quantize_method=None, hcomp_scale=None):
     """
     Write a FITS cube with a WCS to a filename
+
+    The header is written first, followed by the data, one chunk at a
+    time, so that the whole cube never needs to be in memory. Compressed
+    cubes are written in one go, since astropy compresses whole images.
+
+    Parameters
+    ----------
+    filename : str
+        The path to write the file to
+    cube : SpectralCube
+        The cube to write
+    overwrite : bool
+        If True, overwrite `filename` if it exists
+    apply_mask : bool
+        If True, the excluded values are replaced by the cube's fill value,
+        and the data are written as floating point values. If False, the
+        data are written unchanged.
+    blank : int, optional
+        For integer data, write the excluded values as ``blank`` and record
+        it in the ``BLANK`` keyword, keeping the type of the data
+    chunksize : int, optional
+        The approximate maximum number of elements written at once.
+        Defaults to the largest size within the memory limit (see
+        :func:`~spectral_cube.cube_utils.set_memory_limit`).
+    compression_type : str, optional
+        If given, the cube is written as a tile-compressed image in the
+        first extension, using this algorithm: ``'RICE_1'``, ``'GZIP_1'``,
+        ``'GZIP_2'``, ``'HCOMPRESS_1'`` or ``'PLIO_1'``
+    tile_shape : tuple, optional
+        The shape of the compressed tiles, in the same order as the cube
+        shape. By default each tile is a row of the cube.
+    quantize_level : float, optional
+        For floating point data, the level of noise to quantize the values
+        to (see :class:`~astropy.io.fits.CompImageHDU`). Negative values
+        give the absolute quantization step, and 0 compresses losslessly
+        with GZIP.
+    quantize_method : int, optional
+        For floating point data, the dithering used by the quantization:
+        -1 for none, 1 for subtractive dithering and 2 for subtractive
+        dithering that keeps zeros
+    hcomp_scale : float, optional
+        The scale factor of ``'HCOMPRESS_1'`` compression. Values larger
+        than 0 give lossy compression.
     """
 
-    if isinstance(cube, SpectralCube):
-        outhdu = fits.PrimaryHDU(data=cube._data, header=cube._wcs.to_header())
-        outhdu.writeto(filename, clobber=overwrite)
-    else:
+    if not isinstance(cube, SpectralCube):
         raise NotImplementedError()
+
+    # the Stokes parameters are written along a fourth axis, one after the
+    # other
+    if isinstance(cube, StokesSpectralCube):
+        components = [cube.component(name) for name in cube.components]
+        shape = (len(components),) + cube.shape
+        wcs = cube_utils.stokes_wcs(cube._wcs, cube.components)
+    else:
+        components = [cube]
+        shape = cube.shape
+        wcs = cube._wcs
+
+    dtype = cube._data.dtype
+    if blank is not None:
+        if dtype.kind not in 'iu':
+            raise TypeError("blank= can only be used with integer data")
+    elif apply_mask and any(c._mask is not None for c in components):
+        dtype = np.result_type(dtype, np.float32)
+    dtype = dtype.newbyteorder('>')
+
+    if os.path.exists(filename):
+        if overwrite:
+            os.remove(filename)
+        else:
+            raise IOError("File {0} already exists.".format(filename))
+
+    chunks = _filled_chunks(components, dtype, apply_mask=apply_mask,
+                            blank=blank, chunksize=chunksize,
+                            stacked=len(shape) > cube.ndim)
+
+    if compression_type is not None:
+        data = np.empty(shape, dtype=dtype)
+        for view, chunk in chunks:
+            data[view] = chunk
+
+        options = dict(quantize_level=quantize_level,
+                       quantize_method=quantize_method,
+                       hcomp_scale=hcomp_scale)
+        options = dict((key, value) for key, value in options.items()
+                       if value is not None)
+        if tile_shape is not None:
+            options['tile_size'] = list(tile_shape)[::-1]
+
+        image = fits.ImageHDU(data, header=wcs.to_header())
+        if blank is not None:
+            image.header['BLANK'] = blank
+        hdu = fits.CompImageHDU(data, header=image.header,
+                                compression_type=compression_type, **options)
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename)
+        return
+
+    # FITS has no unsigned integers wider than a byte: they are stored as
+    # signed integers offset by BZERO, as astropy does for uint data
+    zero = 0
+    if dtype.kind == 'u' and dtype.itemsize > 1:
+        zero = 2 ** (8 * dtype.itemsize - 1)
+        sign_bit = dtype.type(zero)
+        signed = np.dtype('i{0}'.format(dtype.itemsize))
+        chunks = ((view, (chunk ^ sign_bit).view(signed))
+                  for view, chunk in chunks)
+        dtype = signed
+
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = DTYPE2BITPIX[dtype.name]
+    header['NAXIS'] = len(shape)
+    for i, n in enumerate(shape[::-1]):
+        header['NAXIS{0}'.format(i + 1)] = n
+    if zero:
+        header['BSCALE'] = 1
+        header['BZERO'] = zero
+    header.extend(wcs.to_header())
+    if blank is not None:
+        # BLANK is compared with the stored values
+        header['BLANK'] = blank - zero
+
+    stream = fits.StreamingHDU(filename, header)
+    try:
+        for view, chunk in chunks:
+            stream.write(chunk)
+    except:
+        stream.close()
+        os.remove(filename)
+        raise
+    stream.close()
+
+
+def _filled_chunks(cubes, dtype, apply_mask=True, blank=None, chunksize=None,
+                   stacked=False):
+    """
+    Iterate over contiguous chunks of a list of cubes, converted to *dtype*,
+    with the excluded values replaced by *blank* or the fill value of the
+    cube if *apply_mask* is True. If *stacked* is True, the views are
+    prefixed with the index of the cube.
+    """
+    for i, cube in enumerate(cubes):
+        prefix = (i,) if stacked else ()
+        fill = cube._fill_value if blank is None else blank
+        for view, data, mask in cube.chunked(chunksize=chunksize):
+            data = data.value
+            if apply_mask:
+                data = data.astype(dtype, copy=False)
+                np.copyto(data, fill, where=~mask, casting='unsafe')
+            yield prefix + tuple(view), np.asarray(data, dtype=dtype)
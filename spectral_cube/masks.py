@@ -1,7 +1,10 @@
 import abc
+import threading
+from collections import OrderedDict
 
 import numpy as np
 from . import wcs_utils
+from . import cube_utils
 
 __all__ = ['InvertedMask', 'CompositeMask', 'BooleanArrayMask',
            'LazyMask', 'FunctionMask']
@@ -27,16 +30,20 @@ class MaskBase(object):
 
     __metaclass__ = abc.ABCMeta
 
-    def include(self, data=None, wcs=None, view=()):
+    def include(self, data=None, wcs=None, view=(), out=None):
         """
         Return a boolean array indicating which values should be included.
 
         If ``view`` is passed, only the sliced mask will be returned, which
         avoids having to load the whole mask in memory. Otherwise, the whole
-        mask is returned in-memory.
+        mask is returned in-memory. If ``out`` is passed, the mask is
+        written to this boolean array, which is returned.
         """
         self._validate_wcs(data, wcs)
-        return self._include(data=data, wcs=wcs, view=view)
+        if out is None:
+            return self._include(data=data, wcs=wcs, view=view)
+        return _write(self._evaluate(data=data, wcs=wcs, view=view,
+                                     out=out)[0], out)
 
     def _validate_wcs(self, data, wcs):
         """
@@ -50,16 +57,36 @@ class MaskBase(object):
     def _include(self, data=None, wcs=None, view=()):
         pass
 
-    def exclude(self, data=None, wcs=None, view=()):
+    def _evaluate(self, data=None, wcs=None, view=(), out=None):
+        """
+        Return the included elements as a ``(mask, owned)`` tuple, where
+        ``owned`` is True if the mask is a new array allocated by the mask
+        classes, which can be modified in place. Arrays stored by a mask,
+        cached or returned by a user function are never owned.
+
+        If ``out`` is given, the mask is written directly to this boolean
+        array, which is returned and owned.
+        """
+        result = self._include(data=data, wcs=wcs, view=view)
+        if out is None:
+            return result, False
+        return _write(result, out), True
+
+    def exclude(self, data=None, wcs=None, view=(), out=None):
         """
         Return a boolean array indicating which values should be excluded.
 
         If ``view`` is passed, only the sliced mask will be returned, which
         avoids having to load the whole mask in memory. Otherwise, the whole
-        mask is returned in-memory.
+        mask is returned in-memory. If ``out`` is passed, the mask is
+        written to this boolean array, which is returned.
         """
         self._validate_wcs(data, wcs)
-        return self._exclude(data=data, wcs=wcs, view=view)
+        if out is None:
+            return self._exclude(data=data, wcs=wcs, view=view)
+        result = _write(self._evaluate(data=data, wcs=wcs, view=view,
+                                       out=out)[0], out)
+        return np.logical_not(result, out=result)
 
     def _exclude(self, data=None, wcs=None, view=()):
         return ~self._include(data=data, wcs=wcs, view=view)
@@ -86,7 +113,8 @@ class MaskBase(object):
         """
         return data[view][self.include(data=data, wcs=wcs, view=view)]
 
-    def _filled(self, data, wcs=None, fill=np.nan, view=()):
+    def _filled(self, data, wcs=None, fill=np.nan, view=(), out=None,
+                mask_out=None):
         """
         Replace the exluded elements of *array* with *fill*.
 
@@ -98,6 +126,14 @@ class MaskBase(object):
             Replacement value
         view : tuple, optional
             Any slicing to apply to the data before flattening
+        out : `~numpy.ndarray`, optional
+            Array in which to place the output, which should have the shape
+            of the view. By default, a new array is allocated with the
+            floating point type closest to the type of *data*, so that
+            single precision data stay single precision.
+        mask_out : `~numpy.ndarray`, optional
+            Boolean array in which to place the excluded elements, which
+            should also have the shape of the view.
 
         Returns
         -------
@@ -109,10 +145,17 @@ class MaskBase(object):
         This is an internal method used by :class:`SpectralCube`.
         Users should use the property :meth:`MaskBase.filled_data`
         """
-        sliced_data = data[view].copy().astype(np.float)
-        ex = self.exclude(data=data, wcs=wcs, view=view)
-        sliced_data[ex] = fill
-        return sliced_data
+        sliced_data = np.asanyarray(data[view])
+        if out is None:
+            dtype = np.result_type(sliced_data.dtype, np.float32)
+            out = np.empty(sliced_data.shape, dtype=dtype.newbyteorder('='))
+        # copying also converts the data to native byte order, and the
+        # excluded elements are then overwritten in place
+        np.copyto(out, sliced_data, casting='unsafe')
+        ex = self.exclude(data=data, wcs=wcs, view=view, out=mask_out)
+        np.copyto(out, fill, where=np.asanyarray(ex, dtype=bool),
+                  casting='unsafe')
+        return out
 
     def __and__(self, other):
         return CompositeMask(self, other, operation='and')
@@ -123,20 +166,29 @@ class MaskBase(object):
     def __invert__(self):
         return InvertedMask(self)
 
-    def __getitem__(self):
+    def __getitem__(self, view):
         raise NotImplementedError("Slicing not supported by mask class {0}".format(self.__class__.__name__))
 
+    def _sliced(self, view, wcs=None):
+        """
+        Slice the mask. If given, ``wcs`` is used as the WCS of the sliced
+        mask rather than slicing the WCS of the mask again, e.g. when
+        slicing a cube and its mask.
+        """
+        return self[view]
+
     def _get_new_wcs(self, unit, velocity_convention=None, rest_value=None):
         """
         Returns a new WCS with a different Spectral Axis unit
         """
         from .spectral_axis import convert_spectral_axis,determine_ctype_from_vconv
 
-        out_ctype = determine_ctype_from_vconv(self._wcs.wcs.ctype[self._wcs.wcs.spec],
+        wcs = wcs_utils.as_wcs(self._wcs)
+        out_ctype = determine_ctype_from_vconv(wcs.wcs.ctype[wcs.wcs.spec],
                                                unit,
                                                velocity_convention=velocity_convention)
 
-        newwcs = convert_spectral_axis(self._wcs, unit, out_ctype,
+        newwcs = convert_spectral_axis(wcs, unit, out_ctype,
                                        rest_value=rest_value)
 
         return newwcs
@@ -144,16 +196,40 @@ class MaskBase(object):
     _get_new_wcs.__doc__ += with_spectral_unit_docs
 
 
+def _write(mask, out):
+    """
+    Copy a boolean mask to ``out``, if given
+    """
+    if out is None:
+        return mask
+    np.copyto(out, mask)
+    return out
+
+
 class InvertedMask(MaskBase):
 
     def __init__(self, mask):
         self._mask = mask
 
+    def _validate_wcs(self, new_data, new_wcs):
+        self._mask._validate_wcs(new_data, new_wcs)
+
     def _include(self, data=None, wcs=None, view=()):
-        return ~self._mask.include(data=data, wcs=wcs, view=view)
+        return self._evaluate(data=data, wcs=wcs, view=view)[0]
+
+    def _evaluate(self, data=None, wcs=None, view=(), out=None):
+        result, owned = self._mask._evaluate(data=data, wcs=wcs, view=view,
+                                             out=out)
+        if owned:
+            return np.logical_not(result, out=result), True
+        result = ~result
+        return result, _is_bool_array(result)
 
     def __getitem__(self, view):
-        return InvertedMask(self._mask[view])
+        return self._sliced(view)
+
+    def _sliced(self, view, wcs=None):
+        return InvertedMask(self._mask._sliced(view, wcs=wcs))
     
     def with_spectral_unit(self, unit, velocity_convention=None, rest_value=None):
         """
@@ -167,11 +243,45 @@ class InvertedMask(MaskBase):
     with_spectral_unit.__doc__ += with_spectral_unit_docs
 
 
+def _is_bool_array(array):
+    """
+    Whether a mask is a boolean numpy array, rather than e.g. a dask array
+    """
+    return isinstance(array, np.ndarray) and array.dtype == bool
+
+
+# In-place combination of the result of a composite mask with the
+# (possibly inverted) result of a child, using a & ~b == a > b and
+# a | ~b == a >= b for booleans to avoid inverting the child result
+_COMBINE = {('and', False): np.logical_and,
+            ('and', True): np.greater,
+            ('or', False): np.logical_or,
+            ('or', True): np.greater_equal}
+
+
+def _evaluation_cost(mask):
+    """
+    A rough ordering of the cost of evaluating masks, used to evaluate cheap
+    masks first in composite masks
+    """
+    if isinstance(mask, BooleanArrayMask):
+        return 0
+    if isinstance(mask, LazyMask):
+        return 1
+    return 2
+
+
 class CompositeMask(MaskBase):
     """
     A combination of several masks.  The included masks are treated with the specified
     operation.
 
+    Nested combinations are evaluated as a single operation: consecutive
+    'and' (or 'or') nodes are flattened, inversions are pushed to the
+    children, and the children are combined in place into one array. The
+    remaining children are skipped once the result is all False (for 'and')
+    or all True (for 'or').
+
     Parameters
     ----------
     mask1, mask2 : Masks
@@ -189,18 +299,82 @@ class CompositeMask(MaskBase):
         self._mask1._validate_wcs(new_data, new_wcs)
         self._mask2._validate_wcs(new_data, new_wcs)
 
-    def _include(self, data=None, wcs=None, view=()):
-        result_mask_1 = self._mask1._include(data=data, wcs=wcs, view=view)
-        result_mask_2 = self._mask2._include(data=data, wcs=wcs, view=view)
-        if self._operation == 'and':
-            return result_mask_1 & result_mask_2
-        elif self._operation == 'or':
-            return result_mask_1 | result_mask_2
-        else:
+    def _flatten(self, operation=None, invert=False):
+        """
+        Return the (mask, inverted) leaves of the tree of masks combined
+        with ``operation``, applying De Morgan's laws to inverted nodes
+        """
+        if self._operation not in ('and', 'or'):
             raise ValueError("Operation '{0}' not supported".format(self._operation))
 
+        leaves = []
+        for mask in (self._mask1, self._mask2):
+            inverted = invert
+            while isinstance(mask, InvertedMask):
+                mask, inverted = mask._mask, not inverted
+            if isinstance(mask, CompositeMask):
+                # ~(a & b) == ~a | ~b, and ~(a | b) == ~a & ~b
+                effective = mask._operation
+                if inverted and effective in ('and', 'or'):
+                    effective = 'or' if effective == 'and' else 'and'
+                if effective == operation:
+                    leaves.extend(mask._flatten(operation, inverted))
+                    continue
+            leaves.append((mask, inverted))
+        return leaves
+
+    def _include(self, data=None, wcs=None, view=()):
+        return self._evaluate(data=data, wcs=wcs, view=view)[0]
+
+    def _evaluate(self, data=None, wcs=None, view=(), out=None):
+        operation = self._operation
+        leaves = sorted(self._flatten(operation),
+                        key=lambda leaf: _evaluation_cost(leaf[0]))
+
+        result = None
+        for mask, inverted in leaves:
+            if isinstance(result, np.ndarray):
+                # the remaining masks cannot change the result
+                if operation == 'and' and not result.any():
+                    break
+                if operation == 'or' and result.all():
+                    break
+
+            if result is None:
+                # the first mask is written directly to the output array,
+                # and the other masks are combined with it in place
+                include, owned = mask._evaluate(data=data, wcs=wcs,
+                                                view=view, out=out)
+                if owned:
+                    result = include
+                    if inverted:
+                        np.logical_not(result, out=result)
+                elif isinstance(include, np.ndarray):
+                    # the result is modified in place, so it cannot be an
+                    # array of a child mask or of a user function
+                    result = (np.logical_not(include) if inverted
+                              else include.astype(bool))
+                else:
+                    result = ~include if inverted else include
+                continue
+
+            include, _ = mask._evaluate(data=data, wcs=wcs, view=view)
+            if isinstance(result, np.ndarray) and isinstance(include, np.ndarray):
+                _COMBINE[operation, inverted](result, include, out=result)
+            else:
+                # e.g. dask arrays, which cannot be modified in place
+                include = ~include if inverted else include
+                result = result & include if operation == 'and' else result | include
+
+        return result, _is_bool_array(result)
+
     def __getitem__(self, view):
-        return CompositeMask(self._mask1[view], self._mask2[view], operation=self._operation)
+        return self._sliced(view)
+
+    def _sliced(self, view, wcs=None):
+        return CompositeMask(self._mask1._sliced(view, wcs=wcs),
+                             self._mask2._sliced(view, wcs=wcs),
+                             operation=self._operation)
 
     def with_spectral_unit(self, unit, velocity_convention=None, rest_value=None):
         """
@@ -218,40 +392,258 @@ class CompositeMask(MaskBase):
     with_spectral_unit.__doc__ += with_spectral_unit_docs
 
 
+def _view_tuple(view):
+    """
+    Return a view as a tuple of per-axis items, or None if it is an index
+    array. Lists are considered to be tuples if they contain slices, as
+    they are used for views in several places.
+    """
+    if isinstance(view, tuple):
+        return view
+    if isinstance(view, list):
+        if any(isinstance(item, slice) for item in view):
+            return tuple(view)
+        return None
+    if isinstance(view, np.ndarray):
+        return None
+    return (view,)
+
+
+class _PackedBooleanArray(object):
+    """
+    A boolean array stored with one bit per element, packed along the last
+    axis with `numpy.packbits`.
+
+    Indexing unpacks only the requested part of the array, and the logical
+    operators work directly on the packed bytes.
+
+    Parameters
+    ----------
+    words : `~numpy.ndarray`
+        The packed array, of type uint8
+    shape : tuple
+        The shape of the unpacked array
+    """
+
+    dtype = np.dtype(bool)
+
+    def __init__(self, words, shape):
+        self._words = words
+        self.shape = tuple(shape)
+
+    @classmethod
+    def pack(cls, mask):
+        """
+        Pack a boolean array
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if mask.ndim == 0:
+            raise ValueError("Cannot pack a scalar")
+        return cls(np.packbits(mask, axis=-1), mask.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self._words.nbytes
+
+    def __array__(self, dtype=None):
+        mask = self[()]
+        return mask if dtype is None else mask.astype(dtype)
+
+    def _normalize(self, view):
+        """
+        Return the view as a tuple with one slice or integer per axis, or
+        None for views that need advanced indexing
+        """
+        view = _view_tuple(view)
+        if view is None or len(view) > self.ndim:
+            return None
+        view = view + (slice(None),) * (self.ndim - len(view))
+        for item in view:
+            if not isinstance(item, (slice, int, np.integer)):
+                return None
+        return view
+
+    def __getitem__(self, view):
+        normalized = self._normalize(view)
+        if normalized is None:
+            return self[()][view]
+
+        words = self._words[normalized[:-1] + (slice(None),)]
+        last = normalized[-1]
+        size = self.shape[-1]
+
+        if isinstance(last, slice):
+            start, stop, step = last.indices(size)
+            if step < 0:
+                last = np.arange(start, stop, step)
+            else:
+                # only unpack the bytes covering the requested range
+                lo = start // 8
+                hi = max(lo, (stop - 1) // 8 + 1)
+                bits = np.unpackbits(words[..., lo:hi], axis=-1)
+                return bits[..., start - 8 * lo:stop - 8 * lo:step].astype(bool)
+        elif not -size <= last < size:
+            raise IndexError("index {0} is out of bounds for axis with "
+                             "size {1}".format(last, size))
+        else:
+            last = last % size
+
+        bits = words[..., last // 8] >> (7 - last % 8)
+        return (bits & 1).astype(bool)
+
+    def sliced(self, view):
+        """
+        Return the packed array of a view, without unpacking the full
+        array
+        """
+        normalized = self._normalize(view)
+        if normalized is not None and isinstance(normalized[-1], slice):
+            start, stop, step = normalized[-1].indices(self.shape[-1])
+            if step == 1 and start % 8 == 0 and stop == self.shape[-1]:
+                # the bytes can be sliced directly
+                words = self._words[normalized[:-1] +
+                                    (slice(start // 8, None),)]
+                shape = words.shape[:-1] + (stop - start,)
+                return _PackedBooleanArray(words, shape)
+        return _PackedBooleanArray.pack(self[view])
+
+    def __invert__(self):
+        # the padding bits of the last byte are never unpacked, so they can
+        # be inverted too
+        return _PackedBooleanArray(~self._words, self.shape)
+
+    def _combine(self, other, operation):
+        if isinstance(other, _PackedBooleanArray) and other.shape == self.shape:
+            return _PackedBooleanArray(operation(self._words, other._words),
+                                       self.shape)
+        return operation(self[()], np.asarray(other))
+
+    def __and__(self, other):
+        return self._combine(other, np.bitwise_and)
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or)
+
+
 class BooleanArrayMask(MaskBase):
 
     """
     A mask defined as an array on a spectral cube WCS
+
+    Parameters
+    ----------
+    mask : `~numpy.ndarray`
+        The boolean array
+    wcs : `~astropy.wcs.WCS`
+        The WCS of the array
+    include : bool, optional
+        Whether True values of ``mask`` indicate included (the default) or
+        excluded elements
+    packed : bool, optional
+        If True, the mask is stored with one bit per element, which uses 8
+        times less memory. Only the parts of the mask that are used are
+        unpacked, and masks combined with ``&``, ``|`` and ``~`` remain
+        packed.
     """
 
-    def __init__(self, mask, wcs, include=True):
+    def __init__(self, mask, wcs, include=True, packed=False):
+        if packed and not isinstance(mask, _PackedBooleanArray):
+            mask = _PackedBooleanArray.pack(mask)
         self._mask = mask
         self._mask_type = 'include' if include else 'exclude'
         self._wcs = wcs
         self._wcs_whitelist = set()
 
+    @property
+    def packed(self):
+        """
+        Whether the mask is stored with one bit per element
+        """
+        return isinstance(self._mask, _PackedBooleanArray)
+
     def _validate_wcs(self, new_data, new_wcs):
         if new_data.shape != self._mask.shape:
             raise ValueError("data shape does not match mask shape")
-        if new_wcs not in self._wcs_whitelist:
+        fingerprint = wcs_utils.wcs_fingerprint(new_wcs)
+        if fingerprint not in self._wcs_whitelist:
             if not wcs_utils.check_equality(new_wcs, self._wcs):
                 raise ValueError("WCS does not match mask WCS")
-        self._wcs_whitelist.add(new_wcs)
+        self._wcs_whitelist.add(fingerprint)
 
     def _include(self, data=None, wcs=None, view=()):
         result_mask = self._mask[view]
         return result_mask if self._mask_type == 'include' else ~result_mask
 
+    def _evaluate(self, data=None, wcs=None, view=(), out=None):
+        if out is not None:
+            if self._mask_type == 'include':
+                np.copyto(out, self._mask[view])
+            else:
+                np.logical_not(self._mask[view], out=out)
+            return out, True
+        # packed masks are unpacked to a new array
+        result = self._include(data=data, wcs=wcs, view=view)
+        return result, ((self.packed or self._mask_type == 'exclude') and
+                        _is_bool_array(result))
+
     def _exclude(self, data=None, wcs=None, view=()):
         result_mask = self._mask[view]
         return result_mask if self._mask_type == 'exclude' else ~result_mask
 
     @property
     def shape(self):
-        return self._include_mask.shape
+        return self._mask.shape
 
     def __getitem__(self, view):
-        return BooleanArrayMask(self._mask[view], wcs_utils.slice_wcs(self._wcs, view))
+        return self._sliced(view)
+
+    def _sliced(self, view, wcs=None):
+        if self.packed:
+            mask = self._mask.sliced(view)
+        else:
+            mask = self._mask[view]
+        if wcs is None:
+            wcs = wcs_utils.slice_wcs(self._wcs, view, lazy=True)
+        return BooleanArrayMask(mask, wcs,
+                                include=self._mask_type == 'include')
+
+    def _combine_packed(self, other, operation):
+        """
+        Combine two packed masks defined on the same grid into a new packed
+        mask, or return None if this is not possible
+        """
+        if not (isinstance(other, BooleanArrayMask) and self.packed and
+                other.packed and self.shape == other.shape and
+                wcs_utils.check_equality(self._wcs, other._wcs)):
+            return None
+        words = [m._mask if m._mask_type == 'include' else ~m._mask
+                 for m in (self, other)]
+        return BooleanArrayMask(operation(*words), self._wcs)
+
+    def __and__(self, other):
+        combined = self._combine_packed(other, lambda a, b: a & b)
+        if combined is None:
+            return super(BooleanArrayMask, self).__and__(other)
+        return combined
+
+    def __or__(self, other):
+        combined = self._combine_packed(other, lambda a, b: a | b)
+        if combined is None:
+            return super(BooleanArrayMask, self).__or__(other)
+        return combined
+
+    def __invert__(self):
+        # swapping the meaning of the array avoids inverting it
+        return BooleanArrayMask(self._mask, self._wcs,
+                                include=self._mask_type != 'include')
 
     def with_spectral_unit(self, unit, velocity_convention=None, rest_value=None):
         """
@@ -265,6 +657,216 @@ class BooleanArrayMask(MaskBase):
 
     with_spectral_unit.__doc__ += with_spectral_unit_docs
 
+def _view_key(view, shape):
+    """
+    Normalize a view of an array with the given shape to a hashable key,
+    so that equivalent views (e.g. ``()`` and ``[:, :, :]``) share a key.
+
+    Returns None for views that cannot be normalized, e.g. views using
+    fancy indexing.
+    """
+    view = _view_tuple(view)
+    if view is None or len(view) > len(shape):
+        return None
+
+    key = []
+    for item, size in zip(tuple(view) + (slice(None),) * len(shape), shape):
+        if isinstance(item, slice):
+            key.append(item.indices(size))
+        elif isinstance(item, (int, np.integer)):
+            if not -size <= item < size:
+                return None
+            key.append(int(item) % size)
+        else:
+            return None
+    return tuple(key)
+
+
+def _compose_view(key, view):
+    """
+    Return the view of a full array that selects ``view`` of the part of the
+    array given by ``key`` (as returned by `_view_key`), or None if the
+    views cannot be composed.
+    """
+    shape = tuple(len(range(*item)) for item in key
+                  if isinstance(item, tuple))
+    subkey = _view_key(view, shape)
+    if subkey is None:
+        return None
+    subkey = iter(subkey)
+
+    composed = []
+    for item in key:
+        if not isinstance(item, tuple):
+            composed.append(item)
+            continue
+        start, _, step = item
+        sub = next(subkey)
+        if isinstance(sub, tuple) and len(range(*sub)) == 0:
+            composed.append(slice(0, 0))
+        elif isinstance(sub, tuple):
+            substart, substop, substep = sub
+            stop = start + substop * step
+            # a negative stop means that the slice runs to the start
+            composed.append(slice(start + substart * step,
+                                  stop if stop >= 0 else None,
+                                  step * substep))
+        else:
+            composed.append(start + sub * step)
+    return tuple(composed)
+
+
+class _MaskCache(object):
+    """
+    A least-recently-used cache of evaluated boolean masks, keyed by view.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the full mask
+    max_bytes : int
+        The maximum size of the cached arrays. The least recently used
+        entries are discarded to stay within this budget.
+    packed : bool
+        Whether to store the masks as bits rather than bytes, which uses 8
+        times less memory at the cost of unpacking the masks when used.
+    """
+
+    def __init__(self, shape, max_bytes, packed=False):
+        self._shape = shape
+        self._max_bytes = max_bytes
+        self._packed = packed
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        # slices of a mask share its cache, and may be evaluated by
+        # several threads at once
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        """
+        The size of the cached arrays, in bytes
+        """
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def get(self, view):
+        """
+        Return the cached mask for a view, or None. The mask of the full
+        array is used for any view if it is cached.
+        """
+        key = _view_key(view, self._shape)
+        if key is None:
+            return None
+        view = _view_tuple(view)
+        with self._lock:
+            for candidate, subview in ((key, ()),
+                                       (_view_key((), self._shape), view)):
+                if candidate in self._entries:
+                    entry = self._entries.pop(candidate)
+                    self._entries[candidate] = entry
+                    break
+            else:
+                return None
+        return entry[subview]
+
+    def put(self, view, mask):
+        """
+        Cache the mask of a view, if it fits within the budget
+        """
+        key = _view_key(view, self._shape)
+        if key is None or key in self._entries:
+            return
+        mask = np.asarray(mask, dtype=bool)
+        if self._packed and mask.ndim > 0:
+            entry = _PackedBooleanArray.pack(mask)
+        else:
+            entry = mask.copy()
+            entry.flags.writeable = False
+        if entry.nbytes > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            while self._nbytes + entry.nbytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+            self._entries[key] = entry
+            self._nbytes += entry.nbytes
+
+    def sliced(self, view):
+        """
+        Return a cache for a slice of the array, which shares the entries
+        and the budget of this cache, or None if the view cannot be
+        normalized
+        """
+        key = _view_key(view, self._shape)
+        if key is None:
+            return None
+        return _SlicedMaskCache(self, key)
+
+
+class _SlicedMaskCache(object):
+    """
+    The cache of a slice of an array, whose masks are stored in the
+    `_MaskCache` of the full array, keyed by their view of the full array,
+    so that the total size of the cached masks stays within the budget of
+    the full array however many slices are made.
+
+    Parameters
+    ----------
+    cache : `_MaskCache`
+        The cache of the full array
+    key : tuple
+        The slice of the full array, as returned by `_view_key`
+    """
+
+    def __init__(self, cache, key):
+        self._parent = cache
+        self._key = key
+
+    @property
+    def _max_bytes(self):
+        return self._parent._max_bytes
+
+    @property
+    def _packed(self):
+        return self._parent._packed
+
+    @property
+    def nbytes(self):
+        """
+        The size of the cached arrays of the full array, in bytes
+        """
+        return self._parent.nbytes
+
+    def __len__(self):
+        return len(self._parent)
+
+    def clear(self):
+        self._parent.clear()
+
+    def get(self, view):
+        view = _compose_view(self._key, view)
+        return None if view is None else self._parent.get(view)
+
+    def put(self, view, mask):
+        view = _compose_view(self._key, view)
+        if view is not None:
+            self._parent.put(view, mask)
+
+    def sliced(self, view):
+        view = _compose_view(self._key, view)
+        return None if view is None else self._parent.sliced(view)
+
+
 class LazyMask(MaskBase):
 
     """
@@ -287,9 +889,17 @@ class LazyMask(MaskBase):
     wcs : `~astropy.wcs.WCS`
         The WCS of the input data, which is used to define the coordinates
         for which the boolean mask is defined.
+    cache_size : int or str, optional
+        If given, the evaluated masks are cached, keyed by view, up to this
+        number of bytes (or a string such as ``'1GB'``), discarding the
+        least recently used masks first. By default, the mask is evaluated
+        every time it is used. See :meth:`set_cache`.
+    packed : bool, optional
+        If True, cached masks are stored with one bit per element.
     """
 
-    def __init__(self, function, cube=None, data=None, wcs=None):
+    def __init__(self, function, cube=None, data=None, wcs=None,
+                 cache_size=None, packed=False):
         self._function = function
         if cube is not None and (data is not None or wcs is not None):
             raise ValueError("Pass only cube or (data & wcs)")
@@ -303,21 +913,73 @@ class LazyMask(MaskBase):
             raise ValueError("Either a cube or (data & wcs) is required.")
 
         self._wcs_whitelist = set()
+        self.set_cache(cache_size, packed=packed)
+
+    def set_cache(self, cache_size, packed=False):
+        """
+        Enable, resize or disable the cache of evaluated masks.
+
+        Repeated operations on a cube, such as reductions and moments,
+        then reuse the evaluated mask instead of calling the function on
+        the data again. The cache is emptied by this method.
+
+        Parameters
+        ----------
+        cache_size : int or str
+            The maximum size of the cache in bytes, or as a string such as
+            ``'1GB'``. If None, caching is disabled.
+        packed : bool, optional
+            If True, cached masks are stored with one bit per element,
+            which uses 8 times less memory but requires unpacking the
+            masks when they are used.
+        """
+        if cache_size is None:
+            self._cache = None
+        else:
+            self._cache = _MaskCache(self._data.shape,
+                                     cube_utils.to_bytes(cache_size),
+                                     packed=packed)
+
+    def clear_cache(self):
+        """
+        Discard the cached masks, if any. Slices of a mask share its cache,
+        so this also discards the masks cached by the mask it was sliced
+        from and by its other slices.
+        """
+        if self._cache is not None:
+            self._cache.clear()
 
     def _validate_wcs(self, new_data, new_wcs):
         if new_data.shape != self._data.shape:
             raise ValueError("data shape does not match mask shape")
-        if new_wcs not in self._wcs_whitelist:
+        fingerprint = wcs_utils.wcs_fingerprint(new_wcs)
+        if fingerprint not in self._wcs_whitelist:
             if not wcs_utils.check_equality(new_wcs, self._wcs):
                 raise ValueError("WCS does not match mask WCS")
-        self._wcs_whitelist.add(new_wcs)
+        self._wcs_whitelist.add(fingerprint)
 
     def _include(self, data=None, wcs=None, view=()):
         self._validate_wcs(data, wcs)
-        return self._function(self._data[view])
+        if self._cache is None:
+            return self._function(self._data[view])
+
+        result = self._cache.get(view)
+        if result is None:
+            result = self._function(self._data[view])
+            self._cache.put(view, result)
+        return result
 
     def __getitem__(self, view):
-        return LazyMask(self._function, data=self._data[view], wcs=wcs_utils.slice_wcs(self._wcs, view))
+        return self._sliced(view)
+
+    def _sliced(self, view, wcs=None):
+        if wcs is None:
+            wcs = wcs_utils.slice_wcs(self._wcs, view, lazy=True)
+        newmask = LazyMask(self._function, data=self._data[view], wcs=wcs)
+        # the slice shares the cache, and its budget, with this mask
+        if self._cache is not None:
+            newmask._cache = self._cache.sliced(view)
+        return newmask
 
     def with_spectral_unit(self, unit, velocity_convention=None, rest_value=None):
         """
@@ -326,6 +988,8 @@ class LazyMask(MaskBase):
         newwcs = self._get_new_wcs(unit, velocity_convention, rest_value)
 
         newmask = LazyMask(self._function, data=self._data, wcs=newwcs)
+        # the mask is evaluated on the same data, so the cache can be shared
+        newmask._cache = self._cache
         return newmask
 
     with_spectral_unit.__doc__ += with_spectral_unit_docs
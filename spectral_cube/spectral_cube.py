@@ -2,8 +2,12 @@
 A class to represent a 3-d position-position-velocity spectral cube.
 """
 
+import weakref
 import warnings
+import threading
+import multiprocessing
 from functools import wraps
+from collections import OrderedDict
 
 from astropy import units as u
 from astropy.extern import six
@@ -13,6 +17,7 @@ import numpy as np
 
 from . import cube_utils
 from . import wcs_utils
+from ._accumulators import ACCUMULATORS
 from .masks import LazyMask, BooleanArrayMask
 from .io.core import determine_format
 
@@ -24,20 +29,126 @@ except NameError:
     xrange = range
 
 
+class _ResultCache(object):
+    """
+    Cache of the results of method calls, for each instance.
+
+    The instances are only referenced weakly, so that their results are
+    discarded when they are garbage collected, and the least recently used
+    results are discarded when the total size of the cached arrays exceeds
+    a quarter of the memory limit (see
+    :func:`~spectral_cube.cube_utils.set_memory_limit`).
+    """
+
+    def __init__(self):
+        self._results = OrderedDict()
+        # the weak reference to each instance, and the keys of its results
+        self._instances = {}
+        self._lock = threading.RLock()
+        self.nbytes = 0
+
+    @property
+    def max_bytes(self):
+        return cube_utils.get_memory_limit() // 4
+
+    def get(self, instance, key):
+        """
+        Return a cached result, raising a KeyError if there is none
+        """
+        key = (id(instance), key)
+        with self._lock:
+            result, nbytes = self._results.pop(key)
+            self._results[key] = (result, nbytes)
+        return result
+
+    def put(self, instance, key, result):
+        """
+        Cache a result, discarding the least recently used results if
+        needed. Results larger than the budget are not cached.
+        """
+        nbytes = _nbytes(result)
+        if nbytes > self.max_bytes:
+            return
+        ident = id(instance)
+        with self._lock:
+            if (ident in self._instances and
+                    self._instances[ident][0]() is not instance):
+                self.clear(ident)
+            if ident not in self._instances:
+                ref = weakref.ref(instance, lambda ref: self.clear(ident))
+                self._instances[ident] = (ref, set())
+            self._discard((ident, key))
+            self._results[(ident, key)] = (result, nbytes)
+            self._instances[ident][1].add(key)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._discard(next(iter(self._results)))
+
+    def clear(self, ident=None):
+        """
+        Discard the results of the instance with the given id, or all
+        results
+        """
+        with self._lock:
+            if ident is None:
+                self._results.clear()
+                self._instances.clear()
+                self.nbytes = 0
+            elif ident in self._instances:
+                for key in list(self._instances[ident][1]):
+                    self._discard((ident, key))
+
+    def _discard(self, key):
+        if key not in self._results:
+            return
+        _, nbytes = self._results.pop(key)
+        self.nbytes -= nbytes
+        ident, key = key
+        keys = self._instances[ident][1]
+        keys.discard(key)
+        if not keys:
+            del self._instances[ident]
+
+
+def _nbytes(result):
+    """
+    The number of bytes used by a result, which can be an array or a tuple
+    of arrays
+    """
+    if isinstance(result, (tuple, list)):
+        return sum(_nbytes(item) for item in result)
+    return getattr(result, 'nbytes', 0)
+
+
+_RESULT_CACHE = _ResultCache()
+
+
 def cached(func):
     """
-    Decorator to cache function calls
+    Decorator to cache method calls on each instance, see `_ResultCache`
     """
-    cache = {}
 
     @wraps(func)
-    def wrapper(*args):
-        if args not in cache:
-            cache[args] = func(*args)
-        return cache[args]
+    def wrapper(self, *args):
+        key = (func.__name__,) + args
+        try:
+            return _RESULT_CACHE.get(self, key)
+        except KeyError:
+            result = func(self, *args)
+            _RESULT_CACHE.put(self, key, result)
+            return result
 
     return wrapper
 
+
+def clear_cache():
+    """
+    Discard the cached results of all cubes, such as their pixel
+    coordinates. Use :meth:`SpectralCube.clear_cache` to only discard those
+    of one cube.
+    """
+    _RESULT_CACHE.clear()
+
 _NP_DOC = """
 Ignores excluded mask elements.
 
@@ -51,6 +162,17 @@ how : cube | slice | ray | auto
    on data size and layout. Cube/slice/ray iterate over
    decreasing subsets of the data, to conserve memory.
    Default='auto'
+n_workers : int (optional)
+   If larger than one, split the cube into slabs and reduce them
+   in parallel using this many threads. ``how`` is then ignored.
+executor : object (optional)
+   An executor with a ``map`` method (e.g. from `concurrent.futures`
+   or a `multiprocessing.Pool`) used to reduce the slabs in parallel,
+   instead of creating a thread pool. Only the data and mask of each
+   slab are sent to the workers, but process-based executors require
+   the mask to be picklable (e.g. a LazyMask cannot use a lambda
+   function), and copy each slab to the workers. Reductions that
+   cannot be split into slabs are computed serially, with a warning.
 """.replace('\n', '\n         ')
 
 
@@ -67,6 +189,91 @@ def aggregation_docstring(func):
 np2wcs = {2: 0, 1: 1, 0: 2}
 
 
+def _reduce_slab(task):
+    """
+    Reduce one slab of a cube, as part of a parallel reduction.
+
+    This is a module-level function so that it can be sent to process
+    pools. For full reductions, the partial result is the accumulator
+    fed with each plane of the slab, so that slabs can be merged.
+    """
+    slab, start, function, fill, check_endian, axis, kwargs = task
+    data = slab._get_filled_data(fill=fill, check_endian=check_endian)
+    if axis is not None:
+        return function(data, axis=axis, **kwargs)
+
+    accumulator = ACCUMULATORS[function](**kwargs)
+    for index, plane in enumerate(data, start=start):
+        accumulator.update(plane, index)
+    return accumulator
+
+
+# NaN-aware equivalents of functions that can be applied to many rays at
+# once, by ignoring the masked values (which are set to NaN)
+_NAN_FUNCTIONS = {np.mean: np.nanmean,
+                  np.std: np.nanstd,
+                  np.var: np.nanvar,
+                  np.sum: np.nansum,
+                  np.max: np.nanmax,
+                  np.min: np.nanmin}
+# np.nanmedian and np.nanpercentile need numpy 1.9: with earlier versions,
+# medians and percentiles are computed one ray at a time
+if hasattr(np, 'nanmedian'):
+    _NAN_FUNCTIONS.update({np.median: np.nanmedian,
+                           np.percentile: np.nanpercentile})
+_NAN_FUNCTIONS.update((f, f) for f in list(_NAN_FUNCTIONS.values()))
+
+
+def _apply_along_rays(task):
+    """
+    Apply a function to each ray in a block of a cube, as part of
+    :meth:`SpectralCube._apply_along_axes`.
+
+    The data and mask of the whole block are read at once, and passed to
+    :func:`_apply_to_rays`.
+    """
+    block, function, axis, weights, kwargs = task
+
+    data = block._data[()]
+    if block._mask is None:
+        include = np.ones(data.shape, dtype=bool)
+    else:
+        include = block._mask.include(data=block._data, wcs=block._wcs)
+    if weights is not None:
+        data = data * weights
+
+    return _apply_to_rays(function, data, include, axis, kwargs)
+
+
+def _apply_to_rays(function, data, include, axis, kwargs):
+    """
+    Apply a function to the included values of each ray of a 3-d array.
+
+    Functions with a NaN-aware equivalent are applied to all rays in a
+    single call, and other functions are called on each ray in turn. Rays
+    without any included values are set to NaN.
+    """
+    empty = ~include.any(axis=axis)
+
+    if function in _NAN_FUNCTIONS:
+        data = np.where(include, data, np.nan)
+        with warnings.catch_warnings():
+            # all-NaN rays are expected, and dealt with below
+            warnings.simplefilter('ignore', RuntimeWarning)
+            out = _NAN_FUNCTIONS[function](data, axis=axis, **kwargs)
+        out = np.asarray(out, dtype=float)
+        out[empty] = np.nan
+        return out
+
+    data = np.rollaxis(data, axis, 3)
+    include = np.rollaxis(include, axis, 3)
+
+    out = np.empty(empty.shape) * np.nan
+    for x, y in zip(*np.nonzero(~empty)):
+        out[x, y] = function(data[x, y][include[x, y]], **kwargs)
+    return out
+
+
 class Projection(u.Quantity):
 
     def __new__(cls, value, unit=None, dtype=None, copy=True, wcs=None, meta=None):
@@ -120,6 +327,34 @@ class Projection(u.Quantity):
                              "format at this time is 'fits'")
 
 
+def _pixel_range(lo, hi, n):
+    """
+    Convert a range along an axis of length ``n`` to a slice. The limits
+    are either 'min' or 'max', integers (with ``hi`` excluded) or pixel
+    coordinates converted from world coordinates (with ``hi`` included).
+    """
+    if isinstance(lo, float) and isinstance(hi, float) and lo > hi:
+        lo, hi = hi, lo
+    limits = []
+    for value, inclusive in ((lo, False), (hi, True)):
+        if value is None:
+            value = n if inclusive else 0
+        elif isinstance(value, six.string_types):
+            if value not in ('min', 'max'):
+                raise ValueError("Invalid range limit: {0}".format(value))
+            value = n if value == 'max' else 0
+        elif isinstance(value, float):
+            value = int(np.floor(value + 0.5)) + int(inclusive)
+            value = min(max(value, 0), n)
+        elif isinstance(value, (np.integer,) + six.integer_types):
+            value = int(value)
+        else:
+            raise TypeError("Invalid range limit: {0}".format(value))
+        limits.append(value)
+    start, stop, _ = slice(*limits).indices(n)
+    return slice(start, max(start, stop))
+
+
 class SpectralCube(object):
 
     def __init__(self, data, wcs, mask=None, meta=None, fill_value=np.nan):
@@ -143,6 +378,43 @@ class SpectralCube(object):
         #assert mask._wcs == self._wcs
         self._fill_value = fill_value
 
+        # an open file backing memory-mapped data, if any; see close()
+        self._file_handle = None
+
+    def close(self):
+        """
+        Close the file the cube was read from, if it is still open.
+
+        Memory-mapped data remains accessible after the file is closed, for
+        as long as the cube (or any array derived from it) exists.
+        """
+        if self._file_handle is not None:
+            self._file_handle.close()
+            self._file_handle = None
+
+    def clear_cache(self):
+        """
+        Discard the cached results of this cube, such as its pixel
+        coordinates. Use :func:`~spectral_cube.clear_cache` to
+        discard those of all cubes.
+        """
+        _RESULT_CACHE.clear(id(self))
+
+    def _new_cube(self, data, wcs, mask=None, meta=None, fill_value=np.nan):
+        """
+        Create a cube derived from this one, e.g. a view or a cube with a
+        different mask. Subclasses override this to return instances of
+        their own class.
+        """
+        return SpectralCube(data, wcs, mask=mask, meta=meta,
+                            fill_value=fill_value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     @property
     def unit(self):
         """ The flux unit """
@@ -179,21 +451,33 @@ class SpectralCube(object):
 
     def _apply_numpy_function(self, function, fill=np.nan,
                               reduce=True, how='auto',
-                              check_endian=False, **kwargs):
+                              check_endian=False, n_workers=None,
+                              executor=None, **kwargs):
         """
         Apply a numpy function to the cube
         """
 
         # reduce indicates whether this is a reduce-like operation,
         # that can be accumulated one slice at a time.
-        # sum/max/min are like this. argmax/argmin are not
+        # sum/max/min/argmax/argmin are like this. median is not
+
+        if executor is not None or (n_workers or 1) > 1:
+            try:
+                return self._reduce_parallel(function, fill, check_endian,
+                                             n_workers, executor, **kwargs)
+            except NotImplementedError as exc:
+                warnings.warn("{0}, computing it serially".format(exc))
 
         if how == 'auto':
             strategy = cube_utils.iterator_strategy(self, kwargs.get('axis', None))
         else:
             strategy = how
 
-        if strategy == 'slice' and reduce:
+        if strategy == 'ray' and isinstance(kwargs.get('axis'), int):
+            return self._reduce_raywise(function, fill, check_endian,
+                                        **kwargs)
+
+        if strategy in ('slice', 'ray') and reduce:
             try:
                 return self._reduce_slicewise(function, fill,
                                               check_endian,
@@ -211,6 +495,9 @@ class SpectralCube(object):
     def _reduce_slicewise(self, function, fill, check_endian, **kwargs):
         """
         Compute a numpy aggregation by grabbing one slice at a time
+
+        The slices are fed to a streaming accumulator, so only a few
+        slice-sized arrays are held in memory at any time.
         """
 
         ax = kwargs.pop('axis', None)
@@ -221,15 +508,83 @@ class SpectralCube(object):
             raise NotImplementedError("Multi-axis reductions are not "
                                       "supported with how='slice'")
 
+        if function not in ACCUMULATORS:
+            raise NotImplementedError("{0} cannot be computed with "
+                                      "how='slice'".format(function.__name__))
+
+        accumulator = ACCUMULATORS[function](**kwargs)
         planes = self._iter_slices(ax, fill=fill, check_endian=check_endian)
-        result = next(planes)
-        for plane in planes:
-            result = function(np.dstack((result, plane)), axis=2, **kwargs)
+        for index, plane in enumerate(planes):
+            accumulator.update(plane, index)
 
-        if full_reduce:
-            result = function(result)
+        return accumulator.result(full=full_reduce)
 
-        return result
+    def _reduce_raywise(self, function, fill, check_endian, axis, **kwargs):
+        """
+        Compute a numpy aggregation along an axis by applying it to blocks
+        of complete rays, sized to fit within the memory limit
+        """
+        out = None
+        blocks = list(self._iter_ray_blocks(axis))
+        filled = self._iter_filled([view for _, _, view in blocks],
+                                   fill=fill, check_endian=check_endian)
+        for (xslc, yslc, view), data in six.moves.zip(blocks, filled):
+            result = function(data, axis=axis, **kwargs)
+            if out is None:
+                out = np.empty(self._get_flat_shape(axis), dtype=result.dtype)
+            out[xslc, yslc] = result
+        return out
+
+    def _reduce_parallel(self, function, fill, check_endian, n_workers,
+                         executor, **kwargs):
+        """
+        Compute a numpy aggregation by reducing slabs of the cube in
+        parallel, and combining the partial results
+
+        Reductions along an axis split the cube along another axis, so
+        that the partial results only need to be concatenated. Full
+        reductions split the cube along the spectral axis and merge the
+        accumulated slabs.
+        """
+
+        axis = kwargs.pop('axis', None)
+
+        if isinstance(axis, tuple):
+            raise NotImplementedError("Multi-axis reductions cannot be "
+                                      "run in parallel")
+
+        if axis is None:
+            if function not in ACCUMULATORS:
+                raise NotImplementedError("{0} cannot be computed in "
+                                          "parallel".format(function.__name__))
+            split = 0
+        else:
+            # split along the slowest-varying axis that is not collapsed
+            split = 1 if axis == 0 else 0
+
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+
+        # use a few slabs per worker to balance the load, and enough slabs
+        # for the slabs being reduced at the same time to fit in memory
+        size = cube_utils.block_size(self, n_workers=n_workers)
+        nslabs = max(4 * n_workers, -(-self.size // size))
+        views = cube_utils.slab_views(self.shape, split, nslabs)
+        # each task only holds a slab of the cube, which is all that is
+        # sent to process-based executors
+        tasks = [(self[view], view[0].start, function, fill, check_endian,
+                  axis, kwargs) for view in views]
+        results = cube_utils.map_parallel(_reduce_slab, tasks,
+                                          n_workers=n_workers,
+                                          executor=executor)
+
+        if axis is None:
+            accumulator = results[0]
+            for partial in results[1:]:
+                accumulator.merge(partial)
+            return accumulator.result(full=True)
+
+        return np.concatenate(results, axis=split if split < axis else split - 1)
 
     def get_mask_array(self):
         """
@@ -245,36 +600,45 @@ class SpectralCube(object):
         return self._mask
 
     @aggregation_docstring
-    def sum(self, axis=None, how='auto'):
+    def sum(self, axis=None, how='auto', n_workers=None, executor=None):
         """
         Return the sum of the cube, optionally over an axis.
         """
 
         # use nansum, and multiply by mask to add zero each time there is badness
         return u.Quantity(self._apply_numpy_function(np.nansum, fill=np.nan,
-                                                     how=how, axis=axis), self.unit,
+                                                     how=how, axis=axis,
+                                                     n_workers=n_workers,
+                                                     executor=executor),
+                          self.unit,
                           copy=False)
 
     @aggregation_docstring
-    def max(self, axis=None, how='auto'):
+    def max(self, axis=None, how='auto', n_workers=None, executor=None):
         """
         Return the maximum data value of the cube, optionally over an axis.
         """
         return u.Quantity(self._apply_numpy_function(np.nanmax, fill=np.nan,
-                                                     how=how, axis=axis), self.unit,
+                                                     how=how, axis=axis,
+                                                     n_workers=n_workers,
+                                                     executor=executor),
+                          self.unit,
                           copy=False)
 
     @aggregation_docstring
-    def min(self, axis=None, how='auto'):
+    def min(self, axis=None, how='auto', n_workers=None, executor=None):
         """
         Return the minimum data value of the cube, optionally over an axis.
         """
         return u.Quantity(self._apply_numpy_function(np.nanmin, fill=np.nan,
-                                                     how=how, axis=axis), self.unit,
+                                                     how=how, axis=axis,
+                                                     n_workers=n_workers,
+                                                     executor=executor),
+                          self.unit,
                           copy=False)
 
     @aggregation_docstring
-    def argmax(self, axis=None, how='auto'):
+    def argmax(self, axis=None, how='auto', n_workers=None, executor=None):
         """
         Return the index of the maximum data value.
 
@@ -282,11 +646,12 @@ class SpectralCube(object):
         excluded from the mask.
         """
         return self._apply_numpy_function(np.nanargmax, fill=-np.inf,
-                                          reduce=False,
-                                          how=how, axis=axis)
+                                          how=how, axis=axis,
+                                          n_workers=n_workers,
+                                          executor=executor)
 
     @aggregation_docstring
-    def argmin(self, axis=None, how='auto'):
+    def argmin(self, axis=None, how='auto', n_workers=None, executor=None):
         """
         Return the index of the minimum data value.
 
@@ -294,16 +659,66 @@ class SpectralCube(object):
         excluded from the mask
         """
         return self._apply_numpy_function(np.nanargmin, fill=np.inf,
-                                          reduce=False,
-                                          how=how, axis=axis)
+                                          how=how, axis=axis,
+                                          n_workers=n_workers,
+                                          executor=executor)
 
-    def chunked(self, chunksize=1000):
+    def chunked(self, chunksize=None, prefetch=True):
         """
-        Not Implemented.
+        Iterate over chunks of the data and mask.
 
-        Iterate over chunks of valid data
+        The chunks follow the layout of the data in memory (or on disk), so
+        that each is read in a single contiguous pass: chunks are made of
+        complete channels where possible, or else of complete rows of a
+        single channel.
+
+        Parameters
+        ----------
+        chunksize : int, optional
+            The approximate maximum number of elements in each chunk.
+            Defaults to the largest size within the memory limit (see
+            :func:`~spectral_cube.cube_utils.set_memory_limit`).
+        prefetch : bool, optional
+            Whether to read the next chunk on a background thread while the
+            current one is being processed, so that computations overlap
+            with reading the data.
+
+        Yields
+        ------
+        view : tuple
+            The view of the cube containing the chunk
+        data : Quantity
+            The unmasked data of the chunk, in native byte order
+        mask : `~numpy.ndarray`
+            The boolean mask of the included values of the chunk
+        """
+        if chunksize is None:
+            # the next chunk is read while the current one is in use
+            chunksize = cube_utils.block_size(self, n_workers=2 if prefetch
+                                              else 1)
+        views = cube_utils.contiguous_views(self.shape, chunksize)
+
+        if prefetch:
+            chunks = cube_utils.prefetch(self._read_chunk, views)
+        else:
+            chunks = six.moves.map(self._read_chunk, views)
+
+        for view, (data, mask) in six.moves.zip(views, chunks):
+            yield view, u.Quantity(data, self.unit, copy=False), mask
+
+    def _read_chunk(self, view):
         """
-        raise NotImplementedError()
+        Read the data and mask of a view into memory
+        """
+        data = self._data[view]
+        data = np.array(data, dtype=data.dtype.newbyteorder('='))
+        if self._mask is None:
+            mask = np.ones(data.shape, dtype=bool)
+        else:
+            mask = self._mask.include(data=self._data, wcs=self._wcs,
+                                      view=view)
+            mask = np.asarray(mask, dtype=bool)
+        return data, mask
 
     def _get_flat_shape(self, axis):
         """
@@ -318,7 +733,7 @@ class SpectralCube(object):
         return nx, ny
 
     def _apply_along_axes(self, function, axis=None, weights=None, wcs=False,
-                          **kwargs):
+                          n_workers=None, executor=None, **kwargs):
         """
         Apply a function to valid data along the specified axis, optionally
         using a weight array that is the same shape (or at least can be sliced
@@ -328,14 +743,26 @@ class SpectralCube(object):
         ----------
         function: function
             A function that can be applied to a numpy array.  Does not need to
-            be nan-aware
+            be nan-aware. Functions that have a nan-aware equivalent in numpy
+            (e.g. `numpy.median` or `numpy.percentile`) are applied to blocks
+            of rays at once, other functions are called once per ray.
         axis: int
             The axis to operate along
         weights: (optional) np.ndarray
             An array with the same shape (or slicing abilities/results) as the
             data cube
+        n_workers: (optional) int
+            If larger than one, process blocks of rays in parallel using
+            this many threads
+        executor: (optional) object
+            An executor with a ``map`` method used to process blocks of
+            rays in parallel
         """
         if axis is None:
+            if executor is not None or (n_workers or 1) > 1:
+                warnings.warn("{0} cannot be computed in parallel over the "
+                              "whole cube, computing it "
+                              "serially".format(function.__name__))
             return function(self.flattened(), **kwargs)
 
         # determine the output array shape
@@ -344,13 +771,25 @@ class SpectralCube(object):
         # allocate memory for output array
         out = np.empty([nx, ny]) * np.nan
 
-        # iterate over "lines of sight" through the cube
-        for x, y, slc in self._iter_rays(axis):
-            # acquire the flattened, valid data for the slice
-            data = self.flattened(slc, weights=weights)
-            if len(data) != 0:
-                # store result in array
-                out[x, y] = function(data, **kwargs)
+        # process blocks of "lines of sight" through the cube, with a few
+        # blocks per worker to balance the load
+        if executor is not None and n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        n_workers = n_workers or 1
+        min_blocks = 4 * n_workers if n_workers > 1 else 1
+        size = cube_utils.block_size(self, n_workers=n_workers,
+                                     min_blocks=min_blocks)
+        blocks = list(self._iter_ray_blocks(axis, block_size=size))
+        # as for parallel reductions, each task only holds a block of the
+        # cube
+        tasks = [(self[tuple(view)], function, axis,
+                  None if weights is None else weights[tuple(view)], kwargs)
+                 for _, _, view in blocks]
+        results = cube_utils.map_parallel(_apply_along_rays, tasks,
+                                          n_workers=n_workers,
+                                          executor=executor)
+        for (xslc, yslc, _), result in zip(blocks, results):
+            out[xslc, yslc] = result
 
         if wcs:
             newwcs = wcs_utils.drop_axis(self._wcs, np2wcs[axis])
@@ -373,16 +812,130 @@ class SpectralCube(object):
                 slc.insert(axis, slice(None))
                 yield x, y, slc
 
+    def _iter_ray_blocks(self, axis, block_size=None):
+        """
+        Iterate over views corresponding to blocks of lines-of-sight
+        through a cube along the specified axis
+
+        Parameters
+        ----------
+        axis : int
+            The axis along which the rays run
+        block_size : int
+            The approximate maximum number of elements in each block. Blocks
+            always contain at least one complete ray. Defaults to the
+            largest size within the memory limit (see
+            :func:`~spectral_cube.cube_utils.set_memory_limit`).
+
+        Yields
+        ------
+        xslc, yslc, view
+            The range of rays covered by the block, along the first and
+            second axes that are iterated over, and the view of the cube
+            containing the block
+        """
+        nx, ny = self._get_flat_shape(axis)
+
+        if block_size is None:
+            block_size = cube_utils.block_size(self)
+
+        # use complete rows where possible, since these are contiguous in
+        # memory for the last axis
+        nrays = max(1, int(block_size // self.shape[axis]))
+        by = min(ny, nrays)
+        bx = max(1, nrays // by)
+
+        for x in xrange(0, nx, bx):
+            for y in xrange(0, ny, by):
+                xslc = slice(x, min(x + bx, nx))
+                yslc = slice(y, min(y + by, ny))
+                view = [xslc, yslc]
+                view.insert(axis, slice(None))
+                yield xslc, yslc, tuple(view)
+
     def _iter_slices(self, axis, fill=np.nan, check_endian=False):
         """
         Iterate over the cube one slice at a time,
         replacing masked elements with fill
+
+        The same buffers are reused for every slice, so each slice is
+        overwritten by the next one.
         """
-        view = [slice(None)] * 3
-        for x in range(self.shape[axis]):
-            view[axis] = x
+        views = [(slice(None),) * axis + (x,) for x in range(self.shape[axis])]
+        return self._iter_filled(views, fill=fill, check_endian=check_endian)
+
+    def _iter_filled(self, views, fill=np.nan, check_endian=False):
+        """
+        Iterate over the filled data in each of *views*.
+
+        When the cube has a mask, the data are written to a data buffer and
+        a mask buffer allocated once, for the largest view, so that each
+        array yielded is overwritten by the next one. Otherwise, views of
+        the data are yielded, which should not be modified.
+        """
+        if self._mask is None:
+            for view in views:
+                yield self._get_filled_data(view=view, fill=fill,
+                                            check_endian=check_endian)
+            return
+
+        data = mask = None
+        for view in views:
+            shape = self._data[view].shape
+            size = int(np.prod(shape))
+            if data is None or data.size < size:
+                data = np.empty(size, dtype=self._filled_dtype())
+                mask = np.empty(size, dtype=bool)
             yield self._get_filled_data(view=view, fill=fill,
-                                        check_endian=check_endian)
+                                        check_endian=check_endian,
+                                        out=data[:size].reshape(shape),
+                                        mask_out=mask[:size].reshape(shape))
+
+    def iter_channels(self):
+        """
+        Iterate over the spectral channels of the cube, with excluded mask
+        values replaced by `fill_value`.
+
+        The same buffers are reused for every channel, so each channel is
+        overwritten by the next one; copy it to keep it.
+
+        Yields
+        ------
+        channel : Quantity
+            The filled 2-d channel
+        """
+        for plane in self._iter_slices(0, fill=self._fill_value,
+                                       check_endian=True):
+            yield u.Quantity(plane, self.unit, copy=False)
+
+    def iter_spectra_blocks(self, block_size=None):
+        """
+        Iterate over blocks of complete spectra, with excluded mask values
+        replaced by `fill_value`.
+
+        The same buffers are reused for every block, so each block is
+        overwritten by the next one; copy it to keep it.
+
+        Parameters
+        ----------
+        block_size : int, optional
+            The approximate maximum number of elements in each block. Defaults
+            to the largest size within the memory limit (see
+            :func:`~spectral_cube.cube_utils.set_memory_limit`).
+
+        Yields
+        ------
+        view : tuple
+            The view of the cube containing the block
+        block : Quantity
+            The filled 3-d block of spectra
+        """
+        views = [view for _, _, view in
+                 self._iter_ray_blocks(0, block_size=block_size)]
+        blocks = self._iter_filled(views, fill=self._fill_value,
+                                   check_endian=True)
+        for view, block in six.moves.zip(views, blocks):
+            yield view, u.Quantity(block, self.unit, copy=False)
 
     def flattened(self, slice=(), weights=None):
         """
@@ -405,7 +958,7 @@ class SpectralCube(object):
         else:
             return u.Quantity(data, self.unit, copy=False)
 
-    def median(self, axis=None, **kwargs):
+    def median(self, axis=None, n_workers=None, executor=None, **kwargs):
         """
         Compute the median of an array, optionally along an axis.
 
@@ -415,6 +968,14 @@ class SpectralCube(object):
         ----------
         axis : int (optional)
             The axis to collapse
+        n_workers : int (optional)
+            If larger than one, compute the median of slabs of the cube
+            in parallel using this many threads. The median of the whole
+            cube (``axis=None``) is computed serially, with a warning.
+        executor : object (optional)
+            An executor with a ``map`` method (e.g. from
+            `concurrent.futures` or a `multiprocessing.Pool`) used to
+            compute the median of slabs of the cube in parallel
 
         Returns
         -------
@@ -425,10 +986,14 @@ class SpectralCube(object):
             from bottleneck import nanmedian
             return u.Quantity(self._apply_numpy_function(nanmedian, axis=axis,
                                                          check_endian=True,
+                                                         n_workers=n_workers,
+                                                         executor=executor,
                                                          **kwargs), self.unit,
                               copy=False)
         except ImportError:
             return u.Quantity(self._apply_along_axes(np.median, axis=axis,
+                                                     n_workers=n_workers,
+                                                     executor=executor,
                                                      **kwargs), self.unit,
                               copy=False)
 
@@ -478,22 +1043,47 @@ class SpectralCube(object):
                                  "%s vs %s" % (mask.shape, self._data.shape))
             mask = BooleanArrayMask(mask, self._wcs)
 
-        cube = SpectralCube(self._data, wcs=self._wcs,
-                            mask=self._mask & mask if inherit_mask else mask,
-                            fill_value=self.fill_value,
-                            meta=self._meta)
+        cube = self._new_cube(self._data, wcs=self._wcs,
+                              mask=self._mask & mask if inherit_mask else mask,
+                              fill_value=self.fill_value,
+                              meta=self._meta)
         return cube
 
     def __getitem__(self, view):
+        view = self._normalize_view(view)
+
         meta = {}
         meta.update(self._meta)
         meta['slice'] = [(s.start, s.stop, s.step) for s in view]
 
-        return SpectralCube(self._data[view],
-                            wcs_utils.slice_wcs(self._wcs, view),
-                            mask=self._mask[view],
-                            fill_value=self.fill_value,
-                            meta=meta)
+        # the WCS is only sliced once, for both the cube and its mask, and
+        # the data remains a view of the data of this cube
+        wcs = wcs_utils.slice_wcs(self._wcs, view)
+        mask = None if self._mask is None else self._mask._sliced(view, wcs)
+
+        return self._new_cube(self._data[view], wcs, mask=mask,
+                              fill_value=self.fill_value, meta=meta)
+
+    def _normalize_view(self, view):
+        """
+        Return a view of the cube as a tuple of three slices, with negative
+        start indices converted to positive ones
+
+        The WCS of the view is only shifted, so slices with steps other
+        than 1 (which would reverse or stride the data) are rejected.
+        """
+        if not isinstance(view, tuple):
+            view = (view,)
+        if len(view) > 3 or not all(isinstance(s, slice) for s in view):
+            raise IndexError("Cubes can only be sliced with up to three "
+                             "slices, got {0}".format(view))
+        if any(s.step not in (None, 1) for s in view):
+            raise IndexError("Cubes can only be sliced with steps of 1, "
+                             "got {0}".format(view))
+        view = view + (slice(None),) * (3 - len(view))
+        return tuple(slice(s.start + n, s.stop, s.step)
+                     if s.start is not None and s.start < 0 else s
+                     for s, n in zip(view, self.shape))
 
     @property
     def fill_value(self):
@@ -505,17 +1095,21 @@ class SpectralCube(object):
         return self._fill_value
 
     @cube_utils.slice_syntax
-    def filled_data(self, view):
+    def filled_data(self, view, out=None):
         """
         Return a portion of the data array, with excluded mask values
         replaced by `fill_value`.
 
+        To write the data to an existing array, call this with the view and
+        the array, e.g. ``cube.filled_data((0,), out=array)``.
+
         Returns
         -------
         data : Quantity
             The masked data.
         """
-        return u.Quantity(self._get_filled_data(view, fill=self._fill_value),
+        return u.Quantity(self._get_filled_data(view, fill=self._fill_value,
+                                                out=out),
                           self.unit, copy=False)
 
     def with_fill_value(self, fill_value):
@@ -526,11 +1120,11 @@ class SpectralCube(object):
         ----
         This method is fast (it does not copy any data)
         """
-        return SpectralCube(data=self._data,
-                            wcs=self._wcs,
-                            mask=self._mask,
-                            fill_value=self.fill_value,
-                            meta=self._meta)
+        return self._new_cube(data=self._data,
+                              wcs=self._wcs,
+                              mask=self._mask,
+                              fill_value=fill_value,
+                              meta=self._meta)
 
     def with_spectral_unit(self, unit, velocity_convention=None,
                            rest_value=None):
@@ -571,32 +1165,44 @@ class SpectralCube(object):
                                                 rest_value=rest_value)
         newmask._wcs = newwcs
 
-        return SpectralCube(data=self._data, wcs=newwcs, mask=newmask,
-                            fill_value=self.fill_value, meta=meta)
+        return self._new_cube(data=self._data, wcs=newwcs, mask=newmask,
+                              fill_value=self.fill_value, meta=meta)
 
-    def _get_filled_data(self, view=(), fill=np.nan, check_endian=False):
+    def _get_filled_data(self, view=(), fill=np.nan, check_endian=False,
+                         out=None, mask_out=None):
         """
         Return the underlying data as a numpy array.
         Always returns the spectral axis as the 0th axis
 
-        Sets masked values to *fill*
+        Sets masked values to *fill*. If *check_endian* is True, the
+        result is converted to native byte order if needed (only the
+        requested view is converted, so that memory-mapped data is not
+        loaded in full). If *out* is given, the result is written to it,
+        and *mask_out* can be given to hold the excluded elements.
         """
-        if check_endian:
-            if not self._data.dtype.isnative:
-                kind = str(self._data.dtype.kind)
-                sz = str(self._data.dtype.itemsize)
-                dt = '=' + kind + sz
-                data = self._data.astype(dt)
-            else:
-                data = self._data
-        else:
-            data = self._data
+        if self._mask is not None:
+            return self._mask._filled(data=self._data, wcs=self._wcs,
+                                      fill=fill, view=view, out=out,
+                                      mask_out=mask_out)
 
-        if self._mask is None:
-            return data[view]
+        result = self._data[view]
+        if out is not None:
+            np.copyto(out, result, casting='unsafe')
+            return out
+
+        if check_endian and not result.dtype.isnative:
+            result = result.astype(result.dtype.newbyteorder('='))
+
+        return result
 
-        return self._mask._filled(data=data, wcs=self._wcs, fill=fill,
-                                  view=view)
+    def _filled_dtype(self):
+        """
+        The type of the filled data, in native byte order
+        """
+        dtype = self._data.dtype
+        if self._mask is not None:
+            dtype = np.result_type(dtype, np.float32)
+        return dtype.newbyteorder('=')
 
     @cube_utils.slice_syntax
     def unmasked_data(self, view):
@@ -630,7 +1236,10 @@ class SpectralCube(object):
 
         Notes
         -----
-        These arrays are broadcast, and are not memory intensive
+        These arrays are compact: the spectral offsets have a shape of
+        ``(nv, 1, 1)`` and the spatial offsets ``(1, ny, nx)``, so that they
+        broadcast to the shape of the cube without being expanded. Use
+        :func:`~spectral_cube.cube_utils.broadcast_view` to slice them.
 
         Each array is in the units of the corresponding wcs.cunit, but
         this is implicit (e.g., they are not astropy Quantity arrays)
@@ -658,9 +1267,8 @@ class SpectralCube(object):
 
         x = x.reshape(1, x.shape[0], x.shape[1])
         y = y.reshape(1, y.shape[0], y.shape[1])
-        spectral = spectral.reshape(-1, 1, 1) - spectral.ravel()[0]
-        x, y, spectral = np.broadcast_arrays(x, y, spectral)
-        return spectral, y, x
+        spectral = np.asarray(spectral).reshape(-1, 1, 1)
+        return spectral - spectral.ravel()[0], y, x
 
     @cached
     def _pix_size(self):
@@ -675,7 +1283,9 @@ class SpectralCube(object):
 
         Notes
         -----
-        These arrays are broadcast, and are not memory intensive
+        These arrays are compact: ``dv`` has a shape of ``(nv, 1, 1)`` and
+        ``dy`` and ``dx`` ``(1, ny, nx)``, so that they broadcast to the
+        shape of the cube without being expanded.
 
         Each array is in the units of the corresponding wcs.cunit, but
         this is implicit (e.g., they are not astropy Quantity arrays)
@@ -732,7 +1342,6 @@ class SpectralCube(object):
         dx = np.abs(np.degrees(dx.reshape(1, dx.shape[0], dx.shape[1])))
         dy = np.abs(np.degrees(dy.reshape(1, dy.shape[0], dy.shape[1])))
         dspectral = np.abs(dspectral.reshape(-1, 1, 1))
-        dx, dy, dspectral = np.broadcast_arrays(dx, dy, dspectral)
 
         return dspectral, dy, dx
 
@@ -795,11 +1404,66 @@ class SpectralCube(object):
                         auto=moment_auto)
 
         if how not in dispatch:
-            return ValueError("Invalid how. Must be in %s" %
-                              sorted(list(dispatch.keys())))
+            raise ValueError("Invalid how. Must be in %s" %
+                             sorted(list(dispatch.keys())))
 
         out = dispatch[how](self, order, axis)
 
+        return self._moment_projection(out, order, axis, how)
+
+    def moments(self, orders=(0, 1, 2), axis=0, how='auto'):
+        """
+        Compute several moments along an axis in a single pass over the data.
+
+        This gives the same results as calling :meth:`moment` for each
+        order, but reads the data only once, which is much faster for
+        cubes that do not fit in memory. See :meth:`moment` for the
+        definition of the moments.
+
+        Parameters
+        ----------
+        orders : sequence of int
+           The orders of the moments to compute. Default=(0, 1, 2)
+
+        axis : int
+           The axis along which to compute the moments. Default=0
+
+        how : cube | slice | ray | auto
+           How to compute the moments. See :meth:`moment`.
+
+        Returns
+        -------
+        moments : list of :class:`Projection`
+           The moment maps, in the same order as ``orders``
+
+        Notes
+        -----
+        The moments are derived from the intensity-weighted sums of
+        powers of the pixel coordinates, which are accumulated together.
+        """
+        from ._moments import (moments_slicewise, moments_cubewise,
+                               moments_raywise, moments_auto)
+
+        dispatch = dict(slice=moments_slicewise,
+                        cube=moments_cubewise,
+                        ray=moments_raywise,
+                        auto=moments_auto)
+
+        if how not in dispatch:
+            raise ValueError("Invalid how. Must be in %s" %
+                             sorted(list(dispatch.keys())))
+
+        orders = list(orders)
+        out = dispatch[how](self, orders, axis)
+
+        return [self._moment_projection(o, order, axis, how)
+                for o, order in zip(out, orders)]
+
+    def _moment_projection(self, out, order, axis, how):
+        """
+        Apply units to a raw moment map, and wrap it in a Projection
+        """
+
         # apply units
         if order == 0:
             axunit = unit = u.Unit(self._wcs.wcs.cunit[np2wcs[axis]])
@@ -866,9 +1530,15 @@ class SpectralCube(object):
             The rest frequency for any Doppler conversions
         """
 
-        # TODO: we have to not compute this every time
-        spectral_axis = self.spectral_axis
+        return self._closest_channel(self.spectral_axis, value,
+                                     rest_frequency=rest_frequency)
 
+    @staticmethod
+    def _closest_channel(spectral_axis, value, rest_frequency=None):
+        """
+        Find the index of the closest channel of ``spectral_axis`` to a
+        spectral coordinate, see :meth:`closest_spectral_channel`
+        """
         try:
             value = value.to(spectral_axis.unit, equivalencies=u.spectral())
         except u.UnitsError:
@@ -923,9 +1593,9 @@ class SpectralCube(object):
                 mask_slab = None
 
         # Create new spectral cube
-        slab = SpectralCube(self._data[ilo:ihi], wcs_slab,
-                            fill_value=self.fill_value,
-                            mask=mask_slab, meta=self._meta)
+        slab = self._new_cube(self._data[ilo:ihi], wcs_slab,
+                              fill_value=self.fill_value,
+                              mask=mask_slab, meta=self._meta)
 
         # TODO: we could change the WCS to give a spectral axis in the
         # correct units as requested - so if the initial cube is in Hz and we
@@ -934,16 +1604,109 @@ class SpectralCube(object):
 
         return slab
 
-    def subcube(self, xlo, xhi, ylo, yhi, zlo, zhi, rest_frequency=None):
+    def subcube(self, xlo='min', xhi='max', ylo='min', yhi='max', zlo='min',
+                zhi='max', rest_frequency=None):
         """
         Extract a sub-cube spatially and spectrally.
 
-        This method is not yet implemented.
+        The data of the sub-cube is a view of the data of this cube, so no
+        data are copied (memory-mapped data are not read), and the mask is
+        sliced lazily.
 
-        xlo = 'min' / 'max' should be special keywords
+        Parameters
+        ----------
+        xlo, xhi, ylo, yhi, zlo, zhi : int, :class:`~astropy.units.Quantity`, 'min' or 'max'
+            The range along the longitude (x), latitude (y) and spectral (z)
+            axes, given either as pixel indices (with ``hi`` excluded, as for
+            Python slices) or as world coordinates (with ``hi`` included).
+            'min' and 'max' stand for the edges of the cube. If given as
+            world coordinates, the four spatial bounds should all be world
+            coordinates.
+        rest_frequency : :class:`~astropy.units.Quantity`
+            The rest frequency for any Doppler conversions
+        """
+        return self.subcubes([(xlo, xhi, ylo, yhi, zlo, zhi)],
+                             rest_frequency=rest_frequency)[0]
 
+    def subcubes(self, regions, rest_frequency=None):
         """
-        raise NotImplementedError()
+        Extract several sub-cubes, e.g. postage stamps around many sources.
+
+        This is equivalent to calling :meth:`subcube` for each region, but
+        the world coordinates of all the regions are converted to pixels at
+        once.
+
+        Parameters
+        ----------
+        regions : list
+            The ``(xlo, xhi, ylo, yhi, zlo, zhi)`` range of each sub-cube,
+            as for :meth:`subcube`
+        rest_frequency : :class:`~astropy.units.Quantity`
+            The rest frequency for any Doppler conversions
+
+        Returns
+        -------
+        subcubes : list of :class:`SpectralCube`
+        """
+        return [self[view] for view in
+                self._region_views(regions, rest_frequency=rest_frequency)]
+
+    def _region_views(self, regions, rest_frequency=None):
+        """
+        Convert the ranges of regions, as given to :meth:`subcube`, to views
+        """
+        nz, ny, nx = self.shape
+        regions = [tuple(region) for region in regions]
+        if any(len(region) != 6 for region in regions):
+            raise ValueError("Regions should be given as "
+                             "(xlo, xhi, ylo, yhi, zlo, zhi)")
+
+        # convert the spectral coordinates using the spectral axis, which
+        # is only computed once
+        spectral_axis = None
+        ranges = []
+        for region in regions:
+            zrange = []
+            for value in region[4:]:
+                if isinstance(value, u.Quantity):
+                    if spectral_axis is None:
+                        spectral_axis = self.spectral_axis
+                    value = float(self._closest_channel(spectral_axis, value,
+                                                        rest_frequency))
+                zrange.append(value)
+            ranges.append([region[:2], region[2:4], zrange])
+
+        # convert the celestial coordinates of the corners of all the
+        # regions in a single call
+        world = [i for i, region in enumerate(regions)
+                 if any(isinstance(v, u.Quantity) for v in region[:4])]
+        if world:
+            if not all(isinstance(v, u.Quantity)
+                       for i in world for v in regions[i][:4]):
+                raise ValueError("The spatial bounds of a region should all "
+                                 "be world coordinates, or none of them")
+            cunit = self._wcs.wcs.cunit
+            units = [u.Unit(cunit[i]) if str(cunit[i]) else u.deg
+                     for i in (0, 1)]
+            corners = np.array([[lon.to(units[0]).value, lat.to(units[1]).value]
+                                for i in world
+                                for lon in regions[i][:2]
+                                for lat in regions[i][2:4]])
+            pixels = self._wcs.celestial.wcs_world2pix(corners, 0)
+            for i, corner in zip(world, pixels.reshape(-1, 4, 2)):
+                ranges[i][:2] = [(float(np.min(p)), float(np.max(p)))
+                                 for p in corner.T]
+
+        views = []
+        for region, xyz in zip(regions, ranges):
+            view = []
+            for (lo, hi), n in zip(xyz[::-1], (nz, ny, nx)):
+                view.append(_pixel_range(lo, hi, n))
+            if any(s.start >= s.stop for s in view):
+                raise ValueError("Region {0} does not overlap "
+                                 "the cube".format(region))
+            views.append(tuple(view))
+        return views
 
     def world_spines(self):
         """
@@ -968,7 +1731,12 @@ class SpectralCube(object):
         Returns
         -------
         [v, y, x] : list of NumPy arryas
-            The 3 world coordinates at each pixel in the view.
+            The 3 world coordinates at each pixel in the view. When the
+            spectral and celestial axes are separable, these are read-only
+            arrays broadcast from the 1-D spectral coordinates and the 2-D
+            celestial coordinates, which take little memory. Use
+            :meth:`iter_world` to compute the coordinates of large cubes one
+            block at a time otherwise.
 
         Examples
         --------
@@ -984,26 +1752,96 @@ class SpectralCube(object):
         >>> v, y, x = c.world[::2, ::2, ::2]
         """
 
-        # note: view is a tuple of view
+        if wcs_utils.is_spectrally_separable(self._wcs):
+            world = self._separable_world(view)
+        else:
+            world = None
 
-        # the next 3 lines are equivalent to (but more efficient than)
-        # inds = np.indices(self._data.shape)
-        # inds = [i[view] for i in inds]
-        inds = np.ogrid[[slice(0, s) for s in self._data.shape]]
-        inds = np.broadcast_arrays(*inds)
-        inds = [i[view] for i in inds[::-1]]  # numpy -> wcs order
+        if world is None:
+            # note: view is a tuple of view
 
-        shp = inds[0].shape
-        inds = np.column_stack([i.ravel() for i in inds])
-        world = self._wcs.all_pix2world(inds, 0).T
+            # the next 3 lines are equivalent to (but more efficient than)
+            # inds = np.indices(self._data.shape)
+            # inds = [i[view] for i in inds]
+            inds = np.ogrid[[slice(0, s) for s in self._data.shape]]
+            inds = np.broadcast_arrays(*inds)
+            inds = [i[view] for i in inds[::-1]]  # numpy -> wcs order
 
-        world = [w.reshape(shp) for w in world]  # 1D->3D
+            shp = inds[0].shape
+            inds = np.column_stack([i.ravel() for i in inds])
+            world = self._wcs.all_pix2world(inds, 0).T
+
+            world = [w.reshape(shp) for w in world]  # 1D->3D
 
         # apply units
-        world = [w * u.Unit(self._wcs.wcs.cunit[i])
+        world = [u.Quantity(w, self._wcs.wcs.cunit[i], copy=False)
                  for i, w in enumerate(world)]
         return world[::-1]  # reverse WCS -> numpy order
 
+    def _separable_world(self, view):
+        """
+        Compute the world coordinates of a view, in WCS order, when the
+        spectral and celestial axes are separable, by evaluating the spectral
+        coordinates once per channel and the celestial coordinates once per
+        spatial pixel. The results are read-only arrays broadcast to the
+        shape of the view.
+
+        Returns None for views that are not made of integers and slices.
+        """
+        if not isinstance(view, tuple):
+            view = (view,)
+        if len(view) > 3 or not all(isinstance(v, (slice,) + six.integer_types +
+                                               (np.integer,)) for v in view):
+            return None
+        view = view + (slice(None),) * (3 - len(view))
+
+        # the pixel indices along each axis, keeping the integer axes
+        pix = [np.atleast_1d(np.arange(n)[v])
+               for n, v in zip(self._data.shape, view)]
+        shape = tuple(len(p) for p in pix)
+
+        # the other axes are evaluated at the reference pixel, where the
+        # coordinates are always defined
+        crpix = self._wcs.wcs.crpix - 1
+        spectral = pix[0].astype(float)
+        spectral = self._wcs.all_pix2world(np.full(spectral.shape, crpix[0]),
+                                           np.full(spectral.shape, crpix[1]),
+                                           spectral, 0)[2]
+
+        x, y = np.meshgrid(pix[2], pix[1])
+        lon, lat, _ = self._wcs.all_pix2world(x, y, np.full(x.shape, crpix[2]),
+                                              0)
+
+        drop = tuple(slice(None) if isinstance(v, slice) else 0 for v in view)
+        return [cube_utils.broadcast_to(w, shape)[drop]
+                for w in (lon.reshape((1,) + lon.shape),
+                          lat.reshape((1,) + lat.shape),
+                          spectral.reshape(-1, 1, 1))]
+
+    def iter_world(self, block_size=None):
+        """
+        Iterate over the world coordinates of the cube, one block of
+        complete spectra at a time, so that the coordinates of large cubes
+        can be computed within the memory limit even when the spectral and
+        celestial axes are not separable.
+
+        Parameters
+        ----------
+        block_size : int, optional
+            The approximate maximum number of elements in each block. Defaults
+            to the largest size within the memory limit (see
+            :func:`~spectral_cube.cube_utils.set_memory_limit`).
+
+        Yields
+        ------
+        view : tuple
+            The view of the cube containing the block
+        [v, y, x] : list of Quantity
+            The 3 world coordinates at each pixel in the block
+        """
+        for _, _, view in self._iter_ray_blocks(0, block_size=block_size):
+            yield view, self.world[view]
+
     def __gt__(self, value):
         """
         Return a LazyMask representing the inequality
@@ -1044,20 +1882,27 @@ class SpectralCube(object):
             HDU).
         kwargs : dict
             If the format is 'fits', the kwargs are passed to
-            :func:`~astropy.io.fits.open`.
+            :func:`~spectral_cube.io.fits.load_fits_cube`, and then to
+            :func:`~astropy.io.fits.open`. In particular, ``memmap=True``
+            memory-maps the data read-only and keeps the file open until
+            :meth:`close` is called.
         """
         from .io.core import read
         cube = read(filename, format=format, hdu=hdu, **kwargs)
-        if isinstance(cube, SpectralCube):
+        if not isinstance(cube, StokesSpectralCube):
             return cube
-        else:  # StokesSpectralCube
-            return SpectralCube(data=cube._data, wcs=cube._wcs,
-                                meta=cube._meta, mask=cube._mask)
+        else:
+            stokes_i = cube.component(cube.components[0])
+            stokes_i._file_handle = cube._file_handle
+            return stokes_i
 
-    def write(self, filename, overwrite=False, format=None):
+    def write(self, filename, overwrite=False, format=None, **kwargs):
         """
         Write the spectral cube to a file.
 
+        By default, the excluded values are replaced by `fill_value`, and
+        the data are written one chunk at a time.
+
         Parameters
         ----------
         filename : str
@@ -1066,9 +1911,12 @@ class SpectralCube(object):
             The format of the file to write. (Currently limited to 'fits')
         overwrite : bool
             If True, overwrite `filename` if it exists
+        kwargs : dict
+            Passed to the writer, e.g. ``apply_mask`` or ``blank`` (see
+            :func:`~spectral_cube.io.fits.write_fits_cube`)
         """
         from .io.core import write
-        write(filename, self, overwrite=overwrite, format=format)
+        write(filename, self, overwrite=overwrite, format=format, **kwargs)
 
     def to_yt(self, spectral_factor=1.0, center=None, nprocs=1):
         """
@@ -1118,23 +1966,128 @@ class StokesSpectralCube(SpectralCube):
 
     """
     A class to store a spectral cube with multiple Stokes parameters. By
-    default, this will act like a Stokes I spectral cube, but other stokes
-    parameters can be accessed with attribute notation.
+    default, this will act like a Stokes I spectral cube (or the first
+    Stokes parameter, if there is no I), but other stokes parameters can be
+    accessed with attribute notation, e.g. ``cube.Q``.
+
+    The Stokes parameters share the same WCS. Their data are usually views
+    of the same (e.g. memory-mapped) array, and their masks are only
+    evaluated when needed.
+
+    Parameters
+    ----------
+    data : dict
+        The 3-d data of each Stokes parameter, e.g. ``{'I': ..., 'Q': ...}``
+    wcs : `~astropy.wcs.WCS`
+        The 3-d WCS of the Stokes parameters
+    mask : dict, optional
+        The mask of each Stokes parameter
     """
 
-    def __init__(self, data, wcs, mask=None, meta=None):
+    def __init__(self, data, wcs, mask=None, meta=None, fill_value=np.nan):
+
+        mask = mask or {}
+        codes = dict((name, code)
+                     for code, name in cube_utils.STOKES_CODES.items())
+        names = sorted(data, key=lambda name: (codes.get(name, 0) < 0,
+                                               abs(codes.get(name, 0))))
+
+        super(StokesSpectralCube, self).__init__(data[names[0]], wcs,
+                                                 mask=mask.get(names[0]),
+                                                 meta=meta,
+                                                 fill_value=fill_value)
+
+        self._stokes_names = names
+        self._stokes_data = data
+        self._stokes_mask = mask
+
+    @property
+    def components(self):
+        """
+        The names of the Stokes parameters
+        """
+        return list(self._stokes_names)
+
+    def component(self, name):
+        """
+        Return the cube of a Stokes parameter.
+
+        The cube shares the data, mask and WCS of this cube, so no data are
+        read or copied.
 
-        # WCS should be 3-d, data should be dict of 3-d, mask should be disk
-        # of 3-d
+        Parameters
+        ----------
+        name : str
+            The Stokes parameter, e.g. ``'Q'``
+        """
+        if name not in self._stokes_data:
+            raise KeyError("Stokes parameter {0} is not present (the "
+                           "parameters are {1})".format(name,
+                                                        self.components))
+        cube = SpectralCube(self._stokes_data[name], self._wcs,
+                            mask=self._stokes_mask.get(name), meta=self._meta,
+                            fill_value=self._fill_value)
+        cube._wcs = self._wcs
+        return cube
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get('_stokes_data', ()):
+            return self.component(name)
+        raise AttributeError("'{0}' object has no attribute "
+                             "'{1}'".format(type(self).__name__, name))
+
+    def _derived_cube(self, function, names, unit):
+        """
+        Return a cube whose data are computed from the data of some Stokes
+        parameters as they are accessed, and which excludes the elements
+        excluded by any of their masks
+        """
+        for name in names:
+            if name not in self._stokes_data:
+                raise ValueError("Stokes {0} is needed (the parameters are "
+                                 "{1})".format(name, self.components))
+
+        data = cube_utils.FunctionArray(
+            function, [self._stokes_data[name] for name in names],
+            dtype=np.result_type(self._data.dtype, np.float32))
+
+        mask = None
+        for name in names:
+            component = self._stokes_mask.get(name)
+            if component is not None:
+                mask = component if mask is None else mask & component
+
+        meta = dict(self._meta)
+        if unit is not None:
+            meta['BUNIT'] = unit.to_string(format='fits')
+        cube = SpectralCube(data, self._wcs, mask=mask, meta=meta,
+                            fill_value=self._fill_value)
+        cube._wcs = self._wcs
+        return cube
 
-        # XXX: For now, let's just extract I and work with that
+    def polarized_intensity(self):
+        """
+        Return the linearly polarized intensity, sqrt(Q^2 + U^2).
 
-        super(StokesSpectralCube, self).__init__(data["I"], wcs, mask=mask["I"], meta=meta)
+        The result is a cube whose values are computed from Q and U for
+        each chunk of data used, e.g. by a reduction, so that it is never
+        held in memory as a whole.
+        """
+        return self._derived_cube(np.hypot, ('Q', 'U'), self._unit)
 
-        # TODO: deal with the other stokes parameters here
+    def polarization_angle(self):
+        """
+        Return the polarization angle, 0.5 * arctan(U / Q), in degrees.
+
+        As for :meth:`polarized_intensity`, the angle is computed for each
+        chunk of data used.
+        """
+        def angle(stokes_q, stokes_u):
+            return np.degrees(0.5 * np.arctan2(stokes_u, stokes_q))
+        return self._derived_cube(angle, ('Q', 'U'), u.deg)
 
     @classmethod
-    def read(cls, filename, format=None, hdu=None):
+    def read(cls, filename, format=None, hdu=None, **kwargs):
         """
         Read a spectral cube from a file.
 
@@ -1151,20 +2104,17 @@ class StokesSpectralCube(SpectralCube):
         hdu : int or str
             For FITS files, the HDU to read in (can be the ID or name of an
             HDU).
+        kwargs : dict
+            Passed to the reader, see :meth:`SpectralCube.read`
         """
-        raise NotImplementedError("")
-
-    def write(self, filename, overwrite=False, format=None):
-        """
-        Write the spectral cube to a file.
-
-        Parameters
-        ----------
-        filename : str
-            The path to write the file to
-        format : str
-            The format of the file to write. (Currently limited to 'fits')
-        overwrite : bool
-            If True, overwrite `filename` if it exists
-        """
-        raise NotImplementedError("")
+        from .io.core import read
+        cube = read(filename, format=format, hdu=hdu, **kwargs)
+        if isinstance(cube, StokesSpectralCube):
+            return cube
+        else:
+            # a file without Stokes axis holds Stokes I
+            stokes = StokesSpectralCube({'I': cube._data}, cube._wcs,
+                                        mask={'I': cube._mask},
+                                        meta=cube._meta)
+            stokes._file_handle = cube._file_handle
+            return stokes
@@ -0,0 +1,114 @@
+import warnings
+
+import pytest
+import numpy as np
+from numpy.testing import assert_allclose
+
+from .._accumulators import ACCUMULATORS, CountAccumulator
+
+
+def _cube():
+    np.random.seed(0)
+    cube = np.random.random((5, 4, 3))
+    cube[cube > 0.8] = np.nan
+    # a pixel that is blank along the first axis
+    cube[:, 1, 1] = np.nan
+    return cube
+
+
+@pytest.mark.parametrize('function', (np.nansum, np.nanmax, np.nanmin,
+                                      np.nanargmax, np.nanargmin,
+                                      np.nanmean, np.nanvar, np.nanstd))
+def test_matches_numpy(function):
+    cube = _cube()
+    if function in (np.nanargmax, np.nanargmin):
+        # nanargmax and nanargmin fail on all-NaN slices
+        cube[:, 1, 1] = 0.5
+
+    for full in (False, True):
+        accumulator = ACCUMULATORS[function]()
+        for plane in cube:
+            accumulator.update(plane)
+        with warnings.catch_warnings():
+            # numpy warns about the all-NaN slice
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected = function(cube, axis=None if full else 0)
+        assert_allclose(accumulator.result(full=full), expected)
+
+
+@pytest.mark.parametrize('function', sorted(ACCUMULATORS, key=lambda f: f.__name__))
+def test_merge(function):
+    cube = _cube()
+    cube[:, 1, 1] = 0.5
+
+    accumulators = [ACCUMULATORS[function]() for _ in range(3)]
+    for index, plane in enumerate(cube):
+        accumulators[index % 3].update(plane, index)
+
+    merged = ACCUMULATORS[function]()
+    for accumulator in accumulators:
+        merged.merge(accumulator)
+
+    for full in (False, True):
+        assert_allclose(merged.result(full=full),
+                        function(cube, axis=None if full else 0))
+
+    # merging into an empty accumulator copies the state
+    first = accumulators[0].result()
+    merged = ACCUMULATORS[function]()
+    merged.merge(accumulators[0])
+    merged.update(cube[0] + 10, 0)
+    assert_allclose(accumulators[0].result(), first)
+
+
+@pytest.mark.parametrize(('dtype', 'expected'), (('f4', 'f8'), ('f8', 'f8'),
+                                                ('i2', None), ('u1', None)))
+def test_sum_dtype(dtype, expected):
+    # floating point sums are accumulated in double precision, and integer
+    # sums use the same type as numpy
+    cube = np.full((1000, 2, 2), 3.1).astype(dtype)
+    accumulator = ACCUMULATORS[np.nansum]()
+    for plane in cube:
+        accumulator.update(plane)
+    expected = np.dtype(expected or np.sum(cube).dtype)
+    assert accumulator.result().dtype == expected
+    assert_allclose(accumulator.result(),
+                    cube.astype(expected).sum(axis=0), rtol=1e-12)
+    assert_allclose(accumulator.result(full=True),
+                    cube.astype(expected).sum(), rtol=1e-12)
+
+
+def test_variance_ddof():
+    cube = np.random.random((6, 2, 2))
+    accumulator = ACCUMULATORS[np.nanvar](ddof=1)
+    for plane in cube:
+        accumulator.update(plane)
+    assert_allclose(accumulator.result(), np.var(cube, axis=0, ddof=1))
+    assert_allclose(accumulator.result(full=True), np.var(cube, ddof=1))
+
+
+def test_argmax_ties_use_first_occurrence():
+    cube = np.zeros((3, 2, 2))
+    cube[2, 0, 0] = 1
+    cube[1, 1, 1] = 1
+    accumulator = ACCUMULATORS[np.nanargmax]()
+    for plane in cube:
+        accumulator.update(plane)
+    assert accumulator.result(full=True) == np.nanargmax(cube)
+    assert_allclose(accumulator.result(), np.nanargmax(cube, axis=0))
+
+
+def test_count():
+    cube = _cube()
+    accumulator = CountAccumulator()
+    for plane in cube:
+        accumulator.update(plane)
+    assert_allclose(accumulator.result(), np.isfinite(cube).sum(axis=0))
+    assert accumulator.result(full=True) == np.isfinite(cube).sum()
+
+
+def test_empty():
+    with pytest.raises(ValueError) as exc:
+        ACCUMULATORS[np.nansum]().result()
+    assert exc.value.args[0] == "No planes have been accumulated"
+
@@ -0,0 +1,177 @@
+import pytest
+import numpy as np
+
+from .. import SpectralCube, StokesSpectralCube
+from ..io import casa_image
+from ..io.casa_image import CASAArrayWrapper
+from .helpers import assert_allclose
+
+
+class FakeCoordsys(object):
+    # the coordinate system of a RA/Dec/frequency/Stokes image
+
+    def __init__(self, naxes):
+        self._naxes = naxes
+
+    def _quantity(self, values, pw_type):
+        return {'ar_type': 'absolute', 'pw_type': pw_type,
+                'numeric': np.array(values[:self._naxes])}
+
+    def naxes(self):
+        return self._naxes
+
+    def referencepixel(self):
+        return self._quantity([1., 2., 1., 1.], 'pixel')
+
+    def increment(self):
+        return self._quantity([-0.001, 0.001, 1e6, 1.], 'world')
+
+    def referencevalue(self):
+        return self._quantity([23., 30., 1.4e9, 1.], 'world')
+
+    def units(self):
+        return ['deg', 'deg', 'Hz', ''][:self._naxes]
+
+    def names(self):
+        return ['Right Ascension', 'Declination', 'Frequency',
+                'Stokes'][:self._naxes]
+
+    def axiscoordinatetypes(self):
+        return ['Direction', 'Direction', 'Spectral', 'Stokes'][:self._naxes]
+
+    def projection(self):
+        return {'type': 'SIN'}
+
+
+class FakeImageTool(object):
+    """
+    A stand-in for the CASA image tool, holding arrays in the CASA axis
+    order and recording the regions that are read
+    """
+
+    def __init__(self, data, mask):
+        self._data = data
+        self._mask = mask
+        self.chunks = []
+        self.closed = False
+
+    def open(self, filename):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def shape(self):
+        return list(self._data.shape)
+
+    def pixeltype(self):
+        return 'float'
+
+    def coordsys(self):
+        return FakeCoordsys(self._data.ndim)
+
+    def getchunk(self, blc, trc, inc, getmask=False):
+        self.chunks.append((blc, trc, inc, getmask))
+        view = tuple(slice(b, t + 1, i) for b, t, i in zip(blc, trc, inc))
+        return (self._mask if getmask else self._data)[view]
+
+
+def fake_tool(shape):
+    data = np.random.RandomState(0).random_sample(shape).astype('f4')
+    return FakeImageTool(data, data > 0.2)
+
+
+@pytest.mark.parametrize('view', ((), (1,), (slice(1, 3),),
+                                  (slice(None), 2, slice(0, 4, 2)),
+                                  (slice(3, 0, -2), -1), (Ellipsis, 1),
+                                  (slice(4, 2),), (0, 1, 2)))
+def test_array_wrapper(view):
+    tool = fake_tool((5, 4, 3))
+    array = CASAArrayWrapper(tool)
+    expected = tool._data.transpose()
+    assert array.shape == expected.shape
+    assert array.dtype == np.float32
+    assert_allclose(array[view], expected[view])
+
+    mask = CASAArrayWrapper(tool, getmask=True)
+    assert_allclose(mask[view], expected[view] > 0.2)
+
+
+def test_array_wrapper_region():
+    tool = fake_tool((5, 4, 3))
+    array = CASAArrayWrapper(tool, fixed={1: 2})
+    assert array.shape == (3, 5)
+    assert_allclose(array[1, 2:4], tool._data[2:4, 2, 1])
+    assert tool.chunks == [([2, 2, 1], [3, 2, 1], [1, 1, 1], False)]
+
+    # the region is cached
+    array[1, 2:4]
+    assert len(tool.chunks) == 1
+    array = CASAArrayWrapper(tool, cache_size=0)
+    array[1]
+    array[1]
+    assert len(tool.chunks) == 3
+
+
+@pytest.mark.parametrize('axes', ((0, 1, 2), (1, 0, 2), (2, 0, 1)))
+def test_array_wrapper_transpose(axes):
+    tool = fake_tool((5, 4, 3))
+    array = CASAArrayWrapper(tool).transpose(axes)
+    expected = tool._data.transpose().transpose(axes)
+    assert tool.chunks == []
+    assert array.shape == expected.shape
+    for view in ((), (1,), (slice(0, 2), 2), (Ellipsis, slice(None, None, -2)),
+                 (0, 1, 2)):
+        assert_allclose(array[view], expected[view])
+
+    # only the requested region is read
+    array[1, :, 1:2]
+    assert np.prod(np.array(tool.chunks[-1][1]) -
+                   np.array(tool.chunks[-1][0]) + 1) == expected[1, :, 1:2].size
+
+
+@pytest.mark.parametrize('shape', ((5, 4, 3), (5, 4, 3, 1)))
+def test_load_casa_image(monkeypatch, shape):
+    tool = fake_tool(shape)
+    monkeypatch.setattr(casa_image, '_image_tool', lambda: tool)
+
+    cube = SpectralCube.read('fake.image')
+    assert tool.chunks == []
+
+    expected = tool._data.transpose()[(0,) * (len(shape) - 3)]
+    assert cube.shape == expected.shape
+    assert_allclose(cube.filled_data[:],
+                    np.where(expected > 0.2, expected, np.nan))
+    assert_allclose(cube[1:3].sum(axis=0),
+                    np.nansum(np.where(expected > 0.2, expected,
+                                       np.nan)[1:3], axis=0))
+
+    cube.close()
+    assert tool.closed
+
+
+def test_load_casa_image_stokes(monkeypatch):
+    tool = fake_tool((5, 4, 3, 2))
+    monkeypatch.setattr(casa_image, '_image_tool', lambda: tool)
+
+    cube = StokesSpectralCube.read('fake.image')
+    assert cube.components == ['I', 'Q']
+    assert_allclose(cube._data[1], tool._data[:, :, 1, 0].transpose())
+    assert tool.chunks == [([0, 0, 1, 0], [4, 3, 1, 0], [1, 1, 1, 1], False)]
+
+    # the data and masks of all the parameters share one cache
+    assert cube.I._data._cache is cube.Q._data._cache
+    assert cube.I.mask._mask._cache is cube.Q._data._cache
+
+    # SpectralCube.read gives Stokes I
+    cube = SpectralCube.read('fake.image')
+    assert type(cube) is SpectralCube
+    assert_allclose(cube._data[1], tool._data[:, :, 1, 0].transpose())
+
+
+def test_load_casa_image_deprecated(monkeypatch):
+    from astropy.utils.exceptions import AstropyDeprecationWarning
+    tool = fake_tool((5, 4, 3))
+    monkeypatch.setattr(casa_image, '_image_tool', lambda: tool)
+    with pytest.warns(AstropyDeprecationWarning):
+        SpectralCube.read('fake.image', skipdata=True)
@@ -0,0 +1,137 @@
+import pytest
+import numpy as np
+from astropy import units as u
+
+from .. import SpectralCube, set_memory_limit, get_memory_limit
+from .. import cube_utils
+from . import path
+from .helpers import assert_allclose
+
+
+@pytest.fixture
+def memory_limit(request):
+    previous = get_memory_limit()
+    request.addfinalizer(lambda: set_memory_limit(previous))
+    return set_memory_limit
+
+
+@pytest.mark.parametrize(('limit', 'expected'),
+                         ((1000, 1000),
+                          ('8GB', 8000000000),
+                          ('2 KiB', 2048),
+                          (3 * u.MB, 3000000)))
+def test_set_memory_limit(memory_limit, limit, expected):
+    memory_limit(limit)
+    assert get_memory_limit() == expected
+
+
+def test_set_memory_limit_invalid(memory_limit):
+    with pytest.raises(ValueError) as exc:
+        memory_limit(0)
+    assert exc.value.args[0] == "The memory limit should be positive"
+
+
+def _cube(data):
+    cube = SpectralCube.read(path('adv.fits'))
+    return SpectralCube(data, cube._wcs)
+
+
+def test_iterator_strategy(memory_limit):
+    cube = _cube(np.zeros((8, 3, 2)))
+    costs = cube_utils.strategy_costs(cube, axis=0)
+    assert costs['cube'][0] > costs['slice'][0] > costs['ray'][0]
+    assert costs['cube'][1] == 0
+
+    assert cube_utils.iterator_strategy(cube, axis=0) == 'cube'
+    memory_limit(costs['slice'][0])
+    assert cube_utils.iterator_strategy(cube, axis=0) == 'slice'
+    memory_limit(costs['ray'][0])
+    assert cube_utils.iterator_strategy(cube, axis=0) == 'ray'
+    memory_limit(1)
+    assert cube_utils.iterator_strategy(cube, axis=0) == 'ray'
+
+
+def test_iterator_strategy_memmap(memory_limit, tmpdir):
+    data = np.memmap(str(tmpdir.join('data.dat')), dtype='>f8', mode='w+',
+                     shape=(8, 32, 32))
+    cube = _cube(data)
+    assert cube_utils.is_memmapped(cube._data)
+    assert not cube_utils.is_memmapped(np.zeros(3))
+
+    # slices along the last axis are not contiguous on disk, so rays read
+    # less data when the cube does not fit in memory
+    costs = cube_utils.strategy_costs(cube, axis=2)
+    assert costs['slice'][1] > costs['ray'][1] == cube._data.nbytes
+    memory_limit(costs['cube'][0] - 1)
+    assert cube_utils.iterator_strategy(cube, axis=2) == 'ray'
+    assert cube_utils.iterator_strategy(cube, axis=0) == 'slice'
+
+
+def test_block_size(memory_limit):
+    cube = SpectralCube.read(path('adv.fits'))
+    per_element = cube_utils.element_bytes(cube)
+    memory_limit(per_element * 10)
+    assert cube_utils.block_size(cube) == 10
+    assert cube_utils.block_size(cube, n_workers=2) == 5
+    assert cube_utils.block_size(cube, min_blocks=4) == 6
+    memory_limit(1)
+    assert cube_utils.block_size(cube) == 1
+
+
+@pytest.mark.parametrize('axis', (None, 0, 1, 2))
+def test_reductions_within_limit(memory_limit, axis):
+    cube = SpectralCube.read(path('adv.fits'))
+    expected = [cube.sum(axis=axis, how='cube'),
+                cube.argmax(axis=axis, how='cube')]
+
+    memory_limit(1)
+    assert_allclose(cube.sum(axis=axis), expected[0])
+    assert_allclose(cube.argmax(axis=axis), expected[1])
+    assert_allclose(cube.median(axis=0), np.median(cube._data, axis=0))
+
+
+def test_compact_coordinates():
+    cube = SpectralCube.read(path('adv.fits'))
+    nv, ny, nx = cube.shape
+    for arrays in (cube._pix_cen(), cube._pix_size()):
+        assert [a.shape for a in arrays] == [(nv, 1, 1), (1, ny, nx),
+                                             (1, ny, nx)]
+
+
+@pytest.mark.parametrize('view', ((1,), (slice(None), 2), (slice(1, 3), 0, 1),
+                                  (slice(None), slice(None), 0)))
+def test_broadcast_view(view):
+    shape = (4, 3, 2)
+    array = np.arange(4.).reshape((4, 1, 1))
+    full = cube_utils.broadcast_to(array, shape)
+    result = cube_utils.broadcast_view(array, view, shape)
+    assert result.size <= 4
+    assert_allclose(cube_utils.broadcast_to(result, full[view].shape),
+                    full[view])
+
+
+@pytest.mark.parametrize('numpy_broadcast_to', (True, False))
+def test_broadcast_to(monkeypatch, numpy_broadcast_to):
+    if not numpy_broadcast_to:
+        # the fallback used with numpy < 1.10
+        monkeypatch.delattr(np, 'broadcast_to', raising=False)
+    array = np.arange(3.).reshape((3, 1))
+    result = cube_utils.broadcast_to(array, (2, 3, 4))
+    assert result.shape == (2, 3, 4)
+    assert not result.flags.writeable
+    assert_allclose(result, array[None] + np.zeros((2, 3, 4)))
+    with pytest.raises(ValueError):
+        cube_utils.broadcast_to(array, (4,))
+
+
+@pytest.mark.parametrize('size', (1, 4, 12, 30, 100))
+def test_contiguous_views(size):
+    shape = (4, 3, 5)
+    data = np.arange(60).reshape(shape)
+    views = cube_utils.contiguous_views(shape, size)
+    # the blocks are contiguous, in order, and cover the array once
+    flat = np.concatenate([data[view].ravel() for view in views])
+    assert_allclose(flat, np.arange(60))
+    for view in views:
+        assert data[view].flags.c_contiguous
+        assert data[view].size <= max(size, 5)
@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+
+from .. import SpectralCube, BooleanArrayMask, FunctionMask
+from . import path
+from .helpers import assert_allclose
+from .test_moments import moment_cube
+
+da = pytest.importorskip('dask.array')
+
+from ..dask_spectral_cube import DaskSpectralCube
+
+
+def _cubes():
+    cube = SpectralCube.read(path('adv.fits'))
+    mask = BooleanArrayMask(cube._data > 0.3, cube._wcs)
+    cube = cube.with_mask(mask)
+    return cube, DaskSpectralCube.from_cube(cube, chunks=(2, 2, 1))
+
+
+def test_lazy():
+    cube, dcube = _cubes()
+    assert isinstance(dcube._data, da.Array)
+    assert dcube._data.chunks == ((2, 2), (2, 1), (1, 1))
+    assert isinstance(dcube._get_lazy_filled_data(), da.Array)
+    assert isinstance(dcube._mask.include(data=dcube._data,
+                                          wcs=dcube._wcs), da.Array)
+
+    # derived cubes are also backed by dask
+    assert isinstance(dcube[:2, :, :], DaskSpectralCube)
+    assert isinstance(dcube.with_mask(dcube > 0.5), DaskSpectralCube)
+
+
+@pytest.mark.parametrize('method', ('sum', 'max', 'min', 'argmax',
+                                    'argmin', 'median'))
+@pytest.mark.parametrize('axis', (None, 0, 1, 2))
+def test_reductions(method, axis):
+    cube, dcube = _cubes()
+    expected = getattr(cube, method)(axis=axis)
+    assert_allclose(getattr(dcube, method)(axis=axis), expected)
+
+
+def test_data_access():
+    cube, dcube = _cubes()
+    assert_allclose(dcube.filled_data[:], cube.filled_data[:])
+    assert_allclose(dcube.unmasked_data[1:, 0], cube.unmasked_data[1:, 0])
+    assert_allclose(dcube.flattened(), cube.flattened())
+    assert_allclose(dcube.get_mask_array(), cube.get_mask_array())
+    assert_allclose(dcube.percentile(30, axis=1), cube.percentile(30, axis=1))
+
+
+def test_no_mask():
+    # all elements are included in cubes without a mask
+    cube, _ = _cubes()
+    dcube = DaskSpectralCube(cube._data, cube._wcs, chunks=(2, 2, 1))
+    assert dcube._mask is None
+    assert dcube.get_mask_array().all()
+    assert_allclose(dcube.flattened().value, cube._data.ravel())
+    assert_allclose(dcube.median(axis=0).value,
+                    np.median(cube._data, axis=0))
+    assert_allclose(dcube.sum(axis=1).value, cube._data.sum(axis=1))
+
+
+def test_function_mask():
+    cube, dcube = _cubes()
+    mask = FunctionMask(lambda data, wcs, view: data[view] < 0.8)
+    assert_allclose(dcube.with_mask(mask).sum(axis=0),
+                    cube.with_mask(mask).sum(axis=0))
+
+
+@pytest.mark.parametrize('scheduler', ('threads', 'synchronous'))
+def test_scheduler(scheduler):
+    cube, dcube = _cubes()
+    dcube = DaskSpectralCube.from_cube(cube, scheduler=scheduler)
+    assert_allclose(dcube.sum(axis=0, n_workers=2), cube.sum(axis=0))
+
+
+@pytest.mark.parametrize('axis', (0, 1, 2))
+def test_moments(axis):
+    cube = SpectralCube.read(moment_cube())
+    dcube = DaskSpectralCube.from_cube(cube, chunks=(2, 2, 2))
+    expected = cube.moments(axis=axis)
+    for result, order in zip(dcube.moments(axis=axis), (0, 1, 2)):
+        assert_allclose(result, expected[order])
+        assert_allclose(dcube.moment(order, axis=axis), expected[order])
+
+
+def test_read():
+    cube = SpectralCube.read(path('adv.fits'))
+    with DaskSpectralCube.read(path('adv.fits'), memmap=True) as dcube:
+        assert_allclose(dcube.max(axis=0), cube.max(axis=0))
@@ -6,7 +6,8 @@ from astropy import units as u
 
 from .test_spectral_cube import cube_and_raw
 from .. import (BooleanArrayMask, SpectralCube, LazyMask,
-                FunctionMask, CompositeMask)
+                FunctionMask, CompositeMask, InvertedMask)
+from ..masks import MaskBase
 
 
 def test_spectral_cube_mask():
@@ -239,3 +240,355 @@ def test_mask_spectral_unit_functions():
 
     # this one should fail
     #failedmask = CompositeMask(mask_freq1,mask2)
+
+
+@pytest.mark.parametrize('packed', (False, True))
+def test_lazy_mask_cache(packed):
+
+    data = np.arange(60).reshape((3, 4, 5))
+    wcs = WCS(naxis=3)
+    calls = []
+
+    def threshold(x):
+        calls.append(x.shape)
+        return x > 20
+
+    m = LazyMask(threshold, data=data, wcs=wcs, cache_size='1 kB',
+                 packed=packed)
+
+    view = (slice(1, 3), 0, slice(None, None, 2))
+    assert_allclose(m.include(data, wcs, view=view), (data > 20)[view])
+    assert_allclose(m.include(data, wcs, view=[slice(1, 3), 0, slice(0, 5, 2)]),
+                    (data > 20)[view])
+    assert len(calls) == 1
+
+    # once the full mask is cached, it is used for any view
+    assert_allclose(m.include(data, wcs), data > 20)
+    assert_allclose(m.include(data, wcs, view=(2, slice(1, 3))),
+                    (data > 20)[2, 1:3])
+    assert_allclose(m.exclude(data, wcs, view=(0,)), (data <= 20)[0])
+    assert len(calls) == 2
+
+    # cached masks cannot be modified by accident
+    if not packed:
+        with pytest.raises(ValueError):
+            m.include(data, wcs)[0, 0, 0] = True
+
+    m.clear_cache()
+    m.include(data, wcs)
+    assert len(calls) == 3
+
+    m.set_cache(None)
+    m.include(data, wcs)
+    assert len(calls) == 4
+
+
+@pytest.mark.parametrize('packed', (False, True))
+def test_mask_cache_eviction(packed):
+    from ..masks import _MaskCache
+
+    shape = (4, 4, 16)
+    plane = 16 * 4 // (8 if packed else 1)
+    cache = _MaskCache(shape, max_bytes=2 * plane, packed=packed)
+    masks = [np.random.random(shape[1:]) > 0.5 for _ in range(shape[0])]
+
+    cache.put((0,), masks[0])
+    cache.put((1,), masks[1])
+    assert cache.nbytes == 2 * plane
+
+    # plane 0 becomes the most recently used, so plane 1 is evicted
+    assert_allclose(cache.get((0,)), masks[0])
+    cache.put((2,), masks[2])
+    assert len(cache) == 2
+    assert cache.get((1,)) is None
+    assert_allclose(cache.get((2, slice(None), slice(None))), masks[2])
+
+    # entries larger than the budget are not cached
+    cache.put((), np.ones(shape, dtype=bool))
+    assert cache.get(()) is None
+    assert cache.get(([0, 1],)) is None
+    assert cache.nbytes == 2 * plane
+
+
+def test_lazy_mask_cache_spectral_unit():
+    cube, data = cube_and_raw('adv.fits')
+    mask = LazyMask(np.isfinite, cube=cube, cache_size=10 ** 6)
+    mask.include(cube._data, cube._wcs)
+    assert mask.with_spectral_unit(u.Hz)._cache is mask._cache
+    assert mask[0:2, :, :]._cache._max_bytes == 10 ** 6
+
+
+def test_lazy_mask_cache_slices():
+    # slices share the cache of the full mask, so that its budget bounds
+    # the memory used by all of them
+    cube, data = cube_and_raw('adv.fits')
+    calls = []
+
+    def function(values):
+        calls.append(values.shape)
+        return values > 0.5
+
+    mask = LazyMask(function, cube=cube, cache_size=10 ** 6)
+    sliced = mask[1:3, :, 1:]
+    subslice = sliced[:, 1:, :]
+    expected = data[1:3, 1:, 1:] > 0.5
+    assert expected.size > 0
+
+    assert_allclose(subslice.include(data[1:3, 1:, 1:], subslice._wcs),
+                    expected)
+    # the entry is keyed by its view of the full mask
+    assert list(mask._cache._entries) == [((1, 3, 1), (1, 3, 1), (1, 2, 1))]
+    assert_allclose(mask._cache.get((slice(1, 3), slice(1, 3), slice(1, 2))),
+                    expected)
+    assert_allclose(sliced._cache.get((slice(None), slice(1, None))),
+                    expected)
+
+    # the full mask is used by all slices
+    mask.include(data, cube._wcs)
+    ncalls = len(calls)
+    assert_allclose(subslice.include(data[1:3, 1:, 1:], subslice._wcs,
+                                     view=(1,)), expected[1])
+    assert len(calls) == ncalls
+
+    sliced.clear_cache()
+    assert len(mask._cache) == 0
+
+
+def test_mask_cache_threads():
+    # slices evaluated by several threads update the shared cache safely
+    from multiprocessing.pool import ThreadPool
+    from ..masks import _MaskCache
+
+    shape = (50, 4, 4)
+    cache = _MaskCache(shape, max_bytes=10 * 16)
+    masks = np.random.random(shape) > 0.5
+    sliced = [cache.sliced((slice(i, i + 1),)) for i in range(shape[0])]
+
+    def use(i):
+        for _ in range(20):
+            sliced[i].put((), masks[i:i + 1])
+            cached = sliced[i].get(())
+            if cached is not None:
+                assert_allclose(cached, masks[i:i + 1])
+
+    pool = ThreadPool(4)
+    try:
+        pool.map(use, range(shape[0]))
+    finally:
+        pool.close()
+        pool.join()
+    assert cache.nbytes == sum(e.nbytes for e in cache._entries.values())
+    assert cache.nbytes <= 10 * 16
+
+
+@pytest.mark.parametrize(('base', 'view'), (
+    (np.s_[1:3, :, 2:], np.s_[1, ::2]),
+    (np.s_[::-1, 2, 1:8:3], np.s_[1:, -1]),
+    (np.s_[:, ::-2], np.s_[:, 3::-1, 0]),
+    (np.s_[4:1:-1], np.s_[5:]),
+    (np.s_[0, 1], np.s_[...])))
+def test_compose_view(base, view):
+    from ..masks import _compose_view, _view_key
+
+    array = np.arange(4 * 5 * 6).reshape((4, 5, 6))
+    composed = _compose_view(_view_key(base, array.shape), view)
+    if view is Ellipsis:
+        assert composed is None
+    else:
+        assert_allclose(array[composed], array[base][view])
+
+
+@pytest.mark.parametrize('view', (np.s_[:], np.s_[1, :, 3:17:2],
+                                  np.s_[:, 2, ::-3], np.s_[..., 5],
+                                  np.s_[2, 1, 19], np.s_[:, :, -1],
+                                  np.s_[:, :, 8:], np.s_[:, :, 3:3],
+                                  np.s_[[0, 2]]))
+def test_packed_array(view):
+    from ..masks import _PackedBooleanArray
+
+    mask = np.random.random((3, 4, 21)) > 0.5
+    packed = _PackedBooleanArray.pack(mask)
+    assert packed.shape == mask.shape
+    assert packed.nbytes == 3 * 4 * 3
+
+    assert_allclose(packed[view], mask[view])
+    if mask[view].ndim > 0:
+        assert_allclose(np.asarray(packed.sliced(view)), mask[view])
+    assert_allclose((~packed)[view], ~mask[view])
+
+
+def test_packed_mask():
+    data = np.random.random((3, 4, 21))
+    wcs = WCS(naxis=3)
+    m1 = BooleanArrayMask(data > 0.3, wcs, packed=True)
+    m2 = BooleanArrayMask(data < 0.8, wcs, include=False, packed=True)
+    assert m1.packed and m1.shape == data.shape
+
+    view = (slice(1, 3), 2, slice(2, 20, 3))
+    assert_allclose(m1.include(data, wcs, view=view), (data > 0.3)[view])
+    assert_allclose(m2.exclude(data, wcs, view=view), (data < 0.8)[view])
+    assert_allclose(m1._filled(data, wcs), np.where(data > 0.3, data, np.nan))
+
+    # combinations of packed masks are packed masks
+    for combined, expected in ((m1 & m2, (data > 0.3) & (data >= 0.8)),
+                               (m1 | m2, (data > 0.3) | (data >= 0.8)),
+                               (~m1 & ~m2, (data <= 0.3) & (data < 0.8))):
+        assert isinstance(combined, BooleanArrayMask) and combined.packed
+        assert_allclose(combined.include(data, wcs), expected)
+
+    # combinations with other masks fall back to CompositeMask
+    m3 = m1 & BooleanArrayMask(data < 0.5, wcs)
+    assert isinstance(m3, CompositeMask)
+    assert_allclose(m3.include(data, wcs), (data > 0.3) & (data < 0.5))
+
+    sliced = m2[1:, :, 8:]
+    assert sliced.packed
+    assert_allclose(sliced.exclude(data[1:, :, 8:], sliced._wcs),
+                    (data < 0.8)[1:, :, 8:])
+
+
+def _random_masks():
+    np.random.seed(1)
+    data = np.random.random((3, 4, 5))
+    wcs = WCS(naxis=3)
+    a = LazyMask(lambda x: x > 0.2, data=data, wcs=wcs)
+    b = BooleanArrayMask(data < 0.9, wcs)
+    c = LazyMask(lambda x: x < 0.5, data=data, wcs=wcs, cache_size=10 ** 6)
+    d = FunctionMask(lambda data, wcs, view: data[view] > 0.7)
+    return data, wcs, (a, b, c, d)
+
+
+@pytest.mark.parametrize('view', ((), (1,), (slice(0, 2), 2, slice(None, None, 2))))
+def test_composite_mask_trees(view):
+    data, wcs, (a, b, c, d) = _random_masks()
+    ea, eb, ec, ed = data > 0.2, data < 0.9, data < 0.5, data > 0.7
+    b_array = b._mask.copy()
+
+    trees = [(a & b & ~c, ea & eb & ~ec),
+             (~(a | c) & b, ~(ea | ec) & eb),
+             ((a | d) & ~(~b & c), (ea | ed) & ~(~eb & ec)),
+             (~(a & (b | ~d)) | c, ~(ea & (eb | ~ed)) | ec),
+             (InvertedMask(InvertedMask(b)) | ~c, eb | ~ec)]
+
+    for mask, expected in trees:
+        assert_allclose(mask.include(data, wcs, view=view), expected[view])
+        assert_allclose(mask.exclude(data, wcs, view=view), ~expected[view])
+
+        # the result is written directly to the output array
+        out = np.zeros(expected[view].shape, dtype=bool)
+        assert mask.include(data, wcs, view=view, out=out) is out
+        assert_allclose(out, expected[view])
+        assert mask.exclude(data, wcs, view=view, out=out) is out
+        assert_allclose(out, ~expected[view])
+
+    # the arrays of the child masks are not modified
+    assert_allclose(b._mask, b_array)
+
+
+def test_composite_mask_user_arrays():
+    # arrays returned by user functions are never modified in place
+    data, wcs, (a, b, c, d) = _random_masks()
+    stored = data > 0.5
+    expected = stored.copy()
+    lazy = LazyMask(lambda x: stored, data=data, wcs=wcs)
+    function = FunctionMask(lambda data, wcs, view: stored[view])
+
+    for mask in (~lazy, ~lazy & a, ~(lazy | b), lazy & b, ~function | c,
+                 InvertedMask(function & d)):
+        mask.include(data, wcs)
+        assert_allclose(stored, expected)
+        mask.exclude(data, wcs)
+        assert_allclose(stored, expected)
+
+
+def test_composite_mask_flatten():
+    data, wcs, (a, b, c, d) = _random_masks()
+    mask = (a & b) & ~(c | ~d)
+    assert mask._flatten('and') == [(a, False), (b, False),
+                                    (c, True), (d, False)]
+    # an inverted 'or' is an 'and', so it is not flattened into an 'or'
+    mask = a | ~(b | c)
+    assert mask._flatten('or') == [(a, False), (mask._mask2._mask, True)]
+
+
+def test_composite_mask_short_circuit():
+    data = np.arange(60.).reshape((3, 4, 5))
+    wcs = WCS(naxis=3)
+    calls = []
+
+    def threshold(x):
+        calls.append(x.shape)
+        return x > 3
+
+    lazy = LazyMask(threshold, data=data, wcs=wcs)
+    empty = BooleanArrayMask(np.zeros(data.shape, dtype=bool), wcs)
+
+    # the array mask is evaluated first, and is all False
+    assert not (lazy & empty).include(data, wcs).any()
+    assert (lazy | ~empty).include(data, wcs).all()
+    assert calls == []
+
+    assert_allclose((lazy & ~empty).include(data, wcs), data > 3)
+    assert calls == [data.shape]
+
+
+@pytest.mark.parametrize(('dtype', 'expected'),
+                         (('>f4', np.float32), ('<f4', np.float32),
+                          ('>f8', np.float64), ('i2', np.float32),
+                          ('i8', np.float64)))
+def test_filled_dtype(dtype, expected):
+    data = np.arange(60).reshape((3, 4, 5)).astype(dtype)
+    wcs = WCS(naxis=3)
+    mask = BooleanArrayMask(data > 10, wcs)
+
+    filled = mask._filled(data, wcs)
+    assert filled.dtype == expected
+    assert filled.dtype.isnative
+    assert_allclose(filled, np.where(data > 10, data, np.nan))
+
+    # the output can also be written to an existing array
+    out = np.zeros((4, 5), dtype=np.float32)
+    assert mask._filled(data, wcs, fill=-1, view=(1,), out=out) is out
+    assert_allclose(out, np.where(data[1] > 10, data[1], -1))
+
+    out = np.zeros((3, 5), dtype=bool)
+    assert mask.include(data, wcs, view=(slice(None), 2), out=out) is out
+    assert_allclose(out, data[:, 2] > 10)
+    assert mask.exclude(data, wcs, view=(slice(None), 2), out=out) is out
+    assert_allclose(out, data[:, 2] <= 10)
+
+
+def test_filled_float32_cube():
+    cube, data = cube_and_raw('adv.fits')
+    data = data.astype('>f4')
+    cube = SpectralCube(data, cube.wcs,
+                        mask=BooleanArrayMask(data > 0.5, cube.wcs))
+    assert cube.filled_data[:].dtype == np.float32
+    assert cube.sum(axis=0).dtype == np.float32
+    assert cube.max(axis=0, how='slice').dtype == np.float32
+
+
+def test_mask_slicing_not_implemented():
+
+    class CustomMask(MaskBase):
+        def _include(self, data=None, wcs=None, view=()):
+            return np.ones(data[view].shape, dtype=bool)
+
+    with pytest.raises(NotImplementedError) as exc:
+        CustomMask()[0:1]
+    assert exc.value.args[0] == "Slicing not supported by mask class CustomMask"
+
+
+def test_mask_slicing_lazy_wcs():
+    cube, data = cube_and_raw('adv.fits')
+    mask = LazyMask(lambda x: x > 0.5, cube=cube)
+    view = (slice(1, 3), slice(None), slice(1, 2))
+
+    sliced = mask[view][:, 1:, :]
+    assert sliced._wcs._wcs is None
+
+    sub = cube[view][:, 1:, :]
+    assert_allclose(sliced.include(data=sub._data, wcs=sub.wcs),
+                    data[1:3, 1:, 1:2] > 0.5)
+    # the WCS is validated without being computed
+    assert sliced._wcs._wcs is None
@@ -6,6 +6,7 @@ from astropy import units as u
 from astropy.io import fits
 
 from ..spectral_cube import SpectralCube
+from ..cube_utils import get_memory_limit, set_memory_limit
 from .helpers import assert_allclose
 
 # the back of the book
@@ -103,6 +104,25 @@ def test_consistent_mask_handling(axis, order):
     assert_allclose(cwise, rwise)
 
 
+@pytest.mark.parametrize('axis', (0, 1, 2))
+def test_raywise_blocks(axis):
+    mc_hdu = moment_cube()
+    sc = SpectralCube.read(mc_hdu)
+    sc._mask = sc > 4
+    expected = sc.moments(orders=(0, 1, 2), axis=axis, how='cube')
+
+    # one ray per block
+    previous = get_memory_limit()
+    set_memory_limit(1)
+    try:
+        moments = sc.moments(orders=(0, 1, 2), axis=axis, how='ray')
+    finally:
+        set_memory_limit(previous)
+
+    for mom, ref in zip(moments, expected):
+        assert_allclose(mom, ref)
+
+
 def test_convenience_methods():
     mc_hdu = moment_cube()
     sc = SpectralCube.read(mc_hdu)
@@ -110,3 +130,32 @@ def test_convenience_methods():
     assert_allclose(sc.moment0(axis=0), MOMENTS[0][0])
     assert_allclose(sc.moment1(axis=2), MOMENTS[1][2])
     assert_allclose(sc.moment2(axis=1), MOMENTS[2][1])
+
+
+@pytest.mark.parametrize(('axis', 'how'),
+                         [(a, h) for a in [0, 1, 2]
+                          for h in ['cube', 'slice', 'auto', 'ray']])
+def test_moments_single_pass(axis, how):
+    mc_hdu = moment_cube()
+    sc = SpectralCube.read(mc_hdu)
+    sc._mask = sc > 4
+
+    moments = sc.moments(orders=(0, 1, 2, 3), axis=axis, how=how)
+    assert len(moments) == 4
+    for order, mom in enumerate(moments):
+        assert_allclose(mom, sc.moment(order=order, axis=axis, how='ray'))
+        assert mom.meta['moment_order'] == order
+
+
+def test_moments_reference():
+    mc_hdu = moment_cube()
+    sc = SpectralCube.read(mc_hdu)
+    m2, m0 = sc.moments(orders=(2, 0), how='slice')
+    assert_allclose(m2, MOMENTS[2][0])
+    assert_allclose(m0, MOMENTS[0][0])
+
+
+def test_moments_invalid_how():
+    sc = SpectralCube.read(moment_cube())
+    with pytest.raises(ValueError):
+        sc.moments(how='wrong')
@@ -1,6 +1,12 @@
+import sys
 import pytest
 import operator
 import itertools
+import mmap
+import gc
+import weakref
+import warnings
+import threading
 
 from astropy.io import fits
 from astropy import units as u
@@ -8,6 +14,9 @@ from astropy.wcs import WCS
 import numpy as np
 
 from .. import SpectralCube, BooleanArrayMask, FunctionMask, LazyMask, CompositeMask
+from .. import clear_cache, set_memory_limit, get_memory_limit
+from .. import wcs_utils, cube_utils
+from ..spectral_cube import _RESULT_CACHE
 
 from . import path
 from .helpers import assert_allclose
@@ -55,12 +64,24 @@ class TestSpectralCube(object):
                              ('adv.fits', np.s_[:, :,:]),
                              ('adv.fits', np.s_[::2, :, :2]),
                              ('adv.fits', np.s_[0]),
+                             ('adv.fits', np.s_[:, 1]),
+                             ('adv.fits', np.s_[-1, 1:3, 0]),
+                             ('adv.fits', np.s_[[0, 2]]),
+                             ('coupled', np.s_[:, :, :]),
+                             ('coupled', np.s_[1, ::2]),
                              ))
     def test_world(self, file, view):
-        p = path(file)
+        if file == 'coupled':
+            # the spectral coordinates depend on the position
+            p = path('adv.fits')
+            wcs = WCS(p)
+            wcs.wcs.pc = [[1, 0, 0], [0, 1, 0], [0.1, 0.2, 1]]
+        else:
+            p = path(file)
+            wcs = WCS(p)
         d = fits.getdata(p)
-        wcs = WCS(p)
         c = SpectralCube(d, wcs)
+        assert wcs_utils.is_spectrally_separable(c.wcs) == (file != 'coupled')
 
         shp = d.shape
         inds = np.indices(d.shape)
@@ -75,6 +96,16 @@ class TestSpectralCube(object):
         for result, expected in zip(w2, world):
             assert_allclose(result, expected)
 
+    @pytest.mark.parametrize('block_size', (None, 4))
+    def test_iter_world(self, block_size):
+        c, d = cube_and_raw('adv.fits')
+        world = [np.zeros(d.shape) for _ in range(3)]
+        for view, block in c.iter_world(block_size=block_size):
+            for result, coords in zip(world, block):
+                result[view] = coords.value
+        for result, expected in zip(world, c.world[:, :, :]):
+            assert_allclose(result, expected.value)
+
     @pytest.mark.parametrize('view', (np.s_[:, :,:],
                              np.s_[:2, :3, ::2]))
     def test_world_transposes_3d(self, view):
@@ -170,7 +201,7 @@ class TestNumpyMethods(BaseTest):
         for axis in [None, 0, 1, 2]:
             for how in ['auto', 'slice', 'cube', 'ray']:
                 expected = func(array, axis=axis)
-                actual = cubemethod(axis=axis)
+                actual = cubemethod(axis=axis, how=how)
                 assert_allclose(actual, expected)
 
     def test_sum(self):
@@ -211,6 +242,78 @@ class TestNumpyMethods(BaseTest):
                 m[y, x] = np.percentile(ray, 3)
         assert_allclose(self.c.percentile(3, axis=0), m)
 
+    @pytest.mark.parametrize('axis', (0, 1, 2))
+    def test_median_percentile_no_mask(self, axis):
+        # cubes without a mask include every value
+        cube = SpectralCube(self.d, self.c._wcs)
+        assert cube._mask is None
+        assert_allclose(cube.median(axis=axis), np.median(self.d, axis=axis))
+        assert_allclose(cube.percentile(30, axis=axis),
+                        np.percentile(self.d, 30, axis=axis))
+
+    @pytest.mark.parametrize('axis', (0, 1, 2))
+    def test_apply_along_axes_per_ray(self, axis):
+        # functions without a nan-aware equivalent are applied ray by ray
+        expected = self.c._apply_along_axes(np.percentile, q=30, axis=axis)
+        actual = self.c._apply_along_axes(lambda x: np.percentile(x, 30),
+                                          axis=axis)
+        assert_allclose(actual, expected)
+
+    def test_apply_along_axes_weights(self):
+        expected = self.c._apply_along_axes(lambda x: np.median(x), axis=0,
+                                            weights=self.d)
+        actual = self.c._apply_along_axes(np.median, axis=0, weights=self.d)
+        assert_allclose(actual, expected)
+
+    @pytest.mark.parametrize('axis', (0, 1, 2))
+    def test_iter_ray_blocks(self, axis):
+        nx, ny = self.c._get_flat_shape(axis)
+        counts = np.zeros((nx, ny), dtype=int)
+        for xslc, yslc, view in self.c._iter_ray_blocks(axis, block_size=5):
+            assert view[axis] == slice(None)
+            counts[xslc, yslc] += 1
+        assert np.all(counts == 1)
+
+    @pytest.mark.parametrize('method', ('sum', 'min', 'max',
+                             'median', 'argmin', 'argmax'))
+    def test_parallel(self, method):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(2)
+        try:
+            for axis in [None, 0, 1, 2]:
+                expected = getattr(self.c, method)(axis=axis)
+                assert_allclose(getattr(self.c, method)(axis=axis, n_workers=2),
+                                expected)
+                assert_allclose(getattr(self.c, method)(axis=axis, executor=pool),
+                                expected)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_parallel_processes(self):
+        # only the slabs are sent to the processes
+        from multiprocessing import Pool
+        pool = Pool(2)
+        try:
+            for axis in [None, 0, 1, 2]:
+                assert_allclose(self.c.sum(axis=axis, executor=pool),
+                                self.c.sum(axis=axis))
+            assert_allclose(self.c.median(axis=1, executor=pool),
+                            self.c.median(axis=1))
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_parallel_serial_warning(self):
+        # Python 2 does not show a warning again once it is in the registry
+        # of the module that issued it, even with the 'always' filter
+        module = sys.modules[SpectralCube.__module__]
+        module.__dict__.pop('__warningregistry__', None)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            assert_allclose(self.c.median(n_workers=2), self.c.median())
+        assert any('serially' in str(x.message) for x in w)
+
     @pytest.mark.parametrize('method', ('sum', 'min', 'max',
                              'median', 'argmin', 'argmax'))
     def test_transpose(self, method):
@@ -295,6 +398,348 @@ def test_read_write_rountrip(tmpdir):
     assert cube._wcs.to_header_string() == cube2._wcs.to_header_string()
 
 
+def test_write_chunked(tmpdir):
+    cube = SpectralCube.read(path('adv.fits'))
+    cube = cube.with_mask(cube > 0.5).with_fill_value(-1.)
+    tmp_file = str(tmpdir.join('test.fits'))
+
+    # a few elements at a time, from a memory-mapped cube
+    with SpectralCube.read(path('adv.fits'), memmap=True) as mapped:
+        mapped = mapped.with_mask(mapped > 0.5).with_fill_value(-1.)
+        mapped.write(tmp_file, chunksize=5)
+    data = fits.getdata(tmp_file)
+    assert_allclose(data, cube.filled_data[:].value)
+    # the masked values are written as the fill value
+    mask = cube._data > 0.5
+    assert not mask.all()
+    assert np.all(data[~mask] == -1)
+    assert_allclose(data[mask], cube._data[mask])
+
+    with pytest.raises(IOError):
+        cube.write(tmp_file)
+
+    cube.write(tmp_file, overwrite=True, apply_mask=False)
+    assert_allclose(fits.getdata(tmp_file), cube._data)
+
+
+def test_write_blank(tmpdir):
+    cube = SpectralCube.read(path('adv.fits'))
+    data = (cube._data * 100).astype('>i2')
+    cube = SpectralCube(data, cube._wcs,
+                        mask=BooleanArrayMask(data > 50, cube._wcs))
+    tmp_file = str(tmpdir.join('test.fits'))
+
+    with pytest.raises(TypeError):
+        SpectralCube.read(path('adv.fits')).write(tmp_file, blank=0)
+    cube.write(tmp_file, blank=-1)
+    hdu = fits.open(tmp_file, do_not_scale_image_data=True)[0]
+    assert hdu.header['BLANK'] == -1
+    assert hdu.data.dtype.kind == 'i'
+    assert_allclose(hdu.data, np.where(data > 50, data, -1))
+
+    # astropy replaces the blank values by NaN
+    assert_allclose(SpectralCube.read(tmp_file).filled_data[:].value,
+                    np.where(data > 50, data, np.nan))
+
+
+@pytest.mark.parametrize('dtype', ('>u2', '<u4'))
+def test_write_unsigned(tmpdir, dtype):
+    cube = SpectralCube.read(path('adv.fits'))
+    data = (cube._data * 60000).astype(dtype)
+    cube = SpectralCube(data, cube._wcs)
+    tmp_file = str(tmpdir.join('test.fits'))
+    cube.write(tmp_file, chunksize=5)
+
+    hdu = fits.open(tmp_file)[0]
+    assert hdu.header['BZERO'] == 2 ** (8 * data.dtype.itemsize - 1)
+    assert hdu.data.dtype.kind == 'u'
+    assert_allclose(hdu.data, data)
+    assert_allclose(SpectralCube.read(tmp_file)._data, data)
+
+
+@pytest.mark.parametrize(('options', 'dtype'), (
+    (dict(compression_type='GZIP_1', quantize_level=0, tile_shape=(2, 8, 9)),
+     'f4'),
+    (dict(compression_type='RICE_1', tile_shape=(3, 4, 9)), 'i2'),
+    (dict(compression_type='RICE_1', quantize_method=1), 'f4'),
+    (dict(compression_type='HCOMPRESS_1', tile_shape=(1, 8, 9)), 'f4')))
+def test_write_read_compressed(tmpdir, options, dtype):
+    from ..io.fits import CompressedImageArray
+
+    data = (1000 + 10 * np.random.RandomState(0).normal(size=(7, 8, 9)))
+    data = data.astype(dtype)
+    cube = SpectralCube(data, SpectralCube.read(path('adv.fits'))._wcs)
+    tmp_file = str(tmpdir.join('test.fits'))
+    cube.write(tmp_file, **options)
+
+    assert isinstance(fits.open(tmp_file)[1], fits.CompImageHDU)
+    table = fits.open(tmp_file, disable_image_compression=True)[1]
+    assert table.header['ZCMPTYPE'] == options['compression_type']
+    # quantized floating point values are within a quantization step
+    # (the largest ZSCALE of the tiles) of the original ones
+    step = 0
+    if 'ZSCALE' in table.columns.names:
+        step = np.max(table.data['ZSCALE'])
+
+    full = SpectralCube.read(tmp_file)
+    assert_allclose(full._data, data, rtol=1e-6, atol=step)
+
+    # only the tiles that are accessed are decompressed, where astropy
+    # allows it
+    depth = options.get('tile_shape', (1,))[0]
+    with SpectralCube.read(tmp_file, memmap=True) as lazy:
+        assert isinstance(lazy._data, CompressedImageArray)
+        assert lazy._data.shape == data.shape
+        # the type comes from the header, without decompressing any tiles
+        cache = lazy._data._cache
+        assert lazy._data.dtype == full._data.dtype
+        assert lazy._data.nbytes == full._data.nbytes
+        assert lazy._data._cache is cache
+        for view in ((), (1,), (slice(1, 4),), (slice(0, 7, 3), 2),
+                     (-1, slice(None), 0), (slice(4, 2, -1),)):
+            assert_allclose(lazy._data[view], full._data[view])
+        if lazy._data._access == 'table':
+            lazy._data[4]
+            assert lazy._data._cache[:2] == (4 // depth, 4 // depth + 1)
+        assert_allclose(lazy[2:5].sum(axis=0), full[2:5].sum(axis=0))
+
+
+def test_read_compressed_fallback(tmpdir, monkeypatch):
+    # astropy versions without access to the tiles decompress the image
+    from ..io import fits as fits_io
+
+    data = np.random.RandomState(0).normal(size=(7, 8, 9)).astype('f4')
+    cube = SpectralCube(data, SpectralCube.read(path('adv.fits'))._wcs)
+    tmp_file = str(tmpdir.join('test.fits'))
+    cube.write(tmp_file, compression_type='GZIP_1', quantize_level=0)
+
+    monkeypatch.setattr(fits_io, '_tile_access', lambda hdu: None)
+    with SpectralCube.read(tmp_file, memmap=True) as lazy:
+        assert lazy._data.shape == data.shape
+        assert lazy._data.dtype == np.float32
+        assert_allclose(lazy._data[2:4, 1], data[2:4, 1])
+        assert_allclose(lazy.sum(axis=0), data.sum(axis=0), rtol=1e-5)
+
+    # the private astropy attributes may also be missing when the tiles are
+    # decompressed
+    monkeypatch.undo()
+    with SpectralCube.read(tmp_file, memmap=True) as lazy:
+        monkeypatch.setattr(fits_io, '_compressed_tiles', lambda hdu: None)
+        assert_allclose(lazy._data[2:4, 1], data[2:4, 1])
+        assert_allclose(lazy._data[5], data[5])
+
+    assert fits_io._version_tuple('0.4.dev1234') == (0, 4)
+    assert fits_io._version_tuple('5.3rc1') == (5, 3)
+
+
+def test_read_memmap():
+    cube = SpectralCube.read(path('adv.fits'))
+    with SpectralCube.read(path('adv.fits'), memmap=True) as mapped:
+        # astropy returns a read-only view on the mmap buffer
+        base = mapped._data
+        while isinstance(base, np.ndarray):
+            base = base.base
+        assert isinstance(base, mmap.mmap)
+        assert not mapped._data.flags.writeable
+        assert mapped._file_handle is not None
+        assert_allclose(mapped.filled_data[:], cube.filled_data[:])
+        assert_allclose(mapped.sum(axis=0), cube.sum(axis=0))
+    assert mapped._file_handle is None
+
+
+class TestIteration(BaseTest):
+
+    def test_filled_data_out(self):
+        out = np.zeros(self.d.shape[1:])
+        result = self.c.filled_data((1,), out=out)
+        assert result.unit == self.c.unit
+        assert np.may_share_memory(result, out)
+        assert_allclose(out, np.where(self.d[1] > 0.5, self.d[1], np.nan))
+
+    def test_iter_channels(self):
+        channels = [(channel.copy(), channel)
+                    for channel in self.c.iter_channels()]
+        assert len(channels) == self.d.shape[0]
+        for (copy, _), expected in zip(channels, self.c.filled_data[:]):
+            assert_allclose(copy, expected)
+        # the buffers are reused for every channel
+        assert np.may_share_memory(channels[0][1], channels[-1][1])
+
+    @pytest.mark.parametrize('block_size', (None, 4, 7))
+    def test_iter_spectra_blocks(self, block_size):
+        result = np.zeros(self.d.shape)
+        for view, block in self.c.iter_spectra_blocks(block_size=block_size):
+            assert block.unit == self.c.unit
+            result[view] = block.value
+        assert_allclose(result, self.c.filled_data[:])
+
+
+class TestSubcube(BaseTest):
+
+    def _check(self, sub, view):
+        expected = self.c[view]
+        assert sub.shape == expected.shape
+        assert np.may_share_memory(sub._data, self.c._data)
+        assert_allclose(sub.filled_data[:], expected.filled_data[:])
+        assert wcs_utils.check_equality(sub.wcs, expected.wcs)
+        for w1, w2 in zip(sub.world[:, :, :], self.c.world[view]):
+            assert_allclose(w1, w2)
+
+    @pytest.mark.parametrize(('bounds', 'view'),
+                             (((), np.s_[:, :, :]),
+                              ((0, 1, 1, 'max', 1, 3), np.s_[1:3, 1:, 0:1]),
+                              (('min', -1, -2, None, 2, 'max'),
+                               np.s_[2:, 1:, :1])))
+    def test_pixels(self, bounds, view):
+        self._check(self.c.subcube(*bounds), view)
+
+    def test_world(self):
+        v, lat, lon = self.c.world[:, :, :]
+        sub = self.c.subcube(xlo=lon[0, 1, 0], xhi=lon[0, 2, 1],
+                             ylo=lat[0, 1, 0], yhi=lat[0, 2, 1],
+                             zlo=v[2, 0, 0], zhi=v[1, 0, 0])
+        self._check(sub, np.s_[1:3, 1:3, 0:2])
+
+        slab = self.c.spectral_slab(v[1, 0, 0], v[2, 0, 0])
+        assert_allclose(sub.spectral_axis, slab.spectral_axis)
+
+    def test_mask_sliced_lazily(self):
+        sub = self.c.subcube(0, 1, 1, 3, 0, 2)
+        assert isinstance(sub.mask, BooleanArrayMask)
+        assert np.may_share_memory(sub.mask._mask, self.mask._mask)
+
+        lazy = self.c.with_mask(self.c > 0.7).subcube(0, 1, 1, 3, 0, 2)
+        assert isinstance(lazy.mask, CompositeMask)
+        assert_allclose(lazy.get_mask_array(),
+                        (self.d > 0.5)[:2, 1:3, :1] & (self.d > 0.7)[:2, 1:3, :1])
+
+    def test_subcubes(self):
+        regions = [(0, 1, 0, 2, 'min', 'max'), (1, 2, 1, 3, 2, 4)]
+        subs = self.c.subcubes(regions)
+        for sub, region in zip(subs, regions):
+            expected = self.c.subcube(*region)
+            assert_allclose(sub.filled_data[:], expected.filled_data[:])
+
+    def test_invalid(self):
+        with pytest.raises(ValueError) as exc:
+            self.c.subcube(zlo=3, zhi=3)
+        assert exc.value.args[0] == ("Region ('min', 'max', 'min', 'max', 3, 3) "
+                                     "does not overlap the cube")
+        with pytest.raises(ValueError) as exc:
+            self.c.subcube(xlo=1 * u.deg)
+        assert exc.value.args[0] == ("The spatial bounds of a region should "
+                                     "all be world coordinates, or none of "
+                                     "them")
+        with pytest.raises(IndexError):
+            self.c[0]
+
+    @pytest.mark.parametrize('view', (np.s_[::-1], np.s_[:, 1::2],
+                                      np.s_[:, :, ::0]))
+    def test_steps(self, view):
+        # the WCS can only be shifted, so reversed or strided views are
+        # rejected rather than mismatching the data
+        with pytest.raises(IndexError):
+            self.c[view]
+        assert_allclose(self.c[:, 1:, ::1].filled_data[:],
+                        self.c.filled_data[:, 1:, :])
+
+
+class TestChunked(BaseTest):
+
+    @pytest.mark.parametrize(('chunksize', 'prefetch'),
+                             ((None, True), (None, False), (3, True),
+                              (10, False), (30, True)))
+    def test_chunked(self, chunksize, prefetch):
+        data = np.zeros(self.d.shape)
+        mask = np.zeros(self.d.shape, dtype=bool)
+        count = np.zeros(self.d.shape, dtype=int)
+        for view, chunk, include in self.c.chunked(chunksize=chunksize,
+                                                   prefetch=prefetch):
+            assert chunk.unit == self.c.unit
+            data[view] = chunk.value
+            mask[view] = include
+            count[view] += 1
+        assert (count == 1).all()
+        assert_allclose(data, self.d)
+        assert_allclose(mask, self.d > 0.5)
+
+    def test_chunked_stop(self):
+        # stopping early does not leave the prefetching thread running
+        threads = set(threading.enumerate())
+        reads = []
+        read_chunk = self.c._read_chunk
+
+        def counting_read_chunk(view):
+            reads.append(view)
+            return read_chunk(view)
+
+        self.c._read_chunk = counting_read_chunk
+        nchunks = len(cube_utils.contiguous_views(self.c.shape, 3))
+
+        chunks = self.c.chunked(chunksize=3)
+        next(chunks)
+        assert set(threading.enumerate()) - threads
+        chunks.close()
+
+        with pytest.raises(StopIteration):
+            next(chunks)
+        # at most the current and the prefetched chunks were read
+        assert 1 <= len(reads) <= 2 < nchunks
+        assert set(threading.enumerate()) - threads == set()
+
+
+class TestResultCache(object):
+
+    def setup_method(self, method):
+        clear_cache()
+        self.limit = get_memory_limit()
+
+    def teardown_method(self, method):
+        set_memory_limit(self.limit)
+        clear_cache()
+
+    def test_cached_per_instance(self):
+        cube, _ = cube_and_raw('adv.fits')
+        assert cube._pix_cen() is cube._pix_cen()
+        cube2 = cube[:, :, :]
+        assert cube2._pix_size() is not cube._pix_size()
+        assert _RESULT_CACHE.nbytes > 0
+
+        cube.clear_cache()
+        assert len(_RESULT_CACHE._instances) == 1
+        clear_cache()
+        assert _RESULT_CACHE.nbytes == 0
+
+    def test_cubes_not_kept_alive(self):
+        cube, _ = cube_and_raw('adv.fits')
+        cube._pix_cen()
+        ref = weakref.ref(cube)
+        del cube
+        gc.collect()
+        assert ref() is None
+        assert _RESULT_CACHE.nbytes == 0
+        assert len(_RESULT_CACHE._results) == 0
+
+    def test_eviction(self):
+        cube, _ = cube_and_raw('adv.fits')
+        nbytes = sum(a.nbytes for a in cube._pix_cen())
+        clear_cache()
+
+        # room for the results of a single cube
+        set_memory_limit(4 * nbytes)
+        cubes = [cube[:, :, :] for _ in range(3)]
+        for c in cubes:
+            c._pix_cen()
+        assert _RESULT_CACHE.nbytes == nbytes
+        assert list(_RESULT_CACHE._instances) == [id(cubes[-1])]
+
+        # results larger than the budget are not cached
+        set_memory_limit(nbytes)
+        clear_cache()
+        cube._pix_cen()
+        assert _RESULT_CACHE.nbytes == 0
+
+
 def _dummy_cube():
     data = np.array([[[0, 1, 2, 3, 4]]])
     wcs = WCS(naxis=3)
@@ -0,0 +1,122 @@
+import pytest
+import numpy as np
+
+from astropy.io import fits
+from astropy import units as u
+
+from .. import SpectralCube, StokesSpectralCube, BooleanArrayMask
+from . import path
+from .helpers import assert_allclose
+
+
+def make_stokes_file(tmpdir, codes=(1, 2, 3, 4)):
+    # an IQUV cube built from the header of advs.fits
+    header = fits.getheader(path('advs.fits'))
+    del header['BLANK']
+    data = np.random.RandomState(0).normal(size=(len(codes), 2, 3, 4))
+    data[1, 0, 1, 2] = np.nan
+    header['CRVAL4'] = codes[0]
+    header['CDELT4'] = codes[1] - codes[0] if len(codes) > 1 else 1
+    filename = str(tmpdir.join('stokes.fits'))
+    fits.writeto(filename, data, header)
+    return filename, data
+
+
+def test_read_advs():
+    cube = StokesSpectralCube.read(path('advs.fits'))
+    assert cube.components == ['I']
+    assert_allclose(cube.I._data, SpectralCube.read(path('advs.fits'))._data)
+
+    # a cube without Stokes axis holds Stokes I
+    cube = StokesSpectralCube.read(path('adv.fits'))
+    assert cube.components == ['I']
+    assert_allclose(cube.I._data, SpectralCube.read(path('adv.fits'))._data)
+
+
+@pytest.mark.parametrize('memmap', (False, True))
+def test_components(tmpdir, memmap):
+    filename, data = make_stokes_file(tmpdir)
+    cube = StokesSpectralCube.read(filename, memmap=memmap)
+    assert cube.components == ['I', 'Q', 'U', 'V']
+
+    for i, name in enumerate('IQUV'):
+        component = getattr(cube, name)
+        assert type(component) is SpectralCube
+        assert component._wcs is cube._wcs
+        # the components are views of the file data
+        assert not component._data.flags.owndata
+        assert_allclose(component._data, data[i])
+
+    # each component has its own mask
+    assert not cube.Q.get_mask_array()[0, 1, 2]
+    assert cube.I.get_mask_array()[0, 1, 2]
+    assert_allclose(cube.Q.sum(axis=0), np.nansum(data[1], axis=0))
+
+    # the cube acts as Stokes I
+    assert_allclose(cube._data, data[0])
+    assert_allclose(SpectralCube.read(filename)._data, data[0])
+
+    with pytest.raises(AttributeError):
+        cube.RR
+    with pytest.raises(KeyError):
+        cube.component('RR')
+
+    cube.close()
+
+
+def test_component_names(tmpdir):
+    filename, data = make_stokes_file(tmpdir, codes=(-1, -2))
+    cube = StokesSpectralCube.read(filename)
+    assert cube.components == ['RR', 'LL']
+    assert_allclose(cube.LL._data, data[1])
+
+    with pytest.raises(ValueError):
+        cube.polarized_intensity()
+
+
+def test_polarization(tmpdir):
+    filename, data = make_stokes_file(tmpdir)
+    cube = StokesSpectralCube.read(filename)
+
+    intensity = cube.polarized_intensity()
+    expected = np.hypot(data[1], data[2])
+    assert intensity.unit == cube.unit
+    assert_allclose(intensity.filled_data[:].value, expected)
+    assert_allclose(intensity[1:2].filled_data[:].value, expected[1:2])
+    for how in ('cube', 'slice', 'ray'):
+        assert_allclose(intensity.max(axis=0, how=how),
+                        np.nanmax(expected, axis=0))
+
+    angle = cube.polarization_angle()
+    assert angle.unit == u.deg
+    assert_allclose(angle.filled_data[:].value,
+                    np.degrees(0.5 * np.arctan2(data[2], data[1])))
+
+    # the elements excluded from Q or U are excluded
+    cube._stokes_mask['U'] = BooleanArrayMask(data[2] > 0, cube._wcs)
+    intensity = cube.polarized_intensity()
+    assert not intensity.get_mask_array()[0, 1, 2]
+    assert_allclose(intensity.get_mask_array(),
+                    np.isfinite(expected) & (data[2] > 0))
+
+
+@pytest.mark.parametrize('options', ({}, dict(chunksize=5)))
+def test_read_write_roundtrip(tmpdir, options):
+    filename, data = make_stokes_file(tmpdir)
+    cube = StokesSpectralCube.read(filename)
+    tmp_file = str(tmpdir.join('test.fits'))
+    cube.write(tmp_file, **options)
+
+    cube2 = StokesSpectralCube.read(tmp_file)
+    assert cube2.components == cube.components
+    for name in cube.components:
+        assert_allclose(cube2.component(name)._data,
+                        cube.component(name)._data)
+    assert (cube._wcs.to_header_string() ==
+            cube2._wcs.to_header_string())
+
+    # a single component is written with a Stokes axis
+    cube = StokesSpectralCube.read(path('adv.fits'))
+    cube.write(tmp_file, overwrite=True)
+    assert fits.getdata(tmp_file).shape == (1,) + cube.shape
+    assert StokesSpectralCube.read(tmp_file).components == ['I']
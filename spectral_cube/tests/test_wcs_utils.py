@@ -74,3 +74,44 @@ def test_wcs_slice():
     wcs.wcs.crpix = [50., 45., 30.]
     wcs_new = slice_wcs(wcs, (slice(10,20), slice(None), slice(20,30)))
     np.testing.assert_allclose(wcs_new.wcs.crpix, [30., 45., 20.])
+
+
+def test_wcs_slice_lazy():
+    wcs = WCS(naxis=3)
+    wcs.wcs.crpix = [50., 45., 30.]
+    view = (slice(10,20), slice(None), slice(20,30))
+    lazy = slice_wcs(wcs, view, lazy=True)
+    assert isinstance(lazy, OffsetWCS)
+    assert slice_wcs(wcs, (slice(None),) * 3, lazy=True) is wcs
+
+    # slicing again composes the offsets, and fingerprints are computed
+    # without copying the WCS
+    lazy = slice_wcs(lazy, (slice(1, 5), slice(2, None), slice(None)),
+                     lazy=True)
+    assert lazy.parent is wcs
+    expected = slice_wcs(slice_wcs(wcs, view),
+                         (slice(1, 5), slice(2, None), slice(None)))
+    assert wcs_fingerprint(lazy) == wcs_fingerprint(expected)
+    assert check_equality(lazy, expected)
+    assert lazy._wcs is None
+
+    np.testing.assert_allclose(lazy.wcs.crpix, [30., 43., 19.])
+    np.testing.assert_allclose(as_wcs(lazy).wcs_pix2world([[1, 2, 3]], 0),
+                               expected.wcs_pix2world([[1, 2, 3]], 0))
+
+
+def test_wcs_fingerprint():
+    wcs = WCS(path('adv.fits'))
+    other = WCS(path('adv.fits'))
+    assert wcs_fingerprint(wcs) == wcs_fingerprint(other)
+    assert check_equality(wcs, other)
+
+    # units are compared in canonical form
+    wcs.wcs.cunit[2] = 'm/s'
+    other.wcs.cunit[2] = 'm s-1'
+    assert wcs_fingerprint(wcs) == wcs_fingerprint(other)
+
+    # modifications in place are taken into account
+    other.wcs.crpix[2] += 1
+    assert wcs_fingerprint(wcs) != wcs_fingerprint(other)
+    assert not check_equality(wcs, other)
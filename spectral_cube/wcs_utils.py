@@ -159,7 +159,63 @@ def axis_names(wcs):
     return names
 
 
-def slice_wcs(wcs, view):
+class OffsetWCS(object):
+    """
+    A WCS shifted by a number of pixels along each axis, as obtained when
+    slicing, which is only computed when it is needed.
+
+    Slicing a WCS requires a copy of the underlying wcslib structure, which
+    is costly when slicing masks many times (e.g. when iterating over them).
+    This records the parent WCS and the offset instead: attributes of the
+    shifted WCS are computed on first access, while `wcs_fingerprint`
+    (and hence `check_equality` for matching WCSs) works without it. The
+    parent WCS should not be modified in place afterwards.
+
+    Parameters
+    ----------
+    wcs : `~astropy.wcs.WCS` or `OffsetWCS`
+        The parent WCS
+    offset : array
+        The number of pixels to subtract from ``crpix``, in WCS order
+    """
+
+    def __init__(self, wcs, offset):
+        offset = np.asarray(offset, dtype=float)
+        if isinstance(wcs, OffsetWCS):
+            offset = offset + wcs.offset
+            wcs = wcs.parent
+        self.parent = wcs
+        self.offset = offset
+        self._wcs = None
+
+    def to_wcs(self):
+        """
+        Return the shifted WCS as an `~astropy.wcs.WCS` instance
+        """
+        if self._wcs is None:
+            wcs = self.parent.deepcopy()
+            wcs.wcs.crpix -= self.offset
+            self._wcs = wcs
+        return self._wcs
+
+    def deepcopy(self):
+        return self.to_wcs().deepcopy()
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set on this instance
+        if name.startswith('__') or name in ('parent', 'offset', '_wcs'):
+            raise AttributeError(name)
+        return getattr(self.to_wcs(), name)
+
+
+def as_wcs(wcs):
+    """
+    Return a `~astropy.wcs.WCS` instance for a WCS or an `OffsetWCS`
+    """
+    return wcs.to_wcs() if isinstance(wcs, OffsetWCS) else wcs
+
+
+def slice_wcs(wcs, view, lazy=False):
     """
     Slice a WCS instance using a Numpy slice. The order of the slice should
     be reversed (as for the data) compared to the natural WCS order.
@@ -168,28 +224,137 @@ def slice_wcs(wcs, view):
     ----------
     view : tuple
         A tuple containing the same number of slices as the WCS system
+    lazy : bool, optional
+        If True, return an `OffsetWCS` rather than copying the WCS, or the
+        input WCS itself if the view does not shift it
 
     Returns
     -------
     A new `~astropy.wcs.WCS` instance
     """
-    if len(view) != wcs.wcs.naxis:
+    naxis = (wcs.parent if isinstance(wcs, OffsetWCS) else wcs).wcs.naxis
+    if len(view) != naxis:
         raise ValueError("Must have same number of slices as number of WCS axes")
 
-    wcs_new = wcs.deepcopy()
+    offset = np.zeros(len(view))
     for i, iview in enumerate(view):
         if iview.start is not None:
             if iview.step not in (None, 1):
                 raise NotImplementedError("Cannot yet slice WCS with strides different from None or 1")
-            wcs_index = wcs.wcs.naxis - 1 - i
-            wcs_new.wcs.crpix[wcs_index] -= iview.start
-    return wcs_new
+            wcs_index = len(view) - 1 - i
+            offset[wcs_index] = iview.start
+
+    if lazy:
+        return OffsetWCS(wcs, offset) if offset.any() else wcs
+    return OffsetWCS(wcs, offset).to_wcs()
+
+
+def is_spectrally_separable(wcs):
+    """
+    Check whether the spectral coordinates of a 3-d WCS, whose last axis is
+    the spectral axis, only depend on the spectral pixel coordinate, and the
+    celestial coordinates only on the celestial pixel coordinates.
+
+    Parameters
+    ----------
+    wcs : `~astropy.wcs.WCS`
+        A 3-d WCS, such as the WCS of a `~spectral_cube.SpectralCube`
+
+    Returns
+    -------
+    separable : bool
+    """
+    if wcs.wcs.naxis != 3:
+        return False
+    # distortions are only defined for the first two pixel axes, but may
+    # not be consistent with the PC matrix
+    if any(getattr(wcs, name, None) is not None
+           for name in ('sip', 'cpdis1', 'cpdis2', 'det2im1', 'det2im2')):
+        return False
+    pc = wcs.wcs.get_pc()
+    return not (pc[2, :2].any() or pc[:2, 2].any())
+
+
+def _to_bytes(array):
+    """
+    Return the raw bytes of an array or numpy scalar
+    (``ndarray.tobytes`` needs numpy 1.9)
+    """
+    if hasattr(array, 'tobytes'):
+        return array.tobytes()
+    return array.tostring()
+
+
+def _hashable(value):
+    """
+    Convert a WCS parameter to a hashable value, for which NaN values
+    compare equal
+    """
+    if isinstance(value, np.ndarray):
+        return (value.dtype.str, value.shape, _to_bytes(value))
+    if isinstance(value, float):
+        return _to_bytes(np.float64(value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+_CANONICAL_UNITS = {}
+
+
+def _canonical_units(wcs):
+    """
+    Return the units of the axes of a WCS in canonical form (e.g. "m/s" and
+    "m s-1" are the same)
+    """
+    units = []
+    for unit in wcs.wcs.cunit:
+        # parsing the units is slow, so each one is only parsed once
+        unit = str(unit)
+        if unit not in _CANONICAL_UNITS:
+            _CANONICAL_UNITS[unit] = str(u.Unit(unit, parse_strict='silent'))
+        units.append(_CANONICAL_UNITS[unit])
+    return tuple(units)
+
+
+def wcs_fingerprint(wcs):
+    """
+    Return a hashable summary of the parameters of a WCS that are written
+    to its header, with the units in canonical form.
+
+    WCSs with the same fingerprint are equal according to
+    `check_equality`. The fingerprint is recomputed on every call, since
+    WCS objects can be modified in place, but only involves reading a few
+    small arrays, which is much faster than comparing the headers.
+    """
+    offset = 0
+    if isinstance(wcs, OffsetWCS):
+        if wcs._wcs is None:
+            offset = wcs.offset
+        wcs = wcs.parent if wcs._wcs is None else wcs._wcs
+    w = wcs.wcs
+    try:
+        linear = [w.get_cdelt(), w.get_pc()]
+    except Exception:
+        # the WCS cannot be set up, so use the parameters as given
+        linear = [w.cdelt, w.cd if w.has_cd() else w.pc]
+    values = [w.naxis, tuple(w.ctype), _canonical_units(wcs),
+              w.crpix - offset, w.crval, w.get_pv(), w.get_ps(), w.lonpole,
+              w.latpole] + linear
+    values.extend(getattr(w, name) for name in wcs_parameters_to_preserve)
+    return _hashable(values)
+
 
 def check_equality(wcs1, wcs2, warn_missing=False, verbose=False):
     """
     Check if two WCSs are equal
     """
 
+    # WCSs with the same parameters are equal, which is much faster to
+    # check than comparing their headers
+    if wcs1 is wcs2 or wcs_fingerprint(wcs1) == wcs_fingerprint(wcs2):
+        return True
+
     # naive version:
     # return str(wcs1.to_header()) != str(wcs2.to_header())
 